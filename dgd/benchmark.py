@@ -0,0 +1,245 @@
+""" Benchmarks of the denoising network on random batches, with the model settings of the hydra config.
+
+    python dgd/benchmark.py model.n_layers=8 train.batch_size=256 benchmark.n_nodes=60
+    python dgd/benchmark.py benchmark.name=precision
+    python dgd/benchmark.py benchmark.name=inference train.batch_size=1024
+    python dgd/benchmark.py benchmark.name=checks
+    python dgd/benchmark.py benchmark.name=posterior
+
+    The NLL of a trained model in both precisions is logged at each validation epoch with model.precision=bf16 and
+    model.check_fp32_nll=True (val/epoch_NLL_fp32).
+"""
+import sys
+import os
+current = os.path.dirname(os.path.realpath(__file__))
+parent_directory = os.path.dirname(current)
+sys.path.append(parent_directory)
+
+import time
+
+import hydra
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from omegaconf import DictConfig
+
+from dgd import utils
+from dgd.diffusion import diffusion_utils
+from dgd.diffusion.noise_schedule import PredefinedNoiseScheduleDiscrete
+from dgd.models.inference import CompiledDenoiser
+from dgd.models.transformer_model import GraphTransformer
+
+
+def build_model(cfg, **kwargs):
+    """ GraphTransformer of cfg.model for the random inputs of random_batch. kwargs override the config. """
+    types = {'X': cfg.benchmark.node_types, 'E': cfg.benchmark.edge_types}
+    options = dict(attention_chunk_size=cfg.model.get('attention_chunk_size', None),
+                   symmetric_edges=cfg.model.get('symmetric_edges', False),
+                   packed=cfg.model.get('packed', False),
+                   checkpoint_every=cfg.model.get('checkpoint_every', None))
+    options.update(kwargs)
+    return GraphTransformer(n_layers=cfg.model.n_layers,
+                            input_dims={'X': types['X'], 'E': types['E'], 'y': 1},
+                            hidden_mlp_dims=cfg.model.hidden_mlp_dims,
+                            hidden_dims=cfg.model.hidden_dims,
+                            output_dims={'X': types['X'], 'E': types['E'], 'y': 0},
+                            act_fn_in=nn.ReLU(),
+                            act_fn_out=nn.ReLU(),
+                            **options)
+
+
+def random_batch(bs, n, node_types, edge_types, device, seed=0):
+    """ One-hot graphs with random types and between n / 2 and n nodes, and a random time in y. """
+    generator = torch.Generator().manual_seed(seed)
+    n_nodes = torch.randint(max(1, n // 2), n + 1, (bs,), generator=generator)
+    n_nodes[0] = n
+    node_mask = torch.arange(n).unsqueeze(0) < n_nodes.unsqueeze(1)
+    X = F.one_hot(torch.randint(node_types, (bs, n), generator=generator), node_types).float()
+    E = torch.randint(edge_types, (bs, n, n), generator=generator).triu(diagonal=1)
+    E = F.one_hot(E + E.transpose(1, 2), edge_types).float()
+    y = torch.rand(bs, 1, generator=generator)
+    batch = utils.PlaceHolder(X=X, E=E, y=y).mask(node_mask)
+    return utils.PlaceHolder(X=batch.X.to(device), E=batch.E.to(device), y=batch.y.to(device)), node_mask.to(device)
+
+
+def saved_tensor_bytes(fn):
+    """ Runs fn and returns its output and the size of the distinct storages kept for the backward pass. """
+    storages = {}
+
+    def pack(tensor):
+        storage = tensor.storage()
+        storages[storage.data_ptr()] = storage.size() * storage.element_size()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        out = fn()
+    return out, sum(storages.values())
+
+
+def train_step(model, batch, node_mask):
+    pred = model(batch.X, batch.E, batch.y, node_mask)
+    loss = pred.X.sum() + pred.E.sum() + pred.y.sum()
+    loss.backward()
+    model.zero_grad(set_to_none=True)
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def profile_training(model, batch, node_mask, repeats, device):
+    """ Returns the bytes saved for backward, the peak cuda memory (0 on cpu) and the mean time of a training step. """
+    model.train()
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+    pred, saved = saved_tensor_bytes(lambda: model(batch.X, batch.E, batch.y, node_mask))
+    (pred.X.sum() + pred.E.sum() + pred.y.sum()).backward()
+    model.zero_grad(set_to_none=True)
+    peak = torch.cuda.max_memory_allocated(device) if device.type == 'cuda' else 0
+
+    synchronize(device)
+    start = time.perf_counter()
+    for _ in range(repeats):
+        train_step(model, batch, node_mask)
+    synchronize(device)
+    return saved, peak, (time.perf_counter() - start) / repeats
+
+
+def benchmark_checkpointing(cfg, device):
+    """ Activation memory and step time of each value of benchmark.checkpoint_every. """
+    batch, node_mask = random_batch(cfg.train.batch_size, cfg.benchmark.n_nodes, cfg.benchmark.node_types,
+                                    cfg.benchmark.edge_types, device)
+    print(f"Batch of {cfg.train.batch_size} graphs, up to {cfg.benchmark.n_nodes} nodes, "
+          f"{cfg.model.n_layers} layers")
+    reference = None
+    for k in cfg.benchmark.checkpoint_every:
+        torch.manual_seed(cfg.train.seed)
+        model = build_model(cfg, checkpoint_every=k).to(device)
+        saved, peak, step_time = profile_training(model, batch, node_mask, cfg.benchmark.repeats, device)
+        if reference is None:
+            reference = (saved, step_time)
+        print(f"checkpoint_every={k}: {saved / 2 ** 20:.1f} MiB saved for backward "
+              f"({saved / reference[0]:.2f}x), {step_time * 1000:.1f} ms per step ({step_time / reference[1]:.2f}x)"
+              + (f", peak {peak / 2 ** 20:.1f} MiB" if peak > 0 else ""))
+
+
+def softmax_kl(pred, reference, mask):
+    """ Mean KL(softmax(reference) || softmax(pred)) over the masked rows. """
+    kl = F.kl_div(F.log_softmax(pred, dim=-1), F.log_softmax(reference, dim=-1), log_target=True, reduction='none')
+    return kl.sum(-1)[mask].mean().item()
+
+
+def benchmark_precision(cfg, device):
+    """ Step time of each precision and distance of its predicted distributions to the float32 ones. """
+    batch, node_mask = random_batch(cfg.train.batch_size, cfg.benchmark.n_nodes, cfg.benchmark.node_types,
+                                    cfg.benchmark.edge_types, device)
+    edge_mask = node_mask.unsqueeze(1) & node_mask.unsqueeze(2)
+    torch.manual_seed(cfg.train.seed)
+    model = build_model(cfg).to(device)
+    model.eval()
+    with torch.no_grad():
+        reference = model(batch.X, batch.E, batch.y, node_mask)
+    for precision in utils.PRECISIONS:
+        model.eval()
+        with torch.no_grad(), utils.network_autocast(device, precision):
+            pred = model(batch.X, batch.E, batch.y, node_mask)
+        kl_X = softmax_kl(pred.X.float(), reference.X, node_mask)
+        kl_E = softmax_kl(pred.E.float(), reference.E, edge_mask)
+
+        model.train()
+        synchronize(device)
+        start = time.perf_counter()
+        for _ in range(cfg.benchmark.repeats):
+            with utils.network_autocast(device, precision):
+                pred = model(batch.X, batch.E, batch.y, node_mask)
+            (pred.X.float().sum() + pred.E.float().sum()).backward()
+            model.zero_grad(set_to_none=True)
+        synchronize(device)
+        step_time = (time.perf_counter() - start) / cfg.benchmark.repeats
+        print(f"{precision}: {step_time * 1000:.1f} ms per training step, KL to fp32 predictions: "
+              f"nodes {kl_X:.2e}, edges {kl_E:.2e}")
+
+
+def time_inference(network, batch, node_mask, repeats, device):
+    """ Mean time of a call, after a first call that builds any cached trace. """
+    with torch.no_grad():
+        network(batch.X, batch.E, batch.y, node_mask)
+        synchronize(device)
+        start = time.perf_counter()
+        for _ in range(repeats):
+            network(batch.X, batch.E, batch.y, node_mask)
+        synchronize(device)
+    return (time.perf_counter() - start) / repeats
+
+
+def benchmark_inference(cfg, device):
+    """ Time of one denoising step with the eager network and with each inference backend. """
+    batch, node_mask = random_batch(cfg.train.batch_size, cfg.benchmark.n_nodes, cfg.benchmark.node_types,
+                                    cfg.benchmark.edge_types, device)
+    torch.manual_seed(cfg.train.seed)
+    model = build_model(cfg).to(device)
+    model.eval()
+    backends = {'eager': model, 'jit': CompiledDenoiser(model)}
+    reference = None
+    for name, network in backends.items():
+        step_time = time_inference(network, batch, node_mask, cfg.benchmark.repeats, device)
+        reference = step_time if reference is None else reference
+        print(f"{name}: {step_time * 1000:.2f} ms per denoising step ({reference / step_time:.2f}x eager speed)")
+
+
+def benchmark_checks(cfg, device):
+    """ Throughput of the network at each level of runtime checks, see utils.set_check_level. """
+    batch, node_mask = random_batch(cfg.train.batch_size, cfg.benchmark.n_nodes, cfg.benchmark.node_types,
+                                    cfg.benchmark.edge_types, device)
+    torch.manual_seed(cfg.train.seed)
+    model = build_model(cfg).to(device)
+    for level in utils.CHECK_LEVELS:
+        utils.set_check_level(level, interval=cfg.general.get('check_interval', 100))
+        model.eval()
+        step_time = time_inference(model, batch, node_mask, cfg.benchmark.repeats, device)
+        _, _, train_time = profile_training(model, batch, node_mask, cfg.benchmark.repeats, device)
+        print(f"check_level={level}: {cfg.train.batch_size / step_time:.0f} graphs/s in inference, "
+              f"{cfg.train.batch_size / train_time:.0f} graphs/s in training")
+    utils.set_check_level('full')
+
+
+def benchmark_posterior(cfg, device):
+    """ Posterior q(z_s | z_t, x_0) of the all-step sampler, s = t - 1, with Qsb at t (original sampler) and at s
+        (model.exact_sampling_posterior). Averaged over z_t ~ q(z_t | x_0), it should give back q(z_s | x_0): prints
+        the largest error over all x_0 and z_s, for the node marginals of a random dataset. """
+    schedule = PredefinedNoiseScheduleDiscrete(cfg.model.diffusion_noise_schedule, cfg.model.diffusion_steps)
+    torch.manual_seed(cfg.train.seed)
+    d = cfg.benchmark.node_types
+    marginals = torch.softmax(torch.randn(d), dim=0)
+    eye = torch.eye(d)
+    # Batch over x_0, one entry per value of z_t
+    X_t = eye.unsqueeze(0).expand(d, d, d)
+    x_0 = eye.unsqueeze(1).expand(d, d, d)
+    T = cfg.model.diffusion_steps
+    for t_int in sorted({1, 2, T // 10, T // 4, T // 2, T}):
+        alpha_t_bar, alpha_s_bar = schedule.alphas_bar[t_int], schedule.alphas_bar[t_int - 1]
+        q_t = alpha_t_bar * eye + (1 - alpha_t_bar) * marginals          # q(z_t | x_0), x_0 x z_t
+        q_s = alpha_s_bar * eye + (1 - alpha_s_bar) * marginals          # q(z_s | x_0), x_0 x z_s
+        errors = []
+        for s_bar in (alpha_t_bar, alpha_s_bar):
+            coefficients = [value * torch.ones(d, 1) for value in (1 - schedule.betas[t_int], s_bar, alpha_t_bar)]
+            posterior = diffusion_utils.low_rank_posterior_distribution(X_t, x_0, marginals, *coefficients)
+            posterior = posterior / posterior.sum(dim=-1, keepdim=True)
+            errors.append(((q_t.unsqueeze(-1) * posterior).sum(dim=1) - q_s).abs().max().item())
+        print(f"t={t_int}: largest error of the averaged posterior {errors[0]:.2e} with Qsb at t (original), "
+              f"{errors[1]:.2e} with Qsb at s")
+
+
+BENCHMARKS = {'checkpointing': benchmark_checkpointing, 'precision': benchmark_precision,
+              'inference': benchmark_inference, 'checks': benchmark_checks, 'posterior': benchmark_posterior}
+
+
+@hydra.main(version_base='1.1', config_path='../configs', config_name='benchmark')
+def main(cfg: DictConfig):
+    device = torch.device('cuda' if torch.cuda.is_available() and cfg.general.gpus > 0 else 'cpu')
+    BENCHMARKS[cfg.benchmark.name](cfg, device)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,17 @@
+import hashlib
+import os
+
 from dgd.diffusion.distributions import DistributionNodes
+from dgd.datasets.graph_store import PackedGraphStore, store_fingerprint
+from dgd.datasets.collate import DenseCollater
+from dgd.datasets.streaming import StreamingGraphDataset
+from dgd.datasets.samplers import BucketBatchSampler, TokenBudgetBatchSampler, dataset_num_nodes
 import dgd.utils as utils
+import numpy as np
 import torch
 import pytorch_lightning as pl
+from torch.utils.data import IterableDataset, Subset
+from torch_geometric.data import InMemoryDataset
 from torch_geometric.loader import DataLoader
 
 
@@ -12,13 +22,52 @@ class AbstractDataModule(pl.LightningDataModule):
         self.dataloaders = None
         self.input_dims = None
         self.output_dims = None
+        self._statistics = None
 
     def prepare_data(self, datasets) -> None:
+        self.dataloaders = {split: self.make_dataloader(split, dataset) for split, dataset in datasets.items()}
+
+    def make_dataloader(self, split, dataset):
         batch_size = self.cfg.train.batch_size
+        shuffle = 'debug' not in self.cfg.general.name
+        if isinstance(dataset, IterableDataset):
+            # Streaming datasets shuffle themselves and cannot be batched by size
+            return self.loader(dataset, batch_size=batch_size)
+        if self.cfg.train.batch_sampler is None:
+            return self.loader(dataset, batch_size=batch_size, shuffle=shuffle)
+
+        num_nodes = dataset_num_nodes(dataset)
+        if self.cfg.train.batch_sampler == 'bucket':
+            sampler = BucketBatchSampler(num_nodes, batch_size=batch_size,
+                                         bucket_size_multiplier=self.cfg.train.bucket_size_multiplier,
+                                         shuffle=shuffle, seed=self.cfg.train.seed)
+        elif self.cfg.train.batch_sampler == 'budget':
+            # By default, the budget is the memory of a fixed size batch of the largest graphs
+            max_edge_slots = self.cfg.train.max_edge_slots
+            if max_edge_slots is None:
+                max_edge_slots = batch_size * int(num_nodes.max()) ** 2
+            print(f"Batches of {split} are filled up to {max_edge_slots} dense edge slots")
+            sampler = TokenBudgetBatchSampler(num_nodes, max_edge_slots=max_edge_slots,
+                                              bucket_size=batch_size * self.cfg.train.bucket_size_multiplier,
+                                              shuffle=shuffle, seed=self.cfg.train.seed)
+        else:
+            raise ValueError(f"Unknown batch sampler {self.cfg.train.batch_sampler}")
+
+        efficiency, reference = sampler.padding_efficiency(reference_batch_size=batch_size)
+        print(f"Padding efficiency on {split}: {efficiency:.1%} with {self.cfg.train.batch_sampler} batches, "
+              f"{reference:.1%} with random batches")
+        return self.loader(dataset, batch_sampler=sampler)
+
+    def loader(self, dataset, **kwargs):
+        """ DataLoader with the worker, pinned memory and collation options of cfg.train. """
         num_workers = self.cfg.train.num_workers
-        self.dataloaders = {split: DataLoader(dataset, batch_size=batch_size, num_workers=num_workers,
-                                              shuffle='debug' not in self.cfg.general.name)
-                            for split, dataset in datasets.items()}
+        kwargs['num_workers'] = num_workers
+        kwargs['pin_memory'] = self.cfg.train.get('pin_memory', False)
+        if num_workers > 0:
+            kwargs['prefetch_factor'] = self.cfg.train.get('prefetch_factor', 2)
+        if self.cfg.train.get('dense_collate', False):
+            return torch.utils.data.DataLoader(dataset, collate_fn=DenseCollater(), **kwargs)
+        return DataLoader(dataset, **kwargs)
 
     def train_dataloader(self):
         return self.dataloaders["train"]
@@ -32,80 +81,149 @@ class AbstractDataModule(pl.LightningDataModule):
     def __getitem__(self, idx):
         return self.dataloaders['train'][idx]
 
-    def node_counts(self, max_nodes_possible=300):
-        all_counts = torch.zeros(max_nodes_possible)
+    def dataset_statistics(self):
+        """ Marginals of the whole dataset (train, val and test), computed in a single pass over the dataloaders.
+            Results are cached on disk next to the data, see statistics_cache_file. """
+        if self._statistics is not None:
+            return self._statistics
+        cache_file = self.statistics_cache_file()
+        if cache_file is not None and os.path.exists(cache_file):
+            self._statistics = torch.load(cache_file)
+            print(f"Dataset statistics loaded from {cache_file}")
+            return self._statistics
+
+        n_counts, node_types, edge_types = None, None, None
         for split in ['train', 'val', 'test']:
-            for i, data in enumerate(self.dataloaders[split]):
-                unique, counts = torch.unique(data.batch, return_counts=True)
-                for count in counts:
-                    all_counts[count] += 1
-        max_index = max(all_counts.nonzero())
-        all_counts = all_counts[:max_index + 1]
-        all_counts = all_counts / all_counts.sum()
-        return all_counts
+            for data in self.dataloaders[split]:
+                counts = torch.bincount(data.batch)
+                batch_n_counts = torch.bincount(counts)
+                batch_node_types = data.x.sum(dim=0).double()
+                batch_edge_types = data.edge_attr.sum(dim=0).double()
+                # Every ordered pair of distinct nodes that is not an edge counts as "no edge"
+                num_non_edges = (counts * (counts - 1)).sum() - data.edge_index.shape[1]
+                assert num_non_edges >= 0
+                batch_edge_types[0] = num_non_edges
+                self.accumulate_statistics(data)
 
-    def node_types(self):
-        num_classes = None
-        for data in self.dataloaders['train']:
-            num_classes = data.x.shape[1]
-            break
+                if n_counts is None:
+                    n_counts, node_types, edge_types = batch_n_counts, batch_node_types, batch_edge_types
+                else:
+                    n_counts = add_counts(n_counts, batch_n_counts)
+                    node_types += batch_node_types
+                    edge_types += batch_edge_types
+
+        statistics = {'n_nodes': (n_counts / n_counts.sum()).float(),
+                      'node_types': (node_types / node_types.sum()).float(),
+                      'edge_types': (edge_types / edge_types.sum()).float()}
+        statistics.update(self.collect_statistics())
+        if cache_file is not None:
+            tmp_file = cache_file + '.tmp'
+            torch.save(statistics, tmp_file)
+            os.replace(tmp_file, cache_file)
+            print(f"Dataset statistics saved to {cache_file}")
+        self._statistics = statistics
+        return statistics
 
-        counts = torch.zeros(num_classes)
+    def accumulate_statistics(self, data):
+        """ Hook called on every batch of dataset_statistics, for statistics specific to a type of dataset. """
+        pass
 
+    def collect_statistics(self):
+        """ Returns the statistics accumulated by accumulate_statistics, as a dictionary of tensors. """
+        return {}
+
+    def statistics_fingerprint(self):
+        """ Hash of the content of the three splits, or None if it cannot be computed without reading the data. """
+        md5 = hashlib.md5()
+        md5.update(type(self).__name__.encode())
         for split in ['train', 'val', 'test']:
-            for i, data in enumerate(self.dataloaders[split]):
-                counts += data.x.sum(dim=0)
+            dataset = self.dataloaders[split].dataset
+            if isinstance(dataset, Subset):
+                md5.update(np.asarray(dataset.indices, dtype=np.int64).tobytes())
+                dataset = dataset.dataset
+            graphs = getattr(dataset, 'graphs', None)
+            if isinstance(graphs, PackedGraphStore):
+                md5.update(store_fingerprint(graphs).encode())
+            elif isinstance(dataset, StreamingGraphDataset):
+                md5.update(dataset.fingerprint().encode())
+            elif isinstance(dataset, InMemoryDataset):
+                for path in dataset.processed_paths:
+                    stat = os.stat(path)
+                    md5.update(f'{os.path.realpath(path)}:{stat.st_size}:{stat.st_mtime_ns}'.encode())
+            else:
+                return None
+        return md5.hexdigest()
 
-        counts = counts / counts.sum()
-        return counts
+    def statistics_cache_file(self):
+        dataset = self.dataloaders['train'].dataset
+        if isinstance(dataset, Subset):
+            dataset = dataset.dataset
+        graphs = getattr(dataset, 'graphs', None)
+        if isinstance(graphs, PackedGraphStore):
+            cache_dir = graphs.path
+        elif isinstance(dataset, StreamingGraphDataset):
+            cache_dir = dataset.shard_dir
+        elif isinstance(dataset, InMemoryDataset):
+            cache_dir = dataset.processed_dir
+        else:
+            return None
+        fingerprint = self.statistics_fingerprint()
+        if fingerprint is None:
+            return None
+        return os.path.join(cache_dir, f'statistics_{fingerprint}.pt')
 
-    def edge_counts(self):
-        num_classes = None
-        for data in self.dataloaders['train']:
-            num_classes = data.edge_attr.shape[1]
-            break
+    def node_counts(self):
+        return self.dataset_statistics()['n_nodes']
+
+    def node_types(self):
+        return self.dataset_statistics()['node_types']
 
-        d = torch.zeros(num_classes)
+    def edge_counts(self):
+        return self.dataset_statistics()['edge_types']
 
-        for split in ['train', 'val', 'test']:
-            for i, data in enumerate(self.dataloaders[split]):
-                unique, counts = torch.unique(data.batch, return_counts=True)
 
-                all_pairs = 0
-                for count in counts:
-                    all_pairs += count * (count - 1)
+class MolecularDataModule(AbstractDataModule):
+    multiplier = torch.Tensor([0, 1, 2, 3, 1.5])    # Bond order of each edge type
 
-                num_edges = data.edge_index.shape[1]
-                num_non_edges = all_pairs - num_edges
+    def __init__(self, cfg):
+        super().__init__(cfg)
+        self._valency_counts = None
 
-                edge_types = data.edge_attr.sum(dim=0)
-                assert num_non_edges >= 0
-                d[0] += num_non_edges
-                d[1:] += edge_types[1:]
+    def accumulate_statistics(self, data):
+        batch_valencies = self.valency_histogram(data)
+        if self._valency_counts is None:
+            self._valency_counts = batch_valencies
+        else:
+            self._valency_counts = add_counts(self._valency_counts, batch_valencies)
 
-        d = d / d.sum()
-        return d
+    def collect_statistics(self):
+        valencies, self._valency_counts = self._valency_counts, None
+        return {'valencies': valencies}
 
+    def valency_histogram(self, data):
+        """ Number of atoms of each (bond order weighted) valency in a batch. """
+        bond_orders = (data.edge_attr * self.multiplier.to(data.edge_attr.device)).sum(dim=-1)
+        valencies = torch.zeros(data.x.shape[0], device=bond_orders.device)
+        valencies.index_add_(0, data.edge_index[0], bond_orders)
+        return torch.bincount(valencies.long()).float().cpu()
 
-class MolecularDataModule(AbstractDataModule):
     def valency_count(self, max_n_nodes):
         valencies = torch.zeros(3 * max_n_nodes - 2)   # Max valency possible if everything is connected
-
-        multiplier = torch.Tensor([0, 1, 2, 3, 1.5])
-
-        for split in ['train', 'val', 'test']:
-            for i, data in enumerate(self.dataloaders[split]):
-                n = data.x.shape[0]
-
-                for atom in range(n):
-                    edges = data.edge_attr[data.edge_index[0] == atom]
-                    edges_total = edges.sum(dim=0)
-                    valency = (edges_total * multiplier).sum()
-                    valencies[valency.long().item()] += 1
+        counts = self.dataset_statistics()['valencies']
+        valencies[:len(counts)] = counts[:len(valencies)]
         valencies = valencies / valencies.sum()
         return valencies
 
 
+def add_counts(a, b):
+    """ Sum of two histograms of possibly different lengths. """
+    if len(a) < len(b):
+        a, b = b, a
+    a = a.clone()
+    a[:len(b)] += b.to(a.dtype)
+    return a
+
+
 class AbstractDatasetInfos:
     def complete_infos(self, n_nodes, node_types):
         self.input_dims = None
@@ -0,0 +1,18 @@
+from torch_geometric.data import Batch
+
+import dgd.utils as utils
+
+
+class DenseCollater:
+    """ Collates graphs into a Batch and also builds its padded dense tensors, so that this work happens in the
+        DataLoader workers instead of in the training step. The Batch gets three extra attributes:
+            dense_X: bs, n_max, dx       dense_E: bs, n_max, n_max, de       node_mask: bs, n_max
+        They are already masked, see utils.dense_batch. """
+    def __call__(self, data_list):
+        batch = Batch.from_data_list(data_list)
+        dense_data, node_mask = utils.to_dense(batch.x, batch.edge_index, batch.edge_attr, batch.batch)
+        dense_data = dense_data.mask(node_mask)
+        batch.dense_X = dense_data.X
+        batch.dense_E = dense_data.E
+        batch.node_mask = node_mask
+        return batch
@@ -1,13 +1,14 @@
-from pathlib import Path
 import os
 import pandas as pd
 import numpy as np
 
 import torch
-from torch.utils.data import random_split, Dataset
+from torch.utils.data import Dataset, Subset
 import torch_geometric.utils
 
 from dgd.datasets.abstract_dataset import AbstractDataModule, AbstractDatasetInfos
+from dgd.datasets.graph_store import PackedGraphStore, is_stale, load_packed_graphs, packed_path
+from dgd.datasets.streaming import StreamingGraphDataset, split_shards, write_shards
 
 # TODO: Update
 FRAG_GRAPH_FILE = "zinc/mol_frag_graphs_250k_300_5.pt"
@@ -17,41 +18,56 @@ SMILES_FILE = "frag/valid_smiles_250k.txt"
 FRAG_INDEX_FILE = "frag/fragment_index.csv"
 FRAG_EDGE_FILE = "frag/fragment_edge_index.csv"
 SPLIT_IDX_FILE = "frag/split_idxs.npz"
+DATA_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, os.pardir, 'data')
 
 
 class FragDataset(Dataset):
+    # Increase when `preprocess` changes: packed files built with another version are regenerated
+    preprocessing_version = 1
+
     def __init__(self, data_file):
         """ This class can be used to load the comm20, sbm and planar datasets. """
-        base_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, os.pardir, 'data')
-        filename = os.path.join(base_path, data_file)
-        self.graphs = torch.load(filename)
+        filename = os.path.join(DATA_DIR, data_file)
+        self.filename = filename
+        self.graphs = load_packed_graphs(filename, preprocess=self.preprocess,
+                                         preprocessing_version=self.preprocessing_version)
         print(f'Dataset {filename} loaded from file')
 
     def __len__(self):
         return len(self.graphs)
 
-    def __getitem__(self, idx):
-        data = self.graphs[idx]
+    @staticmethod
+    def preprocess(data):
+        """ Run once when the dataset is packed: symmetrize the graph and add an edge type for "no edge". """
         n_edge_classes = data.edge_attr.shape[-1]
-        y = torch.zeros([1, 0]).float()
-        data.idx = idx
-        n_nodes  = data.num_nodes * torch.ones(1, dtype=torch.long)
-
-        # Symmetrize
-        edge_index, edge_attr = torch_geometric.utils.to_undirected(data.edge_index, data.edge_attr,  data.num_nodes)
+        # 'max' keeps edge_attr one-hot if some edges were already stored in both directions
+        edge_index, edge_attr = torch_geometric.utils.to_undirected(data.edge_index, data.edge_attr, data.num_nodes,
+                                                                    reduce='max')
         n_edges = edge_index.shape[-1]
 
-        # Add edge type for "no edge"
         new_edge_attr = torch.zeros(n_edges, n_edge_classes+1, dtype=torch.float)
         new_edge_attr[:, 1:] = edge_attr
-        data_out = torch_geometric.data.Data(x=data.x.float(), edge_index=edge_index, edge_attr=new_edge_attr,
-                                         y=y, idx=idx, n_nodes=n_nodes)
+        return torch_geometric.data.Data(x=data.x.float(), edge_index=edge_index, edge_attr=new_edge_attr)
+
+    def __getitem__(self, idx):
+        idx = int(idx)
+        data = self.graphs[idx]
+        y = torch.zeros([1, 0]).float()
+        n_nodes = data.num_nodes * torch.ones(1, dtype=torch.long)
+        data_out = torch_geometric.data.Data(x=data.x, edge_index=data.edge_index, edge_attr=data.edge_attr,
+                                             y=y, idx=idx, n_nodes=n_nodes)
         return data_out
 
 
 class AtomDataset(FragDataset):
+    # Atom graphs are stored ready to use
+    preprocessing_version = 0
+    preprocess = None
+
     def __getitem__(self, idx):
+        idx = int(idx)
         data = self.graphs[idx]
+        data.y = torch.zeros([1, 0]).float()
         data.idx = idx
 
         return data
@@ -68,28 +84,72 @@ class FragDataModule(AbstractDataModule):
         return self.inner[item]
 
     def prepare_data(self):
+        if self.cfg.dataset.get('streaming', False):
+            return self.prepare_streaming_data()
         graphs = FragDataset(self.file_name)
-        test_len = int(round(len(graphs) * 0.2))
-        train_len = int(round((len(graphs) - test_len) * 0.8))
-        val_len = len(graphs) - train_len - test_len
-        print(f'Dataset sizes: train {train_len}, val {val_len}, test {test_len}')
-        splits = random_split(
-            graphs,
-            [train_len, val_len, test_len],
-            generator=torch.Generator().manual_seed(1234)
-        )
+        split_idxs = load_split_manifest(graphs.filename, len(graphs))
+        print(f"Dataset sizes: train {len(split_idxs['train'])}, val {len(split_idxs['val'])}, "
+              f"test {len(split_idxs['test'])}")
+        datasets = {split: Subset(graphs, idxs) for split, idxs in split_idxs.items()}
+        super().prepare_data(datasets)
 
-        datasets = {'train': splits[0], 'val': splits[1], 'test': splits[2]}
-        split_idxs = {
-            '%s_idxs' % key: np.array([x.idx for x in val])
-            for key, val in datasets.items()
-        }
+    def prepare_streaming_data(self):
+        """ Reads the graphs from shards instead of loading the whole dataset. Splits are made of whole shards,
+            so they differ from the in-memory splits. """
+        shard_dir = self.cfg.dataset.get('shard_dir', None)
+        if shard_dir is None:
+            filename = os.path.join(DATA_DIR, self.file_name)
+            shard_dir = os.path.splitext(filename)[0] + f'.shards_v{FragDataset.preprocessing_version}'
+            if not os.path.exists(os.path.join(shard_dir, 'index.json')):
+                # Graphs are read one at a time from the memory mapped packed store, never from the pickled file
+                path = packed_path(filename)
+                if is_stale(path, filename, FragDataset.preprocessing_version):
+                    raise FileNotFoundError(f"Streaming needs dataset.shard_dir or an up to date packed store {path} "
+                                            f"to write the shards from. Build it once without streaming, or set "
+                                            f"dataset.shard_dir to existing shards")
+                store = PackedGraphStore(path)
+                print(f'Writing {path} to shards in {shard_dir}...')
+                write_shards((store[i] for i in range(len(store))), shard_dir,
+                             shard_size=self.cfg.dataset.get('shard_size', 10000))
+        splits = split_shards(shard_dir)
+        datasets = {split: StreamingGraphDataset(shard_dir, shards, shuffle=(split == 'train'),
+                                                 buffer_size=self.cfg.dataset.get('shuffle_buffer_size', 10000),
+                                                 transform=add_frag_fields)
+                    for split, shards in splits.items()}
+        print(f"Dataset sizes: train {len(datasets['train'])}, val {len(datasets['val'])}, "
+              f"test {len(datasets['test'])}")
+        super().prepare_data(datasets)
 
-        cwd = Path.cwd()
-        print('Saving split indices to %s' % cwd)
-        np.savez(cwd / 'split_idxs', **split_idxs)
 
-        super().prepare_data(datasets)
+def load_split_manifest(filename, num_graphs, seed=1234):
+    """ Train, val and test indices of the graphs of filename, as numpy arrays.
+        They are drawn once with the permutation that random_split used, and stored in a .splits.npz file next to
+        the dataset. The file is redrawn if the dataset size changes. """
+    path = os.path.splitext(filename)[0] + '.splits.npz'
+    if os.path.exists(path):
+        manifest = np.load(path)
+        if int(manifest['num_graphs']) == num_graphs and int(manifest['seed']) == seed:
+            return {split: manifest['%s_idxs' % split] for split in ['train', 'val', 'test']}
+
+    test_len = int(round(num_graphs * 0.2))
+    train_len = int(round((num_graphs - test_len) * 0.8))
+    val_len = num_graphs - train_len - test_len
+    perm = torch.randperm(num_graphs, generator=torch.Generator().manual_seed(seed)).numpy()
+    split_idxs = {'train': perm[:train_len], 'val': perm[train_len: train_len + val_len],
+                  'test': perm[train_len + val_len:]}
+
+    print(f'Saving split indices to {path}')
+    with open(path + '.tmp', 'wb') as f:
+        np.savez(f, num_graphs=num_graphs, seed=seed, **{'%s_idxs' % split: idxs for split, idxs in split_idxs.items()})
+    os.replace(path + '.tmp', path)
+    return split_idxs
+
+
+def add_frag_fields(data):
+    """ Fields that FragDataset.__getitem__ adds to each graph, for graphs read from shards. """
+    data.y = torch.zeros([1, 0]).float()
+    data.n_nodes = data.num_nodes * torch.ones(1, dtype=torch.long)
+    return data
 
 
 class AtomDataModule(AbstractDataModule):
@@ -104,22 +164,8 @@ class AtomDataModule(AbstractDataModule):
 
     def prepare_data(self):
         graphs = AtomDataset(self.file_name)
-
-        base_path = os.path.join(
-            os.path.dirname(os.path.realpath(__file__)),
-            os.pardir,
-            os.pardir,
-            'data'
-        )
-
-        filename = os.path.join(base_path, SPLIT_IDX_FILE)
-        split_idxs = np.load(filename)
-
-        datasets = {
-            key: [graphs[i] for i in split_idxs['%s_idxs' % key]]
-            for key in ['train', 'val', 'test']
-        }
-
+        split_idxs = np.load(os.path.join(DATA_DIR, SPLIT_IDX_FILE))
+        datasets = {key: Subset(graphs, split_idxs['%s_idxs' % key]) for key in ['train', 'val', 'test']}
         super().prepare_data(datasets)
 
 class FragDatasetInfos(AbstractDatasetInfos):
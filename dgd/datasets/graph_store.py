@@ -0,0 +1,215 @@
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+import torch_geometric.utils
+from torch_geometric.data import Data
+
+
+STORE_VERSION = 1
+STORE_SUFFIX = '.packed'
+
+_ARRAY_FILES = ['node_offsets', 'edge_offsets', 'node_labels', 'edge_index', 'edge_labels']
+
+
+class PackedGraphStore:
+    """ Read-only collection of graphs stored as concatenated columns.
+
+        The store is a directory holding one .npy file per column:
+            node_offsets: (G + 1)      start of each graph in node_labels
+            edge_offsets: (G + 1)      start of each graph in edge_index / edge_labels
+            node_labels:  (N_total)    node class of every node
+            edge_index:   (2, E_total) edges of every graph, indexed locally to their graph
+            edge_labels:  (E_total)    edge class of every edge
+        and a meta.json file with the number of node and edge classes.
+
+        Columns are opened with np.memmap, so opening a store does not read it and all DataLoader workers share
+        the same pages through the OS cache.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+        if self.meta['version'] != STORE_VERSION:
+            raise ValueError(f"Packed graph store {path} has version {self.meta['version']}, expected {STORE_VERSION}")
+        self.num_node_classes = self.meta['num_node_classes']
+        self.num_edge_classes = self.meta['num_edge_classes']
+        self._arrays = None
+
+    def __getstate__(self):
+        # Memory maps are reopened lazily in each process instead of being pickled with their content
+        state = self.__dict__.copy()
+        state['_arrays'] = None
+        return state
+
+    @property
+    def arrays(self):
+        if self._arrays is None:
+            # 'c' (copy-on-write) gives writable views so that torch.from_numpy does not need to copy
+            self._arrays = {name: np.load(os.path.join(self.path, name + '.npy'), mmap_mode='c')
+                            for name in _ARRAY_FILES}
+        return self._arrays
+
+    def __len__(self):
+        return self.meta['num_graphs']
+
+    def num_nodes(self):
+        """ Number of nodes of every graph, as a (G) numpy array. Does not read the node labels. """
+        return np.diff(self.arrays['node_offsets'])
+
+    def num_edges(self):
+        """ Number of stored (directed) edges of every graph, as a (G) numpy array. """
+        return np.diff(self.arrays['edge_offsets'])
+
+    def get_arrays(self, idx):
+        """ Returns node_labels (n), edge_index (2, m), edge_labels (m) of graph idx as zero-copy tensors. """
+        arrays = self.arrays
+        n0, n1 = arrays['node_offsets'][idx], arrays['node_offsets'][idx + 1]
+        e0, e1 = arrays['edge_offsets'][idx], arrays['edge_offsets'][idx + 1]
+        node_labels = torch.from_numpy(arrays['node_labels'][n0:n1])
+        edge_index = torch.from_numpy(arrays['edge_index'][:, e0:e1])
+        edge_labels = torch.from_numpy(arrays['edge_labels'][e0:e1])
+        return node_labels, edge_index, edge_labels
+
+    def __getitem__(self, idx):
+        """ Returns graph idx as a Data object with one-hot encoded node and edge features. """
+        node_labels, edge_index, edge_labels = self.get_arrays(idx)
+        x = F.one_hot(node_labels, num_classes=self.num_node_classes).float()
+        edge_attr = F.one_hot(edge_labels, num_classes=self.num_edge_classes).float()
+        return Data(x=x, edge_index=edge_index, edge_attr=edge_attr)
+
+    @staticmethod
+    def write(path, graphs, num_node_classes, num_edge_classes, extra_meta=None):
+        """ Pack graphs into a new store at path.
+            graphs: iterable of (node_labels (n), edge_index (2, m), edge_labels (m)) tensors or arrays.
+            The store is written to a temporary directory and moved in place at the end, so an interrupted
+            write never leaves a partial store behind.
+        """
+        node_labels, edge_index, edge_labels = [], [], []
+        node_counts, edge_counts = [0], [0]
+        for nodes, edges, labels in graphs:
+            node_labels.append(np.asarray(nodes, dtype=np.int64))
+            edge_index.append(np.asarray(edges, dtype=np.int64).reshape(2, -1))
+            edge_labels.append(np.asarray(labels, dtype=np.int64))
+            node_counts.append(len(node_labels[-1]))
+            edge_counts.append(len(edge_labels[-1]))
+
+        columns = {'node_offsets': np.cumsum(node_counts, dtype=np.int64),
+                   'edge_offsets': np.cumsum(edge_counts, dtype=np.int64),
+                   'node_labels': np.concatenate(node_labels) if node_labels else np.zeros(0, dtype=np.int64),
+                   'edge_index': np.concatenate(edge_index, axis=1) if edge_index else np.zeros((2, 0), dtype=np.int64),
+                   'edge_labels': np.concatenate(edge_labels) if edge_labels else np.zeros(0, dtype=np.int64)}
+        meta = {'version': STORE_VERSION,
+                'num_graphs': len(node_counts) - 1,
+                'num_node_classes': int(num_node_classes),
+                'num_edge_classes': int(num_edge_classes)}
+        if extra_meta is not None:
+            meta.update(extra_meta)
+
+        tmp_path = path + '.tmp'
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+        for name, array in columns.items():
+            np.save(os.path.join(tmp_path, name + '.npy'), array)
+        with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+            json.dump(meta, f, indent=2)
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.rename(tmp_path, path)
+        return PackedGraphStore(path)
+
+
+def one_hot_to_labels(features):
+    """ features: (k, d) one-hot tensor. Returns the (k) class indices. """
+    if features.shape[0] > 0 and not (features.sum(dim=-1) == 1).all():
+        raise ValueError("Only one-hot encoded features can be packed")
+    return features.argmax(dim=-1)
+
+
+def pyg_graphs_to_arrays(graphs, preprocess=None):
+    """ Converts Data objects with one-hot x and edge_attr to the columns expected by the store.
+        preprocess: optional function applied to each Data object before packing. """
+    for data in graphs:
+        if preprocess is not None:
+            data = preprocess(data)
+        yield one_hot_to_labels(data.x), data.edge_index, one_hot_to_labels(data.edge_attr)
+
+
+def adjacencies_to_arrays(adjs):
+    """ Converts dense adjacency matrices to single-type graphs. Edge class 0 is reserved for "no edge". """
+    for adj in adjs:
+        edge_index, _ = torch_geometric.utils.dense_to_sparse(adj)
+        yield torch.zeros(adj.shape[-1], dtype=torch.long), edge_index, torch.ones(edge_index.shape[-1],
+                                                                                  dtype=torch.long)
+
+
+def packed_path(filename):
+    return os.path.splitext(filename)[0] + STORE_SUFFIX
+
+
+def file_fingerprint(filename, chunk_size=1 << 24):
+    """ md5 of a file, read by chunks so that large datasets do not need to fit in memory. """
+    md5 = hashlib.md5()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            md5.update(chunk)
+    stat = os.stat(filename)
+    return {'md5': md5.hexdigest(), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def store_fingerprint(store, chunk_size=1 << 24):
+    """ md5 identifying the content of a store. Uses the fingerprint of the source file when the store has one,
+        otherwise hashes the columns. """
+    md5 = hashlib.md5()
+    md5.update(json.dumps(store.meta, sort_keys=True).encode())
+    if 'source' not in store.meta:
+        for name in _ARRAY_FILES:
+            with open(os.path.join(store.path, name + '.npy'), 'rb') as f:
+                for chunk in iter(lambda: f.read(chunk_size), b''):
+                    md5.update(chunk)
+    return md5.hexdigest()
+
+
+def is_stale(path, source_file, preprocessing_version=0):
+    """ Checks whether the store at path was built from the current source_file with the current preprocessing.
+        The source is only hashed when its size or modification time changed since the store was written. """
+    if not os.path.exists(os.path.join(path, 'meta.json')):
+        return True
+    with open(os.path.join(path, 'meta.json'), 'r') as f:
+        meta = json.load(f)
+    if meta.get('version') != STORE_VERSION or meta.get('preprocessing_version', 0) != preprocessing_version:
+        return True
+    if not os.path.exists(source_file):
+        # Only the packed file was shipped: nothing to compare against
+        return False
+    source = meta.get('source')
+    if source is None:
+        return True
+    stat = os.stat(source_file)
+    if stat.st_size == source['size'] and stat.st_mtime_ns == source['mtime_ns']:
+        return False
+    return file_fingerprint(source_file)['md5'] != source['md5']
+
+
+def load_packed_graphs(filename, preprocess=None, preprocessing_version=0):
+    """ Opens the packed version of a file of pickled Data objects, creating it on first use.
+        preprocess: optional function applied once to every graph when packing, instead of at every access.
+        preprocessing_version: bump it when preprocess changes so that existing packed files are rebuilt.
+    """
+    path = packed_path(filename)
+    if is_stale(path, filename, preprocessing_version):
+        print(f'Packing {filename} into {path}...')
+        graphs = torch.load(filename)
+        example = graphs[0] if preprocess is None else preprocess(graphs[0])
+        extra_meta = {'preprocessing_version': preprocessing_version, 'source': file_fingerprint(filename)}
+        PackedGraphStore.write(path, pyg_graphs_to_arrays(graphs, preprocess),
+                               num_node_classes=example.x.shape[-1],
+                               num_edge_classes=example.edge_attr.shape[-1],
+                               extra_meta=extra_meta)
+        del graphs
+    return PackedGraphStore(path)
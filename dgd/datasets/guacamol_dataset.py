@@ -1,21 +1,22 @@
-from rdkit import Chem, RDLogger
-from rdkit.Chem.rdchem import BondType as BT
+from rdkit import RDLogger
 
 import os
 import os.path as osp
 import pathlib
+import shutil
 import hashlib
+from functools import partial
 from typing import Any, Sequence
 
 import torch
-import torch.nn.functional as F
 from tqdm import tqdm
 import numpy as np
-from torch_geometric.data import Data, InMemoryDataset, download_url
+from torch_geometric.data import InMemoryDataset, download_url
 
 from dgd import utils
-from dgd.analysis.rdkit_functions import mol2smiles, build_molecule_with_partial_charges, compute_molecular_metrics
+from dgd.analysis.rdkit_functions import compute_molecular_metrics
 from dgd.datasets.abstract_dataset import AbstractDatasetInfos, MolecularDataModule
+from dgd.datasets.sharded_processing import smiles_to_graph, process_in_shards, load_shards, roundtrip_smiles
 
 
 TRAIN_HASH = '05ad85d871958a05c02ab51a4fde8530'
@@ -54,8 +55,10 @@ class GuacamolDataset(InMemoryDataset):
     valid_url = 'https://figshare.com/ndownloader/files/13612766'
     all_url = 'https://figshare.com/ndownloader/files/13612745'
 
-    def __init__(self, stage, root, filtered: bool, transform=None, pre_transform=None, pre_filter=None):
+    def __init__(self, stage, root, filtered: bool, transform=None, pre_transform=None, pre_filter=None,
+                 num_workers=None):
         self.stage = stage
+        self.num_workers = num_workers      # Processes used by process(), None for one per cpu
         self.filtered = filtered
         if self.stage == 'train':
             self.file_idx = 0
@@ -136,74 +139,15 @@ class GuacamolDataset(InMemoryDataset):
 
         RDLogger.DisableLog('rdApp.*')
         types = {'C': 0, 'N': 1, 'O': 2, 'F': 3, 'B': 4, 'Br': 5, 'Cl': 6, 'I': 7, 'P': 8, 'S': 9, 'Se': 10, 'Si': 11}
-        bonds = {BT.SINGLE: 0, BT.DOUBLE: 1, BT.TRIPLE: 2, BT.AROMATIC: 3}
 
         smile_list = open(self.split_paths[self.file_idx]).readlines()
 
-        data_list = []
-        smiles_kept = []
-        for i, smile in enumerate(tqdm(smile_list)):
-            mol = Chem.MolFromSmiles(smile)
-            N = mol.GetNumAtoms()
-
-            type_idx = []
-            for atom in mol.GetAtoms():
-                type_idx.append(types[atom.GetSymbol()])
-
-            row, col, edge_type = [], [], []
-            for bond in mol.GetBonds():
-                start, end = bond.GetBeginAtomIdx(), bond.GetEndAtomIdx()
-                row += [start, end]
-                col += [end, start]
-                edge_type += 2 * [bonds[bond.GetBondType()] + 1]
-
-            if len(row) == 0:
-                continue
-
-            edge_index = torch.tensor([row, col], dtype=torch.long)
-            edge_type = torch.tensor(edge_type, dtype=torch.long)
-            edge_attr = F.one_hot(edge_type, num_classes=len(bonds) + 1).to(torch.float)
-
-            perm = (edge_index[0] * N + edge_index[1]).argsort()
-            edge_index = edge_index[:, perm]
-            edge_attr = edge_attr[perm]
-
-            x = F.one_hot(torch.tensor(type_idx), num_classes=len(types)).float()
-            y = torch.zeros(size=(1, 0), dtype=torch.float)
-
-            data = Data(x=x, edge_index=edge_index, edge_attr=edge_attr, y=y, idx=i)
-
-            if not preprocess:
-                if self.pre_filter is not None and not self.pre_filter(data):
-                    continue
-                if self.pre_transform is not None:
-                    data = self.pre_transform(data)
-                data_list.append(data)
-                continue
-            else:
-                # Try to build the molecule again from the graph. If it fails, do not add it to the training set
-                dense_data, node_mask = utils.to_dense(data.x, data.edge_index, data.edge_attr, data.batch)
-                dense_data = dense_data.mask(node_mask, collapse=True)
-                X, E = dense_data.X, dense_data.E
-
-                assert X.size(0) == 1
-                atom_types = X[0]
-                edge_types = E[0]
-                atom_decoder = ['C', 'N', 'O', 'F', 'B', 'Br', 'Cl', 'I', 'P', 'S', 'Se', 'Si']
-                mol = build_molecule_with_partial_charges(atom_types, edge_types, atom_decoder)
-                smiles = mol2smiles(mol)
-                if smiles is not None:
-                    try:
-                        mol_frags = Chem.rdmolops.GetMolFrags(mol, asMols=True, sanitizeFrags=True)
-                        largest_mol = max(mol_frags, default=mol, key=lambda m: m.GetNumAtoms())
-                        smiles = mol2smiles(largest_mol)
-                        smiles_kept.append(smiles)
-                    except Chem.rdchem.AtomValenceException:
-                        print("Valence error in GetmolFrags")
-                    except Chem.rdchem.KekulizeException:
-                        print("Can't kekulize molecule")
+        shard_dir = osp.join(self.processed_dir, osp.splitext(self.processed_file_names[self.file_idx])[0] + '_shards')
+        shards = process_in_shards(partial(smiles_to_graph, types=types), list(enumerate(smile_list)), shard_dir,
+                                   num_workers=self.num_workers)
 
         if preprocess:
+            smiles_kept = roundtrip_smiles(load_shards(shards), Guacamolinfos.atom_decoder)
             smiles_save_path = osp.join(pathlib.Path(self.raw_paths[0]).parent, 'new_test.smiles')
             print(smiles_save_path)
             with open(smiles_save_path, 'w') as f:
@@ -211,7 +155,9 @@ class GuacamolDataset(InMemoryDataset):
             print(f"Number of molecules kept: {len(smiles_kept)} / {len(smile_list)}")
             assert False, "This assert avoids overwriting train smiles with val or test"
         else:
+            data_list = load_shards(shards, self.pre_filter, self.pre_transform)
             torch.save(self.collate(data_list), self.processed_paths[self.file_idx])
+            shutil.rmtree(shard_dir)
 
 
 class GuacamolDataModule(MolecularDataModule):
@@ -289,7 +235,7 @@ class Guacamolinfos(AbstractDatasetInfos):
             print("Distribution of edge types", self.edge_types)
             np.savetxt('edge_types.txt', self.edge_types.numpy())
 
-            valencies = datamodule.valency_count()
+            valencies = datamodule.valency_count(self.max_n_nodes)
             print("Distribution of the valencies", valencies)
             np.savetxt('valencies.txt', valencies.numpy())
             self.valency_distribution = valencies
@@ -1,23 +1,24 @@
-from rdkit import Chem, RDLogger
-from rdkit.Chem.rdchem import BondType as BT
+from rdkit import RDLogger
 import mini_moses as moses
 
 import os
 import os.path as osp
 import pathlib
 import pathlib
+import shutil
 import hashlib
+from functools import partial
 from typing import Any, Sequence
 
 import torch
-import torch.nn.functional as F
 from tqdm import tqdm
 import numpy as np
-from torch_geometric.data import Data, InMemoryDataset
+from torch_geometric.data import InMemoryDataset
 
 from dgd import utils
-from dgd.analysis.rdkit_functions import mol2smiles, build_molecule_with_partial_charges, compute_molecular_metrics
+from dgd.analysis.rdkit_functions import compute_molecular_metrics
 from dgd.datasets.abstract_dataset import AbstractDatasetInfos, MolecularDataModule
+from dgd.datasets.sharded_processing import smiles_to_graph, process_in_shards, load_shards, roundtrip_smiles
 
 
 def to_list(value: Any) -> Sequence:
@@ -31,8 +32,10 @@ atom_decoder = ['C', 'N', 'S', 'O', 'F', 'Cl', 'Br', 'H']
 
 
 class MOSESDataset(InMemoryDataset):
-    def __init__(self, stage, root, transform=None, pre_transform=None, pre_filter=None, preprocess=False):
+    def __init__(self, stage, root, transform=None, pre_transform=None, pre_filter=None, preprocess=False,
+                 num_workers=None):
         self.stage = stage
+        self.num_workers = num_workers      # Processes used by process(), None for one per cpu
         self.atom_decoder = atom_decoder
         if self.stage == 'train':
             self.file_idx = 0
@@ -73,8 +76,6 @@ class MOSESDataset(InMemoryDataset):
         RDLogger.DisableLog('rdApp.*')
         types = {atom: i for i, atom in enumerate(self.atom_decoder)}
 
-        bonds = {BT.SINGLE: 0, BT.DOUBLE: 1, BT.TRIPLE: 2, BT.AROMATIC: 3}
-
         if self.stage == 'train':
             smile_list = moses.get_dataset('train')            # thank you moses authors for such an easy API
         elif self.stage == 'val':
@@ -82,70 +83,12 @@ class MOSESDataset(InMemoryDataset):
         else:
             smile_list = moses.get_dataset('test_scaffolds')
 
-
-        data_list = []
-        smiles_kept = []
-        for i, smile in enumerate(tqdm(smile_list)):
-            mol = Chem.MolFromSmiles(smile)
-            N = mol.GetNumAtoms()
-
-            type_idx = []
-            for atom in mol.GetAtoms():
-                type_idx.append(types[atom.GetSymbol()])
-
-            row, col, edge_type = [], [], []
-            for bond in mol.GetBonds():
-                start, end = bond.GetBeginAtomIdx(), bond.GetEndAtomIdx()
-                row += [start, end]
-                col += [end, start]
-                edge_type += 2 * [bonds[bond.GetBondType()] + 1]
-
-            if len(row) == 0:
-                continue
-
-            edge_index = torch.tensor([row, col], dtype=torch.long)
-            edge_type = torch.tensor(edge_type, dtype=torch.long)
-            edge_attr = F.one_hot(edge_type, num_classes=len(bonds) + 1).to(torch.float)
-
-            perm = (edge_index[0] * N + edge_index[1]).argsort()
-            edge_index = edge_index[:, perm]
-            edge_attr = edge_attr[perm]
-
-            x = F.one_hot(torch.tensor(type_idx), num_classes=len(types)).float()
-            y = torch.zeros(size=(1, 0), dtype=torch.float)
-
-            data = Data(x=x, edge_index=edge_index, edge_attr=edge_attr, y=y, idx=i)
-
-            if not preprocess:
-                if self.pre_filter is not None and not self.pre_filter(data):
-                    continue
-                if self.pre_transform is not None:
-                    data = self.pre_transform(data)
-                data_list.append(data)
-                continue
-            else:
-                # Try to build the molecule again from the graph. If it fails, do not add it to the training set
-                dense_data, node_mask = utils.to_dense(data.x, data.edge_index, data.edge_attr, data.batch)
-                dense_data = dense_data.mask(node_mask, collapse=True)
-                X, E = dense_data.X, dense_data.E
-
-                assert X.size(0) == 1
-                atom_types = X[0]
-                edge_types = E[0]
-                mol = build_molecule_with_partial_charges(atom_types, edge_types, self.atom_decoder)
-                smiles = mol2smiles(mol)
-                if smiles is not None:
-                    try:
-                        mol_frags = Chem.rdmolops.GetMolFrags(mol, asMols=True, sanitizeFrags=True)
-                        largest_mol = max(mol_frags, default=mol, key=lambda m: m.GetNumAtoms())
-                        smiles = mol2smiles(largest_mol)
-                        smiles_kept.append(smiles)
-                    except Chem.rdchem.AtomValenceException:
-                        print("Valence error in GetmolFrags")
-                    except Chem.rdchem.KekulizeException:
-                        print("Can't kekulize molecule")
+        shard_dir = osp.join(self.processed_dir, osp.splitext(self.processed_file_names[self.file_idx])[0] + '_shards')
+        shards = process_in_shards(partial(smiles_to_graph, types=types), list(enumerate(smile_list)), shard_dir,
+                                   num_workers=self.num_workers)
 
         if preprocess:
+            smiles_kept = roundtrip_smiles(load_shards(shards), self.atom_decoder)
             smiles_save_path = osp.join(pathlib.Path(self.raw_paths[0]).parent, 'new_test.smiles')
             print(smiles_save_path)
             with open(smiles_save_path, 'w') as f:
@@ -153,7 +96,9 @@ class MOSESDataset(InMemoryDataset):
             print(f"Number of molecules kept: {len(smiles_kept)} / {len(smile_list)}")
             assert False, "This assert avoids overwriting train smiles with val or test"
         else:
+            data_list = load_shards(shards, self.pre_filter, self.pre_transform)
             torch.save(self.collate(data_list), self.processed_paths[self.file_idx])
+            shutil.rmtree(shard_dir)
 
 
 class MOSESDataModule(MolecularDataModule):
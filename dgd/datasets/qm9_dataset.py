@@ -1,22 +1,21 @@
 import os
 import os.path as osp
 import pathlib
+import shutil
+from functools import partial
 from typing import Any, Sequence
 
 import torch
-import torch.nn.functional as F
 from rdkit import Chem, RDLogger
-from rdkit.Chem.rdchem import BondType as BT
-from tqdm import tqdm
 import numpy as np
 import pandas as pd
-from torch_geometric.data import Data, InMemoryDataset, download_url, extract_zip
-from torch_geometric.utils import subgraph
+from torch_geometric.data import InMemoryDataset, download_url, extract_zip
 
 import dgd.utils as utils
 from dgd.datasets.abstract_dataset import MolecularDataModule, AbstractDatasetInfos
 from dgd.analysis.rdkit_functions import  mol2smiles, build_molecule_with_partial_charges
 from dgd.analysis.rdkit_functions import compute_molecular_metrics
+from dgd.datasets.sharded_processing import sdf_to_graph, process_in_shards, load_shards
 
 
 def files_exist(files) -> bool:
@@ -38,8 +37,10 @@ class QM9Dataset(InMemoryDataset):
     raw_url2 = 'https://ndownloader.figshare.com/files/3195404'
     processed_url = 'https://data.pyg.org/datasets/qm9_v3.zip'
 
-    def __init__(self, stage, root, remove_h: bool, transform=None, pre_transform=None, pre_filter=None):
+    def __init__(self, stage, root, remove_h: bool, transform=None, pre_transform=None, pre_filter=None,
+                 num_workers=None):
         self.stage = stage
+        self.num_workers = num_workers      # Processes used by process(), None for one per cpu
         if self.stage == 'train':
             self.file_idx = 0
         elif self.stage == 'val':
@@ -111,64 +112,24 @@ class QM9Dataset(InMemoryDataset):
         RDLogger.DisableLog('rdApp.*')
 
         types = {'H': 0, 'C': 1, 'N': 2, 'O': 3, 'F': 4}
-        bonds = {BT.SINGLE: 0, BT.DOUBLE: 1, BT.TRIPLE: 2, BT.AROMATIC: 3}
 
         target_df = pd.read_csv(self.split_paths[self.file_idx], index_col=0)
         target_df.drop(columns=['mol_id'], inplace=True)
 
         with open(self.raw_paths[-1], 'r') as f:
-            skip = [int(x.split()[0]) - 1 for x in f.read().split('\n')[9:-2]]
+            skip = set(int(x.split()[0]) - 1 for x in f.read().split('\n')[9:-2])
 
-        suppl = Chem.SDMolSupplier(self.raw_paths[0], removeHs=False, sanitize=False)
+        num_mols = len(Chem.SDMolSupplier(self.raw_paths[0], removeHs=False, sanitize=False))
+        items = [int(i) for i in sorted(target_df.index) if i not in skip and i < num_mols]
 
-        data_list = []
-        for i, mol in enumerate(tqdm(suppl)):
-            if i in skip or i not in target_df.index:
-                continue
-
-            N = mol.GetNumAtoms()
-
-            type_idx = []
-            for atom in mol.GetAtoms():
-                type_idx.append(types[atom.GetSymbol()])
-
-            row, col, edge_type = [], [], []
-            for bond in mol.GetBonds():
-                start, end = bond.GetBeginAtomIdx(), bond.GetEndAtomIdx()
-                row += [start, end]
-                col += [end, start]
-                edge_type += 2 * [bonds[bond.GetBondType()] + 1]
-
-            edge_index = torch.tensor([row, col], dtype=torch.long)
-            edge_type = torch.tensor(edge_type, dtype=torch.long)
-            edge_attr = F.one_hot(edge_type, num_classes=len(bonds)+1).to(torch.float)
-
-            perm = (edge_index[0] * N + edge_index[1]).argsort()
-            edge_index = edge_index[:, perm]
-            edge_attr = edge_attr[perm]
-
-            x = F.one_hot(torch.tensor(type_idx), num_classes=len(types)).float()
-            y = torch.zeros((1, 0), dtype=torch.float)
-
-            if self.remove_h:
-                type_idx = torch.Tensor(type_idx).long()
-                to_keep = type_idx > 0
-                edge_index, edge_attr = subgraph(to_keep, edge_index, edge_attr, relabel_nodes=True,
-                                                 num_nodes=len(to_keep))
-                x = x[to_keep]
-                # Shift onehot encoding to match atom decoder
-                x = x[:, 1:]
-
-            data = Data(x=x, edge_index=edge_index, edge_attr=edge_attr, y=y, idx=i)
-
-            if self.pre_filter is not None and not self.pre_filter(data):
-                continue
-            if self.pre_transform is not None:
-                data = self.pre_transform(data)
-
-            data_list.append(data)
+        convert = partial(sdf_to_graph, sdf_path=self.raw_paths[0], types=types, remove_h=self.remove_h)
+        shard_dir = osp.join(self.processed_dir, osp.splitext(self.processed_file_names[self.file_idx])[0] + '_shards')
+        shards = process_in_shards(convert, items, shard_dir, num_workers=self.num_workers,
+                                   source_files=[self.raw_paths[0]])
+        data_list = load_shards(shards, self.pre_filter, self.pre_transform)
 
         torch.save(self.collate(data_list), self.processed_paths[self.file_idx])
+        shutil.rmtree(shard_dir)
 
 
 class QM9DataModule(MolecularDataModule):
@@ -0,0 +1,143 @@
+import math
+from abc import ABC, abstractmethod
+
+import numpy as np
+from torch.utils.data import Sampler, Subset
+
+
+def dataset_num_nodes(dataset):
+    """ Returns the number of nodes of every graph in the dataset as a numpy array. Packed stores and
+        InMemoryDatasets answer from their offsets, other datasets are iterated once. """
+    if isinstance(dataset, Subset):
+        return dataset_num_nodes(dataset.dataset)[np.asarray(dataset.indices)]
+    graphs = getattr(dataset, 'graphs', None)
+    if graphs is not None and hasattr(graphs, 'num_nodes'):
+        return graphs.num_nodes()
+    slices = getattr(dataset, 'slices', None)
+    if slices is not None and 'x' in slices:
+        counts = (slices['x'][1:] - slices['x'][:-1]).numpy()
+        return counts[np.asarray(dataset.indices())]
+    return np.array([data.num_nodes for data in dataset])
+
+
+def padding_efficiency(num_nodes, batches):
+    """ Real node pairs divided by the node pairs of the padded dense batches, i.e. sum n_i^2 / sum bs * n_max^2. """
+    real, padded = 0, 0
+    for batch in batches:
+        sizes = num_nodes[batch].astype(np.int64)
+        real += int((sizes ** 2).sum())
+        padded += len(batch) * int(sizes.max()) ** 2
+    return real / max(padded, 1)
+
+
+def random_batches(num_items, batch_size, rng):
+    """ Batches of a plain shuffled DataLoader, used as a reference for padding efficiency. """
+    order = rng.permutation(num_items)
+    return [order[i: i + batch_size] for i in range(0, num_items, batch_size)]
+
+
+class GraphBatchSampler(Sampler, ABC):
+    """ Base class for batch samplers that build batches from the number of nodes of each graph. """
+    def __init__(self, num_nodes, shuffle: bool = True, seed: int = 0):
+        self.num_nodes = np.asarray(num_nodes)
+        self.shuffle = shuffle
+        self.rng = np.random.default_rng(seed)
+
+    @abstractmethod
+    def batches(self, rng=None):
+        """ Returns the batches of one epoch as a list of index arrays. """
+
+    def __iter__(self):
+        for batch in self.batches():
+            yield batch.tolist()
+
+    def padding_efficiency(self, reference_batch_size, seed=0):
+        """ Returns the padding efficiency of one epoch with this sampler and with random batches. """
+        rng = np.random.default_rng(seed)
+        efficiency = padding_efficiency(self.num_nodes, self.batches(rng))
+        reference = padding_efficiency(self.num_nodes, random_batches(len(self.num_nodes), reference_batch_size, rng))
+        return efficiency, reference
+
+    def sorted_buckets(self, rng, bucket_size):
+        """ Shuffles the dataset, cuts it into buckets of bucket_size graphs and sorts each bucket by size. """
+        num_items = len(self.num_nodes)
+        order = rng.permutation(num_items) if self.shuffle else np.arange(num_items)
+        for start in range(0, num_items, bucket_size):
+            bucket = order[start: start + bucket_size]
+            yield bucket[np.argsort(self.num_nodes[bucket], kind='stable')]
+
+    def shuffled(self, batches, rng):
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        return batches
+
+
+class BucketBatchSampler(GraphBatchSampler):
+    """ Batch sampler that groups graphs of similar sizes to reduce padding in utils.to_dense.
+
+        Every epoch, the dataset is shuffled and cut into buckets of bucket_size_multiplier * batch_size graphs.
+        Each bucket is sorted by number of nodes and split into batches, then the order of all batches is
+        shuffled. Batches are therefore drawn from the whole dataset but contain graphs of similar sizes.
+    """
+    def __init__(self, num_nodes, batch_size: int, bucket_size_multiplier: int = 50, shuffle: bool = True,
+                 seed: int = 0):
+        super().__init__(num_nodes, shuffle, seed)
+        self.batch_size = batch_size
+        self.bucket_size = batch_size * bucket_size_multiplier
+
+    def batches(self, rng=None):
+        rng = self.rng if rng is None else rng
+        batches = []
+        for bucket in self.sorted_buckets(rng, self.bucket_size):
+            batches.extend(bucket[i: i + self.batch_size] for i in range(0, len(bucket), self.batch_size))
+        return self.shuffled(batches, rng)
+
+    def __len__(self):
+        num_items = len(self.num_nodes)
+        return sum(math.ceil(min(self.bucket_size, num_items - start) / self.batch_size)
+                   for start in range(0, num_items, self.bucket_size))
+
+
+class TokenBudgetBatchSampler(GraphBatchSampler):
+    """ Batch sampler with a fixed budget of dense edge slots instead of a fixed number of graphs.
+
+        Graphs are bucketed and sorted by size as in BucketBatchSampler, then each batch is filled while
+        bs * n_max^2 <= max_edge_slots. Batches of small graphs therefore contain more graphs. A graph that
+        exceeds the budget on its own forms a batch of size one.
+        The number of batches depends on the shuffle, so the batches of the next epoch are drawn in advance
+        to make __len__ exact.
+    """
+    def __init__(self, num_nodes, max_edge_slots: int, bucket_size: int, shuffle: bool = True, seed: int = 0):
+        super().__init__(num_nodes, shuffle, seed)
+        self.max_edge_slots = max_edge_slots
+        self.bucket_size = bucket_size
+        self._next_epoch = None
+
+    def batches(self, rng=None):
+        rng = self.rng if rng is None else rng
+        batches = []
+        for bucket in self.sorted_buckets(rng, self.bucket_size):
+            start, n_max = 0, 0
+            for i, n in enumerate(self.num_nodes[bucket]):
+                n_max_with_i = max(n_max, int(n))
+                if i > start and (i - start + 1) * n_max_with_i ** 2 > self.max_edge_slots:
+                    batches.append(bucket[start: i])
+                    start, n_max_with_i = i, int(n)
+                n_max = n_max_with_i
+            if start < len(bucket):
+                batches.append(bucket[start:])
+        return self.shuffled(batches, rng)
+
+    def _upcoming_batches(self):
+        if self._next_epoch is None:
+            self._next_epoch = self.batches()
+        return self._next_epoch
+
+    def __iter__(self):
+        batches = self._upcoming_batches()
+        self._next_epoch = None
+        for batch in batches:
+            yield batch.tolist()
+
+    def __len__(self):
+        return len(self._upcoming_batches())
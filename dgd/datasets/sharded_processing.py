@@ -0,0 +1,203 @@
+import hashlib
+import json
+import os
+import pickle
+import shutil
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import torch
+import torch.nn.functional as F
+from rdkit import Chem, RDLogger
+from rdkit.Chem.rdchem import BondType as BT
+from torch_geometric.data import Data
+from torch_geometric.utils import subgraph
+from tqdm import tqdm
+
+from dgd import utils
+from dgd.analysis.rdkit_functions import mol2smiles, build_molecule_with_partial_charges
+from dgd.datasets.streaming import shard_path
+
+
+DEFAULT_SHARD_SIZE = 10000
+BONDS = {BT.SINGLE: 0, BT.DOUBLE: 1, BT.TRIPLE: 2, BT.AROMATIC: 3}
+
+# One SDMolSupplier per worker process and file, opened on first use
+_SUPPLIERS = {}
+
+
+def mol_to_graph(mol, types, idx, remove_h=False):
+    """ Converts an RDKit molecule to a Data object with one-hot atom and bond types. """
+    N = mol.GetNumAtoms()
+
+    type_idx = []
+    for atom in mol.GetAtoms():
+        type_idx.append(types[atom.GetSymbol()])
+
+    row, col, edge_type = [], [], []
+    for bond in mol.GetBonds():
+        start, end = bond.GetBeginAtomIdx(), bond.GetEndAtomIdx()
+        row += [start, end]
+        col += [end, start]
+        edge_type += 2 * [BONDS[bond.GetBondType()] + 1]
+
+    edge_index = torch.tensor([row, col], dtype=torch.long).view(2, -1)
+    edge_type = torch.tensor(edge_type, dtype=torch.long)
+    edge_attr = F.one_hot(edge_type, num_classes=len(BONDS) + 1).to(torch.float)
+
+    perm = (edge_index[0] * N + edge_index[1]).argsort()
+    edge_index = edge_index[:, perm]
+    edge_attr = edge_attr[perm]
+
+    x = F.one_hot(torch.tensor(type_idx), num_classes=len(types)).float()
+    y = torch.zeros(size=(1, 0), dtype=torch.float)
+
+    if remove_h:
+        type_idx = torch.Tensor(type_idx).long()
+        to_keep = type_idx > 0
+        edge_index, edge_attr = subgraph(to_keep, edge_index, edge_attr, relabel_nodes=True,
+                                         num_nodes=len(to_keep))
+        x = x[to_keep]
+        # Shift onehot encoding to match atom decoder
+        x = x[:, 1:]
+
+    return Data(x=x, edge_index=edge_index, edge_attr=edge_attr, y=y, idx=idx)
+
+
+def smiles_to_graph(item, types):
+    """ item: (idx, smiles). Molecules that cannot be parsed or have no bond are dropped. """
+    idx, smile = item
+    mol = Chem.MolFromSmiles(smile)
+    if mol is None or mol.GetNumBonds() == 0:
+        return None
+    return mol_to_graph(mol, types, idx)
+
+
+def sdf_to_graph(idx, sdf_path, types, remove_h):
+    """ Reads molecule idx of an sdf file with random access. """
+    if sdf_path not in _SUPPLIERS:
+        _SUPPLIERS[sdf_path] = Chem.SDMolSupplier(sdf_path, removeHs=False, sanitize=False)
+    mol = _SUPPLIERS[sdf_path][idx]
+    return mol_to_graph(mol, types, idx, remove_h=remove_h)
+
+
+def _process_shard(convert, items, path):
+    RDLogger.DisableLog('rdApp.*')
+    data_list = [data for data in map(convert, items) if data is not None]
+    # Written under a temporary name first, so that a shard on disk is always complete
+    torch.save(data_list, path + '.tmp')
+    os.replace(path + '.tmp', path)
+    return len(data_list), os.path.getsize(path)
+
+
+def inputs_fingerprint(convert, items, source_files=()):
+    """ md5 of what the shards are computed from: the convert function and its arguments, the items, and the size
+        and modification time of the source files that convert reads. """
+    md5 = hashlib.md5()
+    func = getattr(convert, 'func', convert)
+    md5.update(f'{func.__module__}.{func.__qualname__}'.encode())
+    md5.update(repr(sorted(getattr(convert, 'keywords', {}).items())).encode())
+    md5.update(pickle.dumps(list(items)))
+    for filename in source_files:
+        stat = os.stat(filename)
+        md5.update(f'{filename}:{stat.st_size}:{stat.st_mtime_ns}'.encode())
+    return md5.hexdigest()
+
+
+def process_in_shards(convert, items, shard_dir, shard_size=DEFAULT_SHARD_SIZE, num_workers=None, source_files=()):
+    """ Converts items to Data objects with a pool of processes, shard_size items at a time.
+
+        convert: picklable function item -> Data or None, e.g. a functools.partial of a module-level function.
+        source_files: files read by convert besides the items, e.g. the sdf file items index into.
+        Each shard is saved to shard_dir as soon as it is done, and shards already on disk are not recomputed,
+        so an interrupted run restarts where it stopped. manifest.json holds the fingerprint of the inputs, see
+        inputs_fingerprint: shards built from other inputs are removed. index.json lists the shards, their number of
+        graphs and their size in bytes, and a shard is only reused if its size matches the index.
+        Returns the list of shard files. The shards are only needed until the caller has saved the processed dataset,
+        it should then remove shard_dir.
+    """
+    num_shards = (len(items) + shard_size - 1) // shard_size
+    manifest = {'num_items': len(items), 'shard_size': shard_size, 'num_shards': num_shards,
+                'fingerprint': inputs_fingerprint(convert, items, source_files)}
+    manifest_path = os.path.join(shard_dir, 'manifest.json')
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r') as f:
+            if json.load(f) != manifest:
+                print(f"Shards in {shard_dir} were built from other inputs, removing them")
+                shutil.rmtree(shard_dir)
+    os.makedirs(shard_dir, exist_ok=True)
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f)
+
+    paths = [shard_path(shard_dir, k) for k in range(num_shards)]
+    index_path = os.path.join(shard_dir, 'index.json')
+    num_graphs, num_bytes = [None] * num_shards, [None] * num_shards
+    if os.path.exists(index_path):
+        with open(index_path, 'r') as f:
+            index = json.load(f)
+        num_graphs, num_bytes = index['num_graphs'], index.get('num_bytes', num_bytes)
+    # A shard is reused if the index recorded it and its size did not change since
+    todo = []
+    for k in range(num_shards):
+        if num_graphs[k] is None or not os.path.exists(paths[k]) or os.path.getsize(paths[k]) != num_bytes[k]:
+            num_graphs[k], num_bytes[k] = None, None
+            todo.append(k)
+    if len(todo) < num_shards:
+        print(f"Resuming: {num_shards - len(todo)}/{num_shards} shards already processed")
+
+    def write_index():
+        index = {'shards': [os.path.basename(path) for path in paths], 'num_graphs': num_graphs,
+                 'num_bytes': num_bytes}
+        with open(index_path + '.tmp', 'w') as f:
+            json.dump(index, f)
+        os.replace(index_path + '.tmp', index_path)
+
+    if len(todo) > 0:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            futures = {executor.submit(_process_shard, convert, items[k * shard_size: (k + 1) * shard_size],
+                                       paths[k]): k for k in todo}
+            for future in tqdm(as_completed(futures), total=len(futures), desc='Shards'):
+                k = futures[future]
+                num_graphs[k], num_bytes[k] = future.result()
+                write_index()
+    write_index()
+    return paths
+
+
+def load_shards(paths, pre_filter=None, pre_transform=None):
+    """ Concatenates shards in order, applying the dataset pre_filter and pre_transform. """
+    data_list = []
+    for path in paths:
+        for data in torch.load(path):
+            if pre_filter is not None and not pre_filter(data):
+                continue
+            if pre_transform is not None:
+                data = pre_transform(data)
+            data_list.append(data)
+    return data_list
+
+
+def roundtrip_smiles(data_list, atom_decoder):
+    """ Rebuilds each molecule from its graph and returns the smiles of the ones that can be sanitized. """
+    smiles_kept = []
+    for data in tqdm(data_list):
+        # Try to build the molecule again from the graph. If it fails, do not add it to the training set
+        dense_data, node_mask = utils.to_dense(data.x, data.edge_index, data.edge_attr, data.batch)
+        dense_data = dense_data.mask(node_mask, collapse=True)
+        X, E = dense_data.X, dense_data.E
+
+        assert X.size(0) == 1
+        atom_types = X[0]
+        edge_types = E[0]
+        mol = build_molecule_with_partial_charges(atom_types, edge_types, atom_decoder)
+        smiles = mol2smiles(mol)
+        if smiles is not None:
+            try:
+                mol_frags = Chem.rdmolops.GetMolFrags(mol, asMols=True, sanitizeFrags=True)
+                largest_mol = max(mol_frags, default=mol, key=lambda m: m.GetNumAtoms())
+                smiles = mol2smiles(largest_mol)
+                smiles_kept.append(smiles)
+            except Chem.rdchem.AtomValenceException:
+                print("Valence error in GetmolFrags")
+            except Chem.rdchem.KekulizeException:
+                print("Can't kekulize molecule")
+    return smiles_kept
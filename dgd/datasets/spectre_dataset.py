@@ -5,6 +5,8 @@ from torch.utils.data import random_split, Dataset
 import torch_geometric.utils
 
 from dgd.datasets.abstract_dataset import AbstractDataModule, AbstractDatasetInfos
+from dgd.datasets.graph_store import PackedGraphStore, adjacencies_to_arrays, file_fingerprint, is_stale, \
+    packed_path
 
 
 class SpectreGraphDataset(Dataset):
@@ -12,23 +14,25 @@ class SpectreGraphDataset(Dataset):
         """ This class can be used to load the comm20, sbm and planar datasets. """
         base_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, os.pardir, 'data')
         filename = os.path.join(base_path, data_file)
-        self.adjs, self.eigvals, self.eigvecs, self.n_nodes, self.max_eigval, self.min_eigval, self.same_sample, self.n_max = torch.load(
-            filename)
+        store_path = packed_path(filename)
+        if is_stale(store_path, filename):
+            print(f'Packing {filename} into {store_path}...')
+            adjs = torch.load(filename)[0]
+            # A single node type, and a single edge type after "no edge"
+            PackedGraphStore.write(store_path, adjacencies_to_arrays(adjs), num_node_classes=1, num_edge_classes=2,
+                                   extra_meta={'source': file_fingerprint(filename)})
+        self.graphs = PackedGraphStore(store_path)
         print(f'Dataset {filename} loaded from file')
 
     def __len__(self):
-        return len(self.adjs)
+        return len(self.graphs)
 
     def __getitem__(self, idx):
-        adj = self.adjs[idx]
-        n = adj.shape[-1]
-        X = torch.ones(n, 1, dtype=torch.float)
+        data = self.graphs[idx]
+        n = data.num_nodes
         y = torch.zeros([1, 0]).float()
-        edge_index, _ = torch_geometric.utils.dense_to_sparse(adj)
-        edge_attr = torch.zeros(edge_index.shape[-1], 2, dtype=torch.float)
-        edge_attr[:, 1] = 1
         num_nodes = n * torch.ones(1, dtype=torch.long)
-        data = torch_geometric.data.Data(x=X, edge_index=edge_index, edge_attr=edge_attr,
+        data = torch_geometric.data.Data(x=data.x, edge_index=data.edge_index, edge_attr=data.edge_attr,
                                          y=y, idx=idx, n_nodes=num_nodes)
         return data
 
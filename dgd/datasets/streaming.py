@@ -0,0 +1,125 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+import torch
+from torch.utils.data import IterableDataset, get_worker_info
+
+
+def shard_path(shard_dir, k):
+    return os.path.join(shard_dir, f'shard_{k:05d}.pt')
+
+
+class StreamingGraphDataset(IterableDataset):
+    """ Iterates over a directory of shards without loading the whole dataset.
+
+        The directory holds shard_XXXXX.pt files, each a list of Data objects, and an index.json file with the
+        number of graphs of each shard (the format written by sharded_processing.process_in_shards).
+        Only one shard per DataLoader worker and the shuffle buffer are in memory at any time. Shards are read in
+        a shuffled order that is shared by all workers and split between them, then graphs are shuffled with a
+        buffer of buffer_size graphs. The shard order and the buffer change at every epoch.
+        Graphs keep the idx attribute they were written with.
+    """
+    def __init__(self, shard_dir, shards=None, shuffle=True, buffer_size=10000, transform=None):
+        super().__init__()
+        self.shard_dir = shard_dir
+        with open(os.path.join(shard_dir, 'index.json'), 'r') as f:
+            index = json.load(f)
+        sizes = dict(zip(index['shards'], index['num_graphs']))
+        self.shards = list(index['shards']) if shards is None else list(shards)
+        self.shard_sizes = [sizes[shard] for shard in self.shards]
+        self.shuffle = shuffle
+        self.buffer_size = buffer_size
+        self.transform = transform
+
+    def __len__(self):
+        return sum(self.shard_sizes)
+
+    def fingerprint(self):
+        md5 = hashlib.md5()
+        for shard, size in zip(self.shards, self.shard_sizes):
+            stat = os.stat(os.path.join(self.shard_dir, shard))
+            md5.update(f'{shard}:{size}:{stat.st_size}:{stat.st_mtime_ns}'.encode())
+        return md5.hexdigest()
+
+    def read_shard(self, shard):
+        return torch.load(os.path.join(self.shard_dir, shard))
+
+    def _seeds(self):
+        worker_info = get_worker_info()
+        if worker_info is None:
+            if not self.shuffle:
+                return 0, 0, 1
+            # Same draw as the one DataLoader makes for its workers, so that seed_everything makes it reproducible
+            base_seed = int(torch.empty((), dtype=torch.int64).random_().item())
+            return base_seed, 0, 1
+        # The DataLoader gives seed base_seed + worker_id to each worker, with a new base_seed at every epoch
+        return worker_info.seed - worker_info.id, worker_info.id, worker_info.num_workers
+
+    def __iter__(self):
+        base_seed, worker_id, num_workers = self._seeds()
+        order = np.arange(len(self.shards))
+        if self.shuffle:
+            order = np.random.default_rng(base_seed % 2 ** 32).permutation(order)
+        rng = np.random.default_rng((base_seed + worker_id + 1) % 2 ** 32)
+
+        buffer = []
+        for k in order[worker_id::num_workers]:
+            for data in self.read_shard(self.shards[k]):
+                if self.transform is not None:
+                    data = self.transform(data)
+                if not self.shuffle:
+                    yield data
+                    continue
+                if len(buffer) < self.buffer_size:
+                    buffer.append(data)
+                    continue
+                i = rng.integers(len(buffer))
+                yield buffer[i]
+                buffer[i] = data
+        for i in rng.permutation(len(buffer)):
+            yield buffer[i]
+
+
+def split_shards(shard_dir, test_fraction=0.2, val_fraction=0.2, seed=1234):
+    """ Assigns whole shards to train, val and test with the same proportions as the in-memory splits. """
+    with open(os.path.join(shard_dir, 'index.json'), 'r') as f:
+        shards = json.load(f)['shards']
+    order = np.random.default_rng(seed).permutation(len(shards))
+    test_len = int(round(len(shards) * test_fraction))
+    val_len = int(round((len(shards) - test_len) * val_fraction))
+    test, val, train = np.split(order, [test_len, test_len + val_len])
+    return {'train': [shards[k] for k in sorted(train)],
+            'val': [shards[k] for k in sorted(val)],
+            'test': [shards[k] for k in sorted(test)]}
+
+
+def write_shards(graphs, shard_dir, shard_size=10000, preprocess=None):
+    """ Writes an iterable of Data objects to shard_dir in the format read by StreamingGraphDataset.
+        Graphs without an idx attribute get their position in the iterable. """
+    os.makedirs(shard_dir, exist_ok=True)
+    shards, num_graphs, current = [], [], []
+
+    def flush():
+        path = shard_path(shard_dir, len(shards))
+        torch.save(current, path + '.tmp')
+        os.replace(path + '.tmp', path)
+        shards.append(os.path.basename(path))
+        num_graphs.append(len(current))
+
+    for i, data in enumerate(graphs):
+        if preprocess is not None:
+            data = preprocess(data)
+        if getattr(data, 'idx', None) is None:
+            data.idx = i
+        current.append(data)
+        if len(current) == shard_size:
+            flush()
+            current = []
+    if len(current) > 0:
+        flush()
+
+    # The index is written last: a directory without index.json is an incomplete conversion
+    with open(os.path.join(shard_dir, 'index.json'), 'w') as f:
+        json.dump({'shards': shards, 'num_graphs': num_graphs}, f)
@@ -3,7 +3,7 @@ from torch.nn import functional as F
 import numpy as np
 import math
 
-from dgd.utils import PlaceHolder
+from dgd.utils import PlaceHolder, to_triu, from_triu, should_check
 
 
 def sum_except_batch(x):
@@ -11,6 +11,8 @@ def sum_except_batch(x):
 
 
 def assert_correctly_masked(variable, node_mask):
+    if not should_check('masked'):
+        return
     assert (variable * (1 - node_mask.long())).abs().max().item() < 1e-4, \
         'Variables not masked properly.'
 
@@ -97,6 +99,23 @@ def custom_beta_schedule_discrete(timesteps, average_num_nodes=50, s=0.008):
     return np.array(betas)
 
 
+def sampling_timesteps(timesteps, steps=None, spacing='linear'):
+    """ Integer times T = t_K > ... > t_0 = 0 visited by a sampler with K = steps denoising steps (all T if None).
+        spacing 'linear': jumps of equal length. 'quadratic': t_k ~ T (k / K)^2, shorter jumps at low noise. """
+    steps = timesteps if steps is None else steps
+    assert 1 <= steps <= timesteps, f"Between 1 and {timesteps} sampling steps, got {steps}"
+    if spacing == 'linear':
+        grid = np.linspace(0, timesteps, steps + 1)
+    elif spacing == 'quadratic':
+        grid = np.linspace(0, np.sqrt(timesteps), steps + 1) ** 2
+    else:
+        raise ValueError(f"Unknown sampling spacing {spacing}")
+    # Rounding can merge close times: push them apart so that there are exactly K steps
+    k = np.arange(steps + 1)
+    times = np.maximum.accumulate(np.round(grid).astype(int) - k) + k
+    return times[::-1].tolist()
+
+
 
 def gaussian_KL(q_mu, q_sigma):
     """Computes the KL distance between a normal distribution and the standard normal.
@@ -202,7 +221,8 @@ def sample_feature_noise(X_size, E_size, y_size, node_mask):
     epsE = epsE * upper_triangular_mask
     epsE = (epsE + torch.transpose(epsE, 1, 2))
 
-    assert (epsE == torch.transpose(epsE, 1, 2)).all()
+    if should_check('feature_noise_symmetric'):
+        assert (epsE == torch.transpose(epsE, 1, 2)).all()
 
     return PlaceHolder(X=epsX, E=epsE, y=epsy).mask(node_mask)
 
@@ -249,20 +269,18 @@ def sample_discrete_features(probX, probE, node_mask):
     X_t = X_t.reshape(node_mask.size(0), node_mask.size(1))     # (bs, n)
 
     # Noise E
+    # Only the pairs above the diagonal are sampled, the lower triangle is their mirror and the diagonal is 0
+    n = node_mask.size(1)
+    probE = to_triu(probE)                                                      # (bs, n * (n - 1) / 2, de_out)
     # The masked rows should define probability distributions as well
-    inverse_edge_mask = ~(node_mask.unsqueeze(1) * node_mask.unsqueeze(2))
-    diag_mask = torch.zeros(probE.size(0), probE.size(1), probE.size(2)) + \
-                torch.eye(probE.size(1), probE.size(2)).unsqueeze(0)
-
+    inverse_edge_mask = to_triu(~(node_mask.unsqueeze(1) * node_mask.unsqueeze(2)))
     probE[inverse_edge_mask] = 1 / probE.shape[-1]
-    probE[diag_mask.bool()] = 1 / probE.shape[-1]
 
-    probE = probE.reshape(probE.size(0) * probE.size(1) * probE.size(2), -1)    # (bs * n * n, de_out)
+    probE = probE.reshape(probE.size(0) * probE.size(1), -1)    # (bs * n * (n - 1) / 2, de_out)
 
     # Sample E
-    E_t = probE.multinomial(1).reshape(node_mask.size(0), node_mask.size(1), node_mask.size(1))   # (bs, n, n)
-    E_t = torch.triu(E_t, diagonal=1)
-    E_t = (E_t + torch.transpose(E_t, 1, 2))
+    E_t = probE.multinomial(1).reshape(node_mask.size(0), -1)    # (bs, n * (n - 1) / 2)
+    E_t = from_triu(E_t, n)                                       # (bs, n, n)
 
     return PlaceHolder(X=X_t, E=E_t, y=torch.zeros(X_t.shape[0], 0).type_as(X_t))
 
@@ -322,6 +340,34 @@ def compute_batched_over0_posterior_distribution(X_t, Qt, Qsb, Qtb):
     return out
 
 
+def mixed_posterior_distribution(X_t, pred, Qt, Qsb, Qtb):
+    """ Unnormalized distribution of x_s given x_t, mixed over the predicted distribution of x_0, for any transition.
+        X_t, pred: bs, N, d. Qt, Qsb, Qtb: bs, d, d. Returns bs, N, d_t-1.
+    """
+    p_s_and_t_given_0 = compute_batched_over0_posterior_distribution(X_t=X_t, Qt=Qt, Qsb=Qsb, Qtb=Qtb)
+    weighted = pred.unsqueeze(-1) * p_s_and_t_given_0          # bs, N, d0, d_t-1
+    return weighted.sum(dim=2)
+
+
+def low_rank_posterior_distribution(X_t, pred, marginals, alpha_t, alpha_s_bar, alpha_t_bar):
+    """ Same as mixed_posterior_distribution for transitions Q(a) = a * I + (1 - a) * 1 m^T, with m the marginals:
+        Qt = Q(alpha_t), Qsb = Q(alpha_s_bar), Qtb = Q(alpha_t_bar). Only uses vectors of size d per entry:
+            x_t @ Qt.T = alpha_t * x_t + (1 - alpha_t) * <x_t, m>
+            Qtb @ x_t.T = alpha_t_bar * x_t + (1 - alpha_t_bar) * <x_t, m>
+            sum_x0 w(x0) * Qsb[x0] = alpha_s_bar * w + (1 - alpha_s_bar) * sum(w) * m,  w = pred / Qtb @ x_t.T
+        X_t, pred: bs, N, d. marginals: d. alpha_t, alpha_s_bar, alpha_t_bar: bs, 1. Returns bs, N, d_t-1.
+    """
+    X_t = X_t.to(torch.float32)
+    alpha_t, alpha_s_bar, alpha_t_bar = alpha_t.unsqueeze(-1), alpha_s_bar.unsqueeze(-1), alpha_t_bar.unsqueeze(-1)
+    m_t = X_t @ marginals.unsqueeze(-1)                                 # bs, N, 1
+    left_term = alpha_t * X_t + (1 - alpha_t) * m_t                     # bs, N, d_t-1
+    denominator = alpha_t_bar * X_t + (1 - alpha_t_bar) * m_t           # bs, N, d0
+    denominator[denominator == 0] = 1e-6
+    w = pred / denominator
+    right_term = alpha_s_bar * w + (1 - alpha_s_bar) * w.sum(dim=-1, keepdim=True) * marginals
+    return left_term * right_term
+
+
 def mask_distributions(true_X, true_E, pred_X, pred_E, node_mask):
     # Set masked rows to arbitrary distributions, so it doesn't contribute to loss
     row_X = torch.zeros(true_X.size(-1), dtype=torch.float, device=true_X.device)
@@ -371,7 +417,8 @@ def sample_discrete_feature_noise(limit_dist, node_mask):
     U_E = U_E * upper_triangular_mask
     U_E = (U_E + torch.transpose(U_E, 1, 2))
 
-    assert (U_E == torch.transpose(U_E, 1, 2)).all()
+    if should_check('discrete_noise_symmetric'):
+        assert (U_E == torch.transpose(U_E, 1, 2)).all()
 
     return PlaceHolder(X=U_X, E=U_E, y=U_y).mask(node_mask)
 
@@ -59,11 +59,12 @@ class PredefinedNoiseScheduleDiscrete(torch.nn.Module):
 
         self.register_buffer('betas', torch.from_numpy(betas).float())
 
-        self.alphas = 1 - torch.clamp(self.betas, min=0, max=0.9999)
+        # Buffers follow the module to its device. Non persistent: derived from betas, not saved in checkpoints
+        self.register_buffer('alphas', 1 - torch.clamp(self.betas, min=0, max=0.9999), persistent=False)
 
         log_alpha = torch.log(self.alphas)
         log_alpha_bar = torch.cumsum(log_alpha, dim=0)
-        self.alphas_bar = torch.exp(log_alpha_bar)
+        self.register_buffer('alphas_bar', torch.exp(log_alpha_bar), persistent=False)
         print(f"[Noise schedule: {noise_schedule}] alpha_bar:", self.alphas_bar)
 
     def forward(self, t_normalized=None, t_int=None):
@@ -76,7 +77,7 @@ class PredefinedNoiseScheduleDiscrete(torch.nn.Module):
         assert int(t_normalized is None) + int(t_int is None) == 1
         if t_int is None:
             t_int = torch.round(t_normalized * self.timesteps)
-        return self.alphas_bar[t_int.long().to('cpu')]
+        return self.alphas_bar[t_int.long()]
 
 
 class DiscreteUniformTransition:
@@ -84,6 +85,8 @@ class DiscreteUniformTransition:
         self.X_classes = x_classes
         self.E_classes = e_classes
         self.y_classes = y_classes
+        self.x_marginals = torch.ones(self.X_classes) / max(self.X_classes, 1)
+        self.e_marginals = torch.ones(self.E_classes) / max(self.E_classes, 1)
         self.u_x = torch.ones(1, self.X_classes, self.X_classes)
         if self.X_classes > 0:
             self.u_x = self.u_x / self.X_classes
@@ -187,6 +190,39 @@ class MarginalUniformTransition:
         return utils.PlaceHolder(X=q_x, E=q_e, y=q_y)
 
 
+class PrecomputedTransitions(torch.nn.Module):
+    """ Transition matrices Qt and Qt_bar of all the timesteps 0, ..., T, computed once by transition_model and
+        stored as buffers, which follow the model to its device. Matrices are then gathered with integer timesteps
+        instead of being built at each call. Qs_bar is Qt_bar gathered at s.
+        The tables use (T + 1) * 2 * (dx^2 + de^2 + dy^2) floats, see table_bytes.
+    """
+    def __init__(self, transition_model, noise_schedule):
+        super().__init__()
+        betas = noise_schedule.betas.unsqueeze(1)                  # (T + 1, 1)
+        alphas_bar = noise_schedule.alphas_bar.unsqueeze(1)
+        Qt = transition_model.get_Qt(betas, device=betas.device)
+        Qtb = transition_model.get_Qt_bar(alphas_bar, device=betas.device)
+        for name, table in [('Qt', Qt), ('Qtb', Qtb)]:
+            self.register_buffer(f'{name}_X', table.X.clone(), persistent=False)
+            self.register_buffer(f'{name}_E', table.E.clone(), persistent=False)
+            self.register_buffer(f'{name}_y', table.y.clone(), persistent=False)
+
+    @staticmethod
+    def table_bytes(transition_model, timesteps):
+        classes = [transition_model.X_classes, transition_model.E_classes, transition_model.y_classes]
+        return 4 * (timesteps + 1) * 2 * sum(d ** 2 for d in classes)
+
+    def get_Qt(self, t_int):
+        """ One-step transition matrices from t - 1 to t. t_int: (bs, 1). Returns (bs, d, d) for X, E and y. """
+        t_int = t_int.long().view(-1)
+        return utils.PlaceHolder(X=self.Qt_X[t_int], E=self.Qt_E[t_int], y=self.Qt_y[t_int])
+
+    def get_Qt_bar(self, t_int):
+        """ Transition matrices from 0 to t. t_int: (bs, 1). Returns (bs, d, d) for X, E and y. """
+        t_int = t_int.long().view(-1)
+        return utils.PlaceHolder(X=self.Qtb_X[t_int], E=self.Qtb_E[t_int], y=self.Qtb_y[t_int])
+
+
 class AbsorbingStateTransition:
     def __init__(self, abs_state: int, x_classes: int, e_classes: int, y_classes: int):
         self.X_classes = x_classes
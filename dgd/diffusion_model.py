@@ -8,6 +8,7 @@ import pytorch_lightning as pl
 import wandb
 
 from dgd.models.transformer_model import GraphTransformer
+from dgd.models.inference import inference_backend
 from diffusion.noise_schedule import PredefinedNoiseSchedule
 from dgd.diffusion import diffusion_utils
 from dgd.metrics.train_metrics import TrainLoss
@@ -31,7 +32,8 @@ class LiftedDenoisingDiffusion(pl.LightningModule):
 
         self.cfg = cfg
         self.name = cfg.general.name
-        self.model_dtype = torch.float32
+        self.network_precision = cfg.model.get('precision', 'fp32')
+        self.model_dtype = utils.PRECISIONS[self.network_precision]
         self.T = cfg.model.diffusion_steps
 
         self.Xdim = input_dims['X']
@@ -74,7 +76,13 @@ class LiftedDenoisingDiffusion(pl.LightningModule):
                                       hidden_dims=cfg.model.hidden_dims,
                                       output_dims=output_dims,
                                       act_fn_in=nn.ReLU(),
-                                      act_fn_out=nn.ReLU())
+                                      act_fn_out=nn.ReLU(),
+                                      attention_chunk_size=cfg.model.get('attention_chunk_size', None),
+                                      symmetric_edges=cfg.model.get('symmetric_edges', False),
+                                      packed=cfg.model.get('packed', False),
+                                      checkpoint_every=cfg.model.get('checkpoint_every', None))
+        # Runs the network outside of training, e.g. a TorchScript trace for sampling. None: eager network
+        self.inference_backend = inference_backend(cfg, self.model)
 
         self.save_hyperparameters()
 
@@ -87,9 +95,7 @@ class LiftedDenoisingDiffusion(pl.LightningModule):
         self.val_counter = 0
 
     def training_step(self, data, i):
-        dense_data, node_mask = utils.to_dense(x=data.x, edge_index=data.edge_index, edge_attr=data.edge_attr,
-                                               batch=data.batch)
-        dense_data = dense_data.mask(node_mask)
+        dense_data, node_mask = utils.dense_batch(data)
         X, E = dense_data.X, dense_data.E
         normalized_data = utils.normalize(X, E, data.y, self.norm_values, self.norm_biases, node_mask)
         noisy_data = self.apply_noise(normalized_data.X, normalized_data.E, normalized_data.y, node_mask)
@@ -140,9 +146,7 @@ class LiftedDenoisingDiffusion(pl.LightningModule):
         self.val_y_logp.reset()
 
     def validation_step(self, data, i):
-        dense_data, node_mask = utils.to_dense(x=data.x, edge_index=data.edge_index, edge_attr=data.edge_attr,
-                                               batch=data.batch)
-        dense_data = dense_data.mask(node_mask)
+        dense_data, node_mask = utils.dense_batch(data)
         X, E = dense_data.X, dense_data.E
         normalized_data = utils.normalize(X, E, data.y, self.norm_values, self.norm_biases, node_mask)
         noisy_data = self.apply_noise(normalized_data.X, normalized_data.E, data.y, node_mask)
@@ -220,9 +224,7 @@ class LiftedDenoisingDiffusion(pl.LightningModule):
         self.test_y_logp.reset()
 
     def test_step(self, data, i):
-        dense_data, node_mask = utils.to_dense(x=data.x, edge_index=data.edge_index, edge_attr=data.edge_attr,
-                                               batch=data.batch)
-        dense_data = dense_data.mask(node_mask)
+        dense_data, node_mask = utils.dense_batch(data)
         X, E = dense_data.X, dense_data.E
         normalized_data = utils.normalize(X, E, data.y, self.norm_values, self.norm_biases, node_mask)
         noisy_data = self.apply_noise(normalized_data.X, normalized_data.E, normalized_data.y, node_mask)
@@ -525,11 +527,20 @@ class LiftedDenoisingDiffusion(pl.LightningModule):
         return nll
 
     def forward(self, noisy_data, extra_data, node_mask):
-        """ Concatenates extra data to the noisy data, then calls the network. """
+        """ Concatenates extra data to the noisy data, then calls the network in model.precision.
+            The predictions are returned in float32. """
         X = torch.cat((noisy_data['X_t'], extra_data.X), dim=2)
         E = torch.cat((noisy_data['E_t'], extra_data.E), dim=3)
         y = torch.hstack((noisy_data['y_t'], extra_data.y))
-        return self.model(X, E, y, node_mask)
+        with utils.network_autocast(X.device, self.network_precision):
+            pred = self.network()(X, E, y, node_mask)
+        return utils.PlaceHolder(X=pred.X.float(), E=pred.E.float(), y=pred.y.float())
+
+    def network(self):
+        """ The eager network during training, the inference backend otherwise if there is one. """
+        if self.inference_backend is None or torch.is_grad_enabled():
+            return self.model
+        return self.inference_backend
 
     def log_info(self):
         """
@@ -580,7 +591,8 @@ class LiftedDenoisingDiffusion(pl.LightningModule):
                                                    node_mask=node_mask)
         X, E, y = z_T.X, z_T.E, z_T.y
 
-        assert (E == torch.transpose(E, 1, 2)).all()
+        if utils.should_check('z_T_symmetric'):
+            assert (E == torch.transpose(E, 1, 2)).all()
         assert number_chain_steps < self.T
         chain_X_size = torch.Size((number_chain_steps, keep_chain, X.size(1)))
         chain_E_size = torch.Size((number_chain_steps, keep_chain, E.size(1), E.size(2)))
@@ -617,7 +629,8 @@ class LiftedDenoisingDiffusion(pl.LightningModule):
         # Finally sample the discrete data given the last latent code z0
         final_graph = self.sample_discrete_graph_given_z0(X, E, y, node_mask)
         X, E, y = final_graph.X, final_graph.E, final_graph.y
-        assert (E == torch.transpose(E, 1, 2)).all()
+        if utils.should_check('final_graph_symmetric'):
+            assert (E == torch.transpose(E, 1, 2)).all()
 
         print("Examples of generated graphs:")
         for i in range(min(5, X.shape[0])):
@@ -692,10 +705,12 @@ class LiftedDenoisingDiffusion(pl.LightningModule):
         pred_X = 1. / alpha_0 * (X_0 - sigma_0 * eps0.X)
         pred_E = 1. / alpha_0.unsqueeze(1) * (E_0 - sigma_0.unsqueeze(1) * eps0.E)
         pred_y = 1. / alpha_0.squeeze(1) * (y_0 - sigma_0.squeeze(1) * eps0.y)
-        assert (pred_E == torch.transpose(pred_E, 1, 2)).all()
+        if utils.should_check('pred_E_symmetric'):
+            assert (pred_E == torch.transpose(pred_E, 1, 2)).all()
 
         sampled = diffusion_utils.sample_normal(pred_X, pred_E, pred_y, sigma, node_mask).type_as(pred_X)
-        assert (sampled.E == torch.transpose(sampled.E, 1, 2)).all()
+        if utils.should_check('sampled_E_symmetric'):
+            assert (sampled.E == torch.transpose(sampled.E, 1, 2)).all()
 
         sampled = utils.unnormalize(sampled.X, sampled.E, sampled.y, self.norm_values,
                                     self.norm_biases, node_mask, collapse=True)
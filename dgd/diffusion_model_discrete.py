@@ -7,8 +7,11 @@ import wandb
 import os
 
 from dgd.models.transformer_model import GraphTransformer
+from dgd.models.inference import inference_backend, export_onnx
+from dgd.onnx_sampler import OnnxSampler, write_sampler_coefficients
+from dgd.analysis.rdkit_functions import compute_molecular_metrics
 from dgd.diffusion.noise_schedule import DiscreteUniformTransition, PredefinedNoiseScheduleDiscrete,\
-    MarginalUniformTransition
+    MarginalUniformTransition, PrecomputedTransitions
 from dgd.diffusion import diffusion_utils
 from dgd.metrics.train_metrics import TrainLossDiscrete
 from dgd.metrics.abstract_metrics import SumExceptBatchMetric, SumExceptBatchKL, NLL
@@ -26,7 +29,8 @@ class DiscreteDenoisingDiffusion(pl.LightningModule):
 
         self.cfg = cfg
         self.name = cfg.general.name
-        self.model_dtype = torch.float32
+        self.network_precision = cfg.model.get('precision', 'fp32')
+        self.model_dtype = utils.PRECISIONS[self.network_precision]
         self.T = cfg.model.diffusion_steps
 
         self.Xdim = input_dims['X']
@@ -49,6 +53,12 @@ class DiscreteDenoisingDiffusion(pl.LightningModule):
         self.val_E_logp = SumExceptBatchMetric()
         self.val_y_logp = SumExceptBatchMetric()
 
+        # With a reduced precision, the validation NLL can also be computed with the float32 network
+        self.check_fp32_nll = self.network_precision != 'fp32' and cfg.model.get('check_fp32_nll', False)
+        if self.check_fp32_nll:
+            self.val_nll_fp32 = NLL()
+            self.val_kl_fp32 = nn.ModuleList([SumExceptBatchKL(), SumExceptBatchKL(), SumExceptBatchKL()])
+
         self.test_nll = NLL()
         self.test_X_kl = SumExceptBatchKL()
         self.test_E_kl = SumExceptBatchKL()
@@ -70,7 +80,22 @@ class DiscreteDenoisingDiffusion(pl.LightningModule):
                                       hidden_dims=cfg.model.hidden_dims,
                                       output_dims=output_dims,
                                       act_fn_in=nn.ReLU(),
-                                      act_fn_out=nn.ReLU())
+                                      act_fn_out=nn.ReLU(),
+                                      attention_chunk_size=cfg.model.get('attention_chunk_size', None),
+                                      symmetric_edges=cfg.model.get('symmetric_edges', False),
+                                      packed=cfg.model.get('packed', False),
+                                      checkpoint_every=cfg.model.get('checkpoint_every', None))
+        # Runs the network outside of training, e.g. a TorchScript trace for sampling. None: eager network
+        self.inference_backend = inference_backend(cfg, self.model)
+        # Edge states only for the existing edges and a bounded set of candidate pairs, see utils.candidate_pairs
+        self.sparse_edges = cfg.model.get('sparse_edges', False)
+        # Number of denoising steps of the sampler (null: all T steps) and how they are spread over [0, T]
+        self.sampling_steps = cfg.model.get('sampling_steps', None)
+        self.sampling_spacing = cfg.model.get('sampling_spacing', 'linear')
+        # Qsb at s instead of t in the all-step sampler, see sample_p_zs_given_zt
+        self.exact_sampling_posterior = cfg.model.get('exact_sampling_posterior', False)
+        # Remove graphs that stopped changing from the sampled batch, see sample_active_graphs
+        self.freeze_converged = cfg.model.get('freeze_converged', False)
 
         self.noise_schedule = PredefinedNoiseScheduleDiscrete(cfg.model.diffusion_noise_schedule,
                                                               timesteps=cfg.model.diffusion_steps)
@@ -95,6 +120,23 @@ class DiscreteDenoisingDiffusion(pl.LightningModule):
             self.limit_dist = utils.PlaceHolder(X=x_marginals, E=e_marginals,
                                                 y=torch.ones(self.ydim_output) / self.ydim_output)
 
+        # Tables of Qt and Qt_bar for all the timesteps, unless they are larger than model.transition_tables_mb
+        table_bytes = PrecomputedTransitions.table_bytes(self.transition_model, self.T)
+        if table_bytes <= cfg.model.get('transition_tables_mb', 256) * 2 ** 20:
+            self.transition_tables = PrecomputedTransitions(self.transition_model, self.noise_schedule)
+        else:
+            print(f"Transition tables would use {table_bytes / 2 ** 20:.0f}MB, transitions are computed at each call")
+            self.transition_tables = None
+
+        # Posterior of sampling in closed form for transitions a * I + (1 - a) * 1 m^T, without the d x d matrices
+        self.low_rank_posterior = cfg.model.get('low_rank_posterior', True) and \
+            hasattr(self.transition_model, 'e_marginals')
+        if self.low_rank_posterior:
+            self.register_buffer('x_marginals', self.transition_model.x_marginals.clone(), persistent=False)
+            self.register_buffer('e_marginals', self.transition_model.e_marginals.clone(), persistent=False)
+        else:
+            self.x_marginals = self.e_marginals = None
+
         self.save_hyperparameters(ignore=[train_metrics, sampling_metrics])
         self.start_epoch_time = None
         self.train_iterations = None
@@ -103,16 +145,26 @@ class DiscreteDenoisingDiffusion(pl.LightningModule):
         self.number_chain_steps = cfg.general.number_chain_steps
         self.best_val_nll = 1e8
         self.val_counter = 0
+        self.sampling_stats = {}
+        self.active_batch_sizes = []
 
     def training_step(self, data, i):
-        dense_data, node_mask = utils.to_dense(data.x, data.edge_index, data.edge_attr, data.batch)
-        dense_data = dense_data.mask(node_mask)
+        dense_data, node_mask = utils.dense_batch(data)
         X, E = dense_data.X, dense_data.E
         noisy_data = self.apply_noise(X, E, data.y, node_mask)
         extra_data = self.compute_extra_data(noisy_data)
-        pred = self.forward(noisy_data, extra_data, node_mask)
-        loss = self.train_loss(masked_pred_X=pred.X, masked_pred_E=pred.E, pred_y=pred.y,
-                               true_X=X, true_E=E, true_y=data.y,
+        candidates = self.candidate_pairs(noisy_data['E_t'], node_mask) if self.sparse_edges else None
+        pred = self.forward(noisy_data, extra_data, node_mask, candidates=candidates)
+        pred_E, true_E = pred.E, E
+        if self.cfg.model.get('symmetric_edges', False):
+            # Both triangles hold the same predictions and targets, the loss only needs one of them
+            pred_E, true_E = utils.to_triu(pred.E), utils.to_triu(E)
+        elif candidates is not None:
+            # Only the candidate pairs have a prediction, in both triangles
+            graphs, rows, cols = candidates[:, candidates[1] < candidates[2]]
+            pred_E, true_E = pred.E[graphs, rows, cols], E[graphs, rows, cols]
+        loss = self.train_loss(masked_pred_X=pred.X, masked_pred_E=pred_E, pred_y=pred.y,
+                               true_X=X, true_E=true_E, true_y=data.y,
                                log=i % self.log_every_steps == 0)
 
         self.train_metrics(masked_pred_X=pred.X, masked_pred_E=pred.E, true_X=X, true_E=E,
@@ -147,15 +199,20 @@ class DiscreteDenoisingDiffusion(pl.LightningModule):
         self.val_X_logp.reset()
         self.val_E_logp.reset()
         self.val_y_logp.reset()
+        if self.check_fp32_nll:
+            self.val_nll_fp32.reset()
+            for metric in self.val_kl_fp32:
+                metric.reset()
         self.sampling_metrics.reset()
 
     def validation_step(self, data, i):
-        dense_data, node_mask = utils.to_dense(data.x, data.edge_index, data.edge_attr, data.batch)
-        dense_data = dense_data.mask(node_mask)
+        dense_data, node_mask = utils.dense_batch(data)
         noisy_data = self.apply_noise(dense_data.X, dense_data.E, data.y, node_mask)
         extra_data = self.compute_extra_data(noisy_data)
         pred = self.forward(noisy_data, extra_data, node_mask)
-        nll = self.compute_val_loss(pred, noisy_data, dense_data.X, dense_data.E, data.y,  node_mask, test=False)
+        pred_fp32 = self.forward(noisy_data, extra_data, node_mask, precision='fp32') if self.check_fp32_nll else None
+        nll = self.compute_val_loss(pred, noisy_data, dense_data.X, dense_data.E, data.y,  node_mask, test=False,
+                                    pred_fp32=pred_fp32)
         return {'loss': nll}
 
     def validation_epoch_end(self, outs) -> None:
@@ -172,6 +229,12 @@ class DiscreteDenoisingDiffusion(pl.LightningModule):
 
         print(f"Epoch {self.current_epoch}: Val NLL {metrics[0] :.2f} -- Val Atom type KL {metrics[1] :.2f} -- ",
               f"Val Edge type KL: {metrics[2] :.2f} -- Val Global feat. KL {metrics[3] :.2f}\n")
+        if self.check_fp32_nll:
+            nll_fp32 = self.val_nll_fp32.compute()
+            wandb.log({"val/epoch_NLL_fp32": nll_fp32, "val/epoch_NLL_precision_gap": metrics[0] - nll_fp32},
+                      commit=False)
+            print(f"Val NLL with the float32 network {nll_fp32 :.2f} -- {self.network_precision} gap "
+                  f"{metrics[0] - nll_fp32 :.4f}\n")
 
         # Log val nll with default Lightning logger, so it can be monitored by checkpoint callback
         val_log_p = metrics[-3]
@@ -184,27 +247,10 @@ class DiscreteDenoisingDiffusion(pl.LightningModule):
         self.val_counter += 1
         if self.val_counter % self.cfg.general.sample_every_val == 0:
             start = time.time()
-            samples_left_to_generate = self.cfg.general.samples_to_generate
-            samples_left_to_save = self.cfg.general.samples_to_save
-            chains_left_to_save = self.cfg.general.chains_to_save
-
-            samples = []
-
-            ident = 0
-            while samples_left_to_generate > 0:
-                bs = 2 * self.cfg.train.batch_size
-                to_generate = min(samples_left_to_generate, bs)
-                to_save = min(samples_left_to_save, bs)
-                chains_save = min(chains_left_to_save, bs)
-                samples.extend(self.sample_batch(batch_id=ident, batch_size=to_generate, num_nodes=None,
-                                                 save_final=to_save,
-                                                 keep_chain=chains_save,
-                                                 number_chain_steps=self.number_chain_steps))
-                ident += to_generate
-
-                samples_left_to_save -= to_save
-                samples_left_to_generate -= to_generate
-                chains_left_to_save -= chains_save
+            samples = self.sample_graphs(self.cfg.general.samples_to_generate, 2 * self.cfg.train.batch_size,
+                                         samples_to_save=self.cfg.general.samples_to_save,
+                                         chains_to_save=self.cfg.general.chains_to_save)
+            wandb.log({f"sampling/{key}": value for key, value in self.sampling_stats.items()}, commit=False)
             print("Computing sampling metrics...")
             self.sampling_metrics(samples, self.name, self.current_epoch, val_counter=-1, test=False)
             print(f'Done. Sampling took {time.time() - start:.2f} seconds\n')
@@ -220,8 +266,7 @@ class DiscreteDenoisingDiffusion(pl.LightningModule):
         self.test_y_logp.reset()
 
     def test_step(self, data, i):
-        dense_data, node_mask = utils.to_dense(data.x, data.edge_index, data.edge_attr, data.batch)
-        dense_data = dense_data.mask(node_mask)
+        dense_data, node_mask = utils.dense_batch(data)
         noisy_data = self.apply_noise(dense_data.X, dense_data.E, data.y, node_mask)
         extra_data = self.compute_extra_data(noisy_data)
         pred = self.forward(noisy_data, extra_data, node_mask)
@@ -249,25 +294,10 @@ class DiscreteDenoisingDiffusion(pl.LightningModule):
 
         print(f'Test loss: {test_nll :.4f}')
 
-        samples_left_to_generate = self.cfg.general.final_model_samples_to_generate
-        samples_left_to_save = self.cfg.general.final_model_samples_to_save
-        chains_left_to_save = self.cfg.general.final_model_chains_to_save
-
-        samples = []
-        id = 0
-        while samples_left_to_generate > 0:
-            print(f'Samples left to generate: {samples_left_to_generate}/'
-                  f'{self.cfg.general.final_model_samples_to_generate}', end='', flush=True)
-            bs = 2 * self.cfg.train.batch_size
-            to_generate = min(samples_left_to_generate, bs)
-            to_save = min(samples_left_to_save, bs)
-            chains_save = min(chains_left_to_save, bs)
-            samples.extend(self.sample_batch(id, to_generate, num_nodes=None, save_final=to_save,
-                                             keep_chain=chains_save, number_chain_steps=self.number_chain_steps))
-            id += to_generate
-            samples_left_to_save -= to_save
-            samples_left_to_generate -= to_generate
-            chains_left_to_save -= chains_save
+        samples = self.sample_graphs(self.cfg.general.final_model_samples_to_generate, 2 * self.cfg.train.batch_size,
+                                     samples_to_save=self.cfg.general.final_model_samples_to_save,
+                                     chains_to_save=self.cfg.general.final_model_chains_to_save)
+        wandb.log({f"test/sampling_{key}": value for key, value in self.sampling_stats.items()}, commit=False)
         print("Computing sampling metrics...")
         self.sampling_metrics.reset()
         self.sampling_metrics(samples, self.name, self.current_epoch, self.val_counter, test=True)
@@ -284,9 +314,8 @@ class DiscreteDenoisingDiffusion(pl.LightningModule):
         # Compute the last alpha value, alpha_T.
         ones = torch.ones((X.size(0), 1), device=X.device)
         Ts = self.T * ones
-        alpha_t_bar = self.noise_schedule.get_alpha_bar(t_int=Ts)  # (bs, 1)
 
-        Qtb = self.transition_model.get_Qt_bar(alpha_t_bar, self.device)
+        Qtb = self.get_Qt_bar(Ts)
 
         # Compute transition probabilities
         probX = X @ Qtb.X  # (bs, n, dx_out)
@@ -315,14 +344,18 @@ class DiscreteDenoisingDiffusion(pl.LightningModule):
                diffusion_utils.sum_except_batch(kl_distance_E) + \
                diffusion_utils.sum_except_batch(kl_distance_y)
 
-    def compute_Lt(self, X, E, y, pred, noisy_data, node_mask, test):
+    def compute_Lt(self, X, E, y, pred, noisy_data, node_mask, test, kl_metrics=None):
+        """ kl_metrics: the three metrics that accumulate the KL of X, E and y. Default: the val or test ones. """
         pred_probs_X = F.softmax(pred.X, dim=-1)
         pred_probs_E = F.softmax(pred.E, dim=-1)
         pred_probs_y = F.softmax(pred.y, dim=-1)
 
-        Qtb = self.transition_model.get_Qt_bar(noisy_data['alpha_t_bar'], self.device)
-        Qsb = self.transition_model.get_Qt_bar(noisy_data['alpha_s_bar'], self.device)
-        Qt = self.transition_model.get_Qt(noisy_data['beta_t'], self.device)
+        Qtb = self.get_Qt_bar(noisy_data['t_int'])
+        Qsb = self.get_Qt_bar(noisy_data['s_int'])
+        if noisy_data.get('jump', False):
+            Qt = self.transition_model.get_Qt(noisy_data['beta_t'], self.device)
+        else:
+            Qt = self.get_Qt(noisy_data['t_int'])
 
         # Compute distributions to compare with KL
         bs, n, d = X.shape
@@ -340,16 +373,18 @@ class DiscreteDenoisingDiffusion(pl.LightningModule):
                                                                                                 pred_X=prob_pred.X,
                                                                                                 pred_E=prob_pred.E,
                                                                                                 node_mask=node_mask)
-        kl_x = (self.test_X_kl if test else self.val_X_kl)(prob_true.X, torch.log(prob_pred.X))
-        kl_e = (self.test_E_kl if test else self.val_E_kl)(prob_true.E, torch.log(prob_pred.E))
-        kl_y = (self.test_y_kl if test else self.val_y_kl)(prob_true.y, torch.log(prob_pred.y)) if pred_probs_y.numel() != 0 else 0
+        if kl_metrics is None:
+            kl_metrics = (self.test_X_kl, self.test_E_kl, self.test_y_kl) if test else \
+                         (self.val_X_kl, self.val_E_kl, self.val_y_kl)
+        kl_x = kl_metrics[0](prob_true.X, torch.log(prob_pred.X))
+        kl_e = kl_metrics[1](prob_true.E, torch.log(prob_pred.E))
+        kl_y = kl_metrics[2](prob_true.y, torch.log(prob_pred.y)) if pred_probs_y.numel() != 0 else 0
         return kl_x + kl_e + kl_y
 
     def reconstruction_logp(self, t, X, E, y, node_mask):
         # Compute noise values for t = 0.
         t_zeros = torch.zeros_like(t)
-        beta_0 = self.noise_schedule(t_zeros)
-        Q0 = self.transition_model.get_Qt(beta_t=beta_0, device=self.device)
+        Q0 = self.get_Qt(t_zeros)
 
         probX0 = X @ Q0.X  # (bs, n, dx_out)
         probE0 = E @ Q0.E.unsqueeze(1)  # (bs, n, n, de_out)
@@ -384,26 +419,38 @@ class DiscreteDenoisingDiffusion(pl.LightningModule):
 
         return utils.PlaceHolder(X=probX0, E=probE0, y=proby0)
 
-    def apply_noise(self, X, E, y, node_mask):
-        """ Sample noise and apply it to the data. """
-
-        # Sample a timestep t.
-        # When evaluating, the loss for t=0 is computed separately
-        lowest_t = 0 if self.training else 1
-        t_int = torch.randint(lowest_t, self.T + 1, size=(X.size(0), 1), device=X.device).float()  # (bs, 1)
-        s_int = t_int - 1
+    def apply_noise(self, X, E, y, node_mask, timesteps=None):
+        """ Sample noise and apply it to the data.
+            timesteps: times of a sampler with fewer steps, see diffusion_utils.sampling_timesteps. t is then drawn
+            among them and s is the next time of the sampler, for the evaluation of the NLL of that sampler. """
+
+        if timesteps is None:
+            # Sample a timestep t.
+            # When evaluating, the loss for t=0 is computed separately
+            lowest_t = 0 if self.training else 1
+            t_int = torch.randint(lowest_t, self.T + 1, size=(X.size(0), 1), device=X.device).float()  # (bs, 1)
+            s_int = t_int - 1
+        else:
+            grid = torch.tensor(timesteps[::-1], device=X.device).float()
+            index = torch.randint(1, len(grid), size=(X.size(0), 1), device=X.device)
+            t_int, s_int = grid[index], grid[index - 1]
 
         t_float = t_int / self.T
         s_float = s_int / self.T
 
         # beta_t and alpha_s_bar are used for denoising/loss computation
-        beta_t = self.noise_schedule(t_normalized=t_float)                         # (bs, 1)
         alpha_s_bar = self.noise_schedule.get_alpha_bar(t_normalized=s_float)      # (bs, 1)
         alpha_t_bar = self.noise_schedule.get_alpha_bar(t_normalized=t_float)      # (bs, 1)
+        if timesteps is None:
+            beta_t = self.noise_schedule(t_normalized=t_float)                     # (bs, 1)
+        else:
+            # Noise of the jump from s to t, Q_t|s = Q_s+1 ... Q_t
+            beta_t = 1 - alpha_t_bar / alpha_s_bar
 
-        Qtb = self.transition_model.get_Qt_bar(alpha_t_bar, device=self.device)  # (bs, dx_in, dx_out), (bs, de_in, de_out)
-        assert (abs(Qtb.X.sum(dim=2) - 1.) < 1e-4).all(), Qtb.X.sum(dim=2) - 1
-        assert (abs(Qtb.E.sum(dim=2) - 1.) < 1e-4).all()
+        Qtb = self.get_Qt_bar(t_int)  # (bs, dx_in, dx_out), (bs, de_in, de_out)
+        if utils.should_check('Qt_bar_stochastic'):
+            assert (abs(Qtb.X.sum(dim=2) - 1.) < 1e-4).all(), Qtb.X.sum(dim=2) - 1
+            assert (abs(Qtb.E.sum(dim=2) - 1.) < 1e-4).all()
 
         # Compute transition probabilities
         probX = X @ Qtb.X  # (bs, n, dx_out)
@@ -417,16 +464,20 @@ class DiscreteDenoisingDiffusion(pl.LightningModule):
 
         z_t = utils.PlaceHolder(X=X_t, E=E_t, y=y).type_as(X_t).mask(node_mask)
 
-        noisy_data = {'t_int': t_int, 't': t_float, 'beta_t': beta_t, 'alpha_s_bar': alpha_s_bar,
-                      'alpha_t_bar': alpha_t_bar, 'X_t': z_t.X, 'E_t': z_t.E, 'y_t': z_t.y, 'node_mask': node_mask}
+        noisy_data = {'t_int': t_int, 's_int': s_int, 't': t_float, 'beta_t': beta_t, 'alpha_s_bar': alpha_s_bar,
+                      'alpha_t_bar': alpha_t_bar, 'jump': timesteps is not None, 'X_t': z_t.X, 'E_t': z_t.E,
+                      'y_t': z_t.y, 'node_mask': node_mask}
         return noisy_data
 
-    def compute_val_loss(self, pred, noisy_data, X, E, y, node_mask, test=False):
+    def compute_val_loss(self, pred, noisy_data, X, E, y, node_mask, test=False, pred_fp32=None, num_steps=1):
         """Computes an estimator for the variational lower bound, or the simple loss (MSE).
            pred: (batch_size, n, total_features)
            noisy_data: dict
            X, E, y : (bs, n, dx),  (bs, n, n, de), (bs, dy)
            node_mask : (bs, n)
+           pred_fp32: prediction of the float32 network on the same noisy data, accumulated in val_nll_fp32
+           num_steps: the diffusion term is the KL of one random step of the chain. 1 keeps the per-step estimator,
+                      the number of steps of the sampler estimates the NLL of its whole chain
            Output: nll (size 1)
        """
         t = noisy_data['t']
@@ -439,7 +490,7 @@ class DiscreteDenoisingDiffusion(pl.LightningModule):
         kl_prior = self.kl_prior(X, E, y, node_mask)
 
         # 3. Diffusion loss
-        loss_all_t = self.compute_Lt(X, E, y, pred, noisy_data, node_mask, test)
+        loss_all_t = num_steps * self.compute_Lt(X, E, y, pred, noisy_data, node_mask, test)
 
         # 4. Reconstruction loss
         # Compute L0 term : -log p (X, E, y | z_0) = reconstruction loss
@@ -455,6 +506,12 @@ class DiscreteDenoisingDiffusion(pl.LightningModule):
         # Update NLL metric object and return batch nll
         nll = (self.test_nll if test else self.val_nll)(nlls)        # Average over the batch
 
+        if pred_fp32 is not None:
+            # Only the diffusion term depends on the network, the other terms are shared
+            loss_all_t_fp32 = num_steps * self.compute_Lt(X, E, y, pred_fp32, noisy_data, node_mask, test,
+                                                          kl_metrics=self.val_kl_fp32)
+            self.val_nll_fp32(nlls - loss_all_t + loss_all_t_fp32)
+
         wandb.log({"kl prior": kl_prior.mean(),
                    "Estimator loss terms": loss_all_t.mean(),
                    "log_pn": log_pN.mean(),
@@ -462,11 +519,226 @@ class DiscreteDenoisingDiffusion(pl.LightningModule):
                    'test_nll' if test else 'val_nll': nll}, commit=False)
         return nll
 
-    def forward(self, noisy_data, extra_data, node_mask):
+    def forward(self, noisy_data, extra_data, node_mask, precision=None, candidates=None):
+        """ precision: overrides model.precision. Only the network runs in that precision, its outputs are cast
+            back to float32 so that softmaxes, posteriors and sampling are always computed in float32.
+            candidates: pairs of the sparse edge mode. Training and sampling draw them from E_t. Without them, e.g.
+            for the validation and test NLL, all pairs are predicted, so that true edges outside of the candidates
+            are not scored with the no edge logits of the left out pairs. """
         X = torch.cat((noisy_data['X_t'], extra_data.X), dim=2).float()
         E = torch.cat((noisy_data['E_t'], extra_data.E), dim=3).float()
         y = torch.hstack((noisy_data['y_t'], extra_data.y)).float()
-        return self.model(X, E, y, node_mask)
+        if self.sparse_edges and candidates is None:
+            candidates = utils.all_pairs(node_mask)
+        with utils.network_autocast(X.device, self.network_precision if precision is None else precision):
+            if candidates is None:
+                pred = self.network()(X, E, y, node_mask)
+            else:
+                pred = self.model(X, E, y, node_mask, candidates=candidates)
+        return utils.PlaceHolder(X=pred.X.float(), E=pred.E.float(), y=pred.y.float())
+
+    def network(self):
+        """ The eager network during training, the inference backend otherwise if there is one. """
+        if self.inference_backend is None or torch.is_grad_enabled():
+            return self.model
+        return self.inference_backend
+
+    @torch.no_grad()
+    def export_onnx(self, path, batch_size=4, parity_samples=32, seed=0, atol=1e-4, min_identical=0.95):
+        """ Exports the network to ONNX and the coefficients of the sampler to path + '.sampler.json', then checks the
+            standalone OnnxSampler against the PyTorch sampler: predictions on a noisy batch, then the posteriors and
+            the sampled graphs of every denoising step along a PyTorch sampling trajectory, drawn from the same random
+            state. Raises a RuntimeError if predictions or posteriors differ by more than atol, or if less than
+            min_identical of the sampled steps are identical. Returns the largest differences of the predictions and
+            of the posteriors, and the fraction of identical steps. """
+        if self.sparse_edges:
+            raise ValueError("The ONNX sampler only implements the posterior of dense edges")
+        self.eval()
+        torch.manual_seed(seed)
+        n_nodes = self.node_dist.sample_n(batch_size, self.device)
+        node_mask = torch.arange(torch.max(n_nodes).item(), device=self.device).unsqueeze(0) < n_nodes.unsqueeze(1)
+        z_t = diffusion_utils.sample_discrete_feature_noise(limit_dist=self.limit_dist, node_mask=node_mask)
+        noisy_data = {'X_t': z_t.X, 'E_t': z_t.E, 'y_t': z_t.y, 't': torch.rand(batch_size, 1, device=self.device),
+                      'node_mask': node_mask}
+        extra_data = self.compute_extra_data(noisy_data)
+        export_onnx(self.model, path, noisy_data, extra_data, node_mask)
+        timesteps = diffusion_utils.sampling_timesteps(self.T, self.sampling_steps, self.sampling_spacing)
+        write_sampler_coefficients(path, self.T, timesteps, self.noise_schedule.betas, self.noise_schedule.alphas_bar,
+                                   self.limit_dist.X, self.limit_dist.E, self.node_dist.m.probs,
+                                   one_step=self.sampling_steps is None or self.sampling_steps == self.T,
+                                   exact_posterior=self.exact_sampling_posterior)
+        print(f"Exported the denoiser to {path} and its sampler to {path}.sampler.json")
+
+        def extra_features(data):
+            extra = self.compute_extra_data(data)
+            return extra.X, extra.E, extra.y
+
+        sampler = OnnxSampler(path, extra_features=extra_features)
+        saved_backend = self.inference_backend
+        self.inference_backend = None
+        pred = self.forward(noisy_data, extra_data, node_mask)
+        onnx_X, onnx_E = sampler.predict(z_t.X, z_t.E, z_t.y, noisy_data['t'], node_mask)
+        pred_diff = max((F.softmax(pred.X, dim=-1) - onnx_X).abs().max().item(),
+                        (F.softmax(pred.E, dim=-1) - onnx_E).abs().max().item())
+
+        # Both samplers draw the same graphs from the same random state as long as their posteriors agree
+        torch.manual_seed(seed)
+        state = torch.get_rng_state()
+        n_nodes = self.node_dist.sample_n(parity_samples, self.device)
+        node_mask = torch.arange(torch.max(n_nodes).item()).unsqueeze(0) < n_nodes.unsqueeze(1)
+        z_T = diffusion_utils.sample_discrete_feature_noise(limit_dist=self.limit_dist, node_mask=node_mask)
+        torch.set_rng_state(state)
+        same = [torch.equal(n_nodes, sampler.node_dist.sample((parity_samples,))) and
+                all(torch.equal(a, b) for a, b in zip((z_T.X, z_T.E), sampler.sample_noise(node_mask)))]
+        X, E, y = z_T.X, z_T.E, z_T.y
+        posterior_diff = 0
+        for t_int, s_int in zip(timesteps[:-1], timesteps[1:]):
+            state = torch.get_rng_state()
+            sampled_s, _, _, _, posterior = self.sample_p_zs_given_zt(s_int * torch.ones((parity_samples, 1)) / self.T,
+                                                                      t_int * torch.ones((parity_samples, 1)) / self.T,
+                                                                      X, E, y, node_mask, last_step=False,
+                                                                      return_probs=True)
+            torch.set_rng_state(state)
+            prob_X, prob_E = sampler.posterior(X, E, y, node_mask, s_int, t_int)
+            onnx_s = sampler.sample_step(prob_X, prob_E, node_mask)
+            posterior_diff = max(posterior_diff, (posterior.X - prob_X).abs().max().item(),
+                                 (posterior.E - prob_E).abs().max().item())
+            same.append(torch.equal(sampled_s.X.float(), onnx_s[0]) and torch.equal(sampled_s.E.float(), onnx_s[1]))
+            X, E, y = sampled_s.X, sampled_s.E, sampled_s.y
+        self.inference_backend = saved_backend
+
+        frac_identical = sum(same) / len(same)
+        print(f"ONNX parity: largest difference {pred_diff:.2e} for the predictions, {posterior_diff:.2e} for the "
+              f"posteriors, {sum(same)}/{len(same)} identical sampling steps")
+        if pred_diff > atol or posterior_diff > atol or frac_identical < min_identical:
+            raise RuntimeError(f"The ONNX sampler diverges from the PyTorch sampler (atol {atol}, "
+                               f"min_identical {min_identical})")
+        return pred_diff, posterior_diff, frac_identical
+
+    @torch.no_grad()
+    def compare_inference_backends(self, backends, dataloader, num_samples=512, num_batches=20, seed=0):
+        """ Sampling time, validity, uniqueness and NLL of each inference backend, e.g. against the eager float32
+            network. backends: dict name -> backend, None for the eager network. Returns a dict name -> results. """
+        saved_backend = self.inference_backend
+        results = {}
+        for name, backend in backends.items():
+            self.inference_backend = backend
+            results[name] = self.evaluate_sampler(dataloader, num_samples, num_batches, seed)
+        self.inference_backend = saved_backend
+        self.print_comparison(results)
+        return results
+
+    @torch.no_grad()
+    def compare_sampling_steps(self, steps, dataloader, num_samples=512, num_batches=20, seed=0):
+        """ Sampling time, validity, uniqueness and NLL of the sampler for each number of steps in steps, None for
+            all T steps. The NLL is that of the K-step chain, with the jumps of that sampler, see apply_noise and
+            evaluate_sampler. Returns a dict K -> results. """
+        saved_steps = self.sampling_steps
+        results = {}
+        for K in steps:
+            self.sampling_steps = K
+            timesteps = diffusion_utils.sampling_timesteps(self.T, K, self.sampling_spacing)
+            results[K or self.T] = self.evaluate_sampler(dataloader, num_samples, num_batches, seed,
+                                                         timesteps=timesteps if K is not None else None)
+        self.sampling_steps = saved_steps
+        self.print_comparison(results)
+        return results
+
+    def evaluate_sampler(self, dataloader, num_samples, num_batches, seed, timesteps=None):
+        """ Samples num_samples graphs and computes the NLL of num_batches batches of dataloader, from the same random
+            state at each call. Validity and uniqueness are only computed for molecular datasets.
+            The NLL is that of the whole chain of the sampler, all T steps or those of timesteps: the KL of one random
+            step is scaled by the number of steps, so that it can be compared between samplers. """
+        self.eval()
+        saved_visualization = self.visualization_tools
+        self.visualization_tools = None
+        torch.manual_seed(seed)
+        start = time.time()
+        samples = self.sample_graphs(num_samples, 2 * self.cfg.train.batch_size, number_chain_steps=1)
+        result = {'sampling_time': time.time() - start}
+        self.visualization_tools = saved_visualization
+
+        if hasattr(self.sampling_metrics, 'train_smiles'):
+            _, rdkit_metrics, _ = compute_molecular_metrics(samples, self.sampling_metrics.train_smiles,
+                                                            self.dataset_info, should_check_stability=False,
+                                                            is_frag=getattr(self.sampling_metrics, 'is_frag', False))
+            result['validity'], result['uniqueness'] = rdkit_metrics[0][0], rdkit_metrics[0][2]
+
+        self.on_validation_epoch_start()
+        torch.manual_seed(seed)
+        for i, data in enumerate(dataloader):
+            if i == num_batches:
+                break
+            data = data.to(self.device)
+            dense_data, node_mask = utils.dense_batch(data)
+            noisy_data = self.apply_noise(dense_data.X, dense_data.E, data.y, node_mask, timesteps=timesteps)
+            extra_data = self.compute_extra_data(noisy_data)
+            pred = self.forward(noisy_data, extra_data, node_mask)
+            self.compute_val_loss(pred, noisy_data, dense_data.X, dense_data.E, data.y, node_mask, test=False,
+                                  num_steps=self.T if timesteps is None else len(timesteps) - 1)
+        result['nll'] = self.val_nll.compute().item()
+        return result
+
+    @staticmethod
+    def print_comparison(results):
+        """ Prints each result of evaluate_sampler relative to the first one. """
+        reference = next(iter(results.values()))
+        for name, result in results.items():
+            changes = ' -- '.join(f"{key} {result[key]:.4f} ({result[key] - reference[key]:+.4f})"
+                                  for key in ['validity', 'uniqueness', 'nll'] if key in result)
+            print(f"{name}: sampling {result['sampling_time']:.1f}s "
+                  f"({reference['sampling_time'] / result['sampling_time']:.2f}x speedup) -- {changes}")
+
+    @torch.no_grad()
+    def sample_graphs(self, num_samples, batch_size, samples_to_save=0, chains_to_save=0, number_chain_steps=None):
+        """ Samples num_samples graphs in batches of at most batch_size graphs, and returns them in the order of their
+            node counts, which are all drawn first. With general.size_sorted_sampling, graphs of similar sizes are
+            sampled together, so that batches pad less to their largest graph. The first samples_to_save graphs and
+            chains_to_save chains in draw order are visualized: they are sampled first, in unsorted batches, so that
+            sorting does not restrict the visualizations to the smallest graphs.
+            Sets sampling_stats: padding_ratio, the fraction of padded node pairs in the batches, and molecules_per_sec.
+        """
+        number_chain_steps = self.number_chain_steps if number_chain_steps is None else number_chain_steps
+        n_nodes = self.node_dist.sample_n(num_samples, self.device)
+        num_saved = min(max(samples_to_save, chains_to_save), num_samples)
+        order = torch.arange(num_samples, device=self.device)
+        if self.cfg.general.get('size_sorted_sampling', True):
+            order[num_saved:] = num_saved + torch.sort(n_nodes[num_saved:], stable=True)[1]
+        # The saved graphs get batches of their own, so that they are not mixed with the sorted ones
+        starts = list(range(0, num_saved, batch_size)) + list(range(num_saved, num_samples, batch_size))
+
+        start = time.time()
+        samples = [None] * num_samples
+        padded_pairs = 0
+        active_batch_sizes = None
+        for ident, end in zip(starts, starts[1:] + [num_samples]):
+            print(f'Samples left to generate: {num_samples - ident}/{num_samples}', end='', flush=True)
+            index = order[ident: end]
+            batch_nodes = n_nodes[index]
+            to_save = min(max(samples_to_save - ident, 0), len(index))
+            chains_save = min(max(chains_to_save - ident, 0), len(index))
+            batch = self.sample_batch(batch_id=ident, batch_size=len(index), num_nodes=batch_nodes,
+                                      save_final=to_save, keep_chain=chains_save,
+                                      number_chain_steps=number_chain_steps)
+            for i, sample in zip(index.tolist(), batch):
+                samples[i] = sample
+            padded_pairs += len(index) * batch_nodes.max().item() ** 2
+            active_batch_sizes = self.active_batch_sizes if active_batch_sizes is None else \
+                [a + b for a, b in zip(active_batch_sizes, self.active_batch_sizes)]
+
+        elapsed = time.time() - start
+        self.sampling_stats = {'padding_ratio': 1 - (n_nodes.float() ** 2).sum().item() / padded_pairs,
+                               'molecules_per_sec': num_samples / elapsed,
+                               'active_fraction': sum(active_batch_sizes) / (num_samples * len(active_batch_sizes))}
+        # Number of graphs sampled at each step, summed over the batches
+        self.active_batch_sizes = active_batch_sizes
+        if self.freeze_converged:
+            stride = max(len(active_batch_sizes) // 20, 1)
+            print(f"Active graphs per step (every {stride} steps): {active_batch_sizes[::stride]}, "
+                  f"{100 * self.sampling_stats['active_fraction']:.1f}% of the graph steps were sampled")
+        print(f"Sampled {num_samples} graphs in {elapsed:.1f}s ({self.sampling_stats['molecules_per_sec']:.1f} "
+              f"molecules/s), {100 * self.sampling_stats['padding_ratio']:.1f}% of the node pairs are padding")
+        return samples
 
     @torch.no_grad()
     def sample_batch(self, batch_id: int, batch_size: int, keep_chain: int, number_chain_steps: int,
@@ -497,28 +769,46 @@ class DiscreteDenoisingDiffusion(pl.LightningModule):
         z_T = diffusion_utils.sample_discrete_feature_noise(limit_dist=self.limit_dist, node_mask=node_mask)
         X, E, y = z_T.X, z_T.E, z_T.y
 
-        assert (E == torch.transpose(E, 1, 2)).all()
+        if utils.should_check('z_T_symmetric'):
+            assert (E == torch.transpose(E, 1, 2)).all()
         assert number_chain_steps < self.T
+        timesteps = diffusion_utils.sampling_timesteps(self.T, self.sampling_steps, self.sampling_spacing)
+        num_steps = len(timesteps) - 1
+        number_chain_steps = min(number_chain_steps, num_steps)
         chain_X_size = torch.Size((number_chain_steps, keep_chain, X.size(1)))
         chain_E_size = torch.Size((number_chain_steps, keep_chain, E.size(1), E.size(2)))
 
         chain_X = torch.zeros(chain_X_size)
         chain_E = torch.zeros(chain_E_size)
 
-        # Iteratively sample p(z_s | z_t) for t = 1, ..., T, with s = t - 1.
-        for s_int in reversed(range(0, self.T)):
+        # Graphs still sampled when converged graphs are frozen, and their number of steps without change
+        active = torch.arange(batch_size, device=self.device)
+        unchanged = torch.zeros(batch_size, dtype=torch.long, device=self.device)
+        self.active_batch_sizes = []
+
+        # Iteratively sample p(z_s | z_t) for the consecutive times t > s of the sampler, s = t - 1 with all T steps.
+        for step, (t_int, s_int) in enumerate(zip(timesteps[:-1], timesteps[1:])):
             s_array = s_int * torch.ones((batch_size, 1)).type_as(y)
-            t_array = s_array + 1
+            t_array = t_int * torch.ones((batch_size, 1)).type_as(y)
             s_norm = s_array / self.T
             t_norm = t_array / self.T
 
             # Sample z_s
-            sampled_s, discrete_sampled_s, predicted_graph = self.sample_p_zs_given_zt(t_norm, X, E, y, node_mask,
-                                                                                       last_step=s_int==100)
-            X, E, y = sampled_s.X, sampled_s.E, sampled_s.y
+            self.active_batch_sizes.append(len(active))
+            if self.freeze_converged:
+                if len(active) > 0:
+                    X, E, active, unchanged = self.sample_active_graphs(s_norm, t_norm, X, E, y, node_mask, active,
+                                                                        unchanged)
+                sampled_s = utils.PlaceHolder(X=X, E=E, y=y)
+                discrete_sampled_s = utils.PlaceHolder(X=X, E=E, y=y).mask(node_mask, collapse=True)
+            else:
+                sampled_s, discrete_sampled_s, predicted_graph = self.sample_p_zs_given_zt(s_norm, t_norm, X, E, y,
+                                                                                           node_mask,
+                                                                                           last_step=s_int==100)
+                X, E, y = sampled_s.X, sampled_s.E, sampled_s.y
 
             # Save the first keep_chain graphs
-            write_index = (s_int * number_chain_steps) // self.T
+            write_index = ((num_steps - 1 - step) * number_chain_steps) // num_steps
             chain_X[write_index] = discrete_sampled_s.X[:keep_chain]
             chain_E[write_index] = discrete_sampled_s.E[:keep_chain]
 
@@ -589,23 +879,74 @@ class DiscreteDenoisingDiffusion(pl.LightningModule):
 
         return molecule_list
 
-    def sample_p_zs_given_zt(self, t, X_t, E_t, y_t, node_mask, last_step: bool):
-        """Samples from zs ~ p(zs | zt). Only used during sampling.
-           if last_step, return the graph prediction as well"""
+    def sample_active_graphs(self, s, t, X, E, y, node_mask, active, unchanged):
+        """ Samples z_s for the active graphs of the batch only, see model.freeze_converged. A graph is frozen when none
+            of its entries changed in the last freeze_window steps and its expected number of changes at this step is
+            below freeze_threshold. It is then collapsed to the most likely graph predicted by the network.
+            s, t, X, E, y, node_mask: whole batch. active: indices of the active graphs. unchanged: (bs) number of
+            steps since the last change of each graph. Returns X, E, active and unchanged. """
+        mask = node_mask[active]
+        X_t, E_t = X[active], E[active]
+        sampled_s, _, _, pred, posterior = self.sample_p_zs_given_zt(s[active], t[active], X_t, E_t, y[active], mask,
+                                                                     last_step=False, return_probs=True)
+        pair_mask = utils.to_triu(mask.unsqueeze(1) & mask.unsqueeze(2)).float()
+        changed = ((sampled_s.X != X_t).any(dim=-1) & mask).sum(dim=1) + \
+                  (utils.to_triu((sampled_s.E != E_t).any(dim=-1)) * pair_mask).sum(dim=1)
+        # Expected number of nodes and edges leaving their current state at this step
+        transition_mass = ((1 - (posterior.X * X_t).sum(dim=-1)) * mask).sum(dim=1) + \
+                          ((1 - utils.to_triu((posterior.E * E_t).sum(dim=-1))) * pair_mask).sum(dim=1)
+        X[active], E[active] = sampled_s.X.type_as(X), sampled_s.E.type_as(E)
+        unchanged[active] = torch.where(changed == 0, unchanged[active] + 1, torch.zeros_like(unchanged[active]))
+
+        converged = (unchanged[active] >= self.cfg.model.get('freeze_window', 10)) & \
+                    (transition_mass < self.cfg.model.get('freeze_threshold', 0.01))
+        if converged.any():
+            n = X.shape[1]
+            X_0 = F.one_hot(pred.X[converged].argmax(dim=-1), num_classes=self.Xdim_output).float()
+            E_0 = utils.from_triu(utils.to_triu(pred.E[converged]).argmax(dim=-1), n)
+            E_0 = F.one_hot(E_0, num_classes=self.Edim_output).float()
+            collapsed = utils.PlaceHolder(X=X_0, E=E_0, y=y[active[converged]]).mask(mask[converged])
+            X[active[converged]], E[active[converged]] = collapsed.X.type_as(X), collapsed.E.type_as(E)
+            active = active[~converged]
+        return X, E, active, unchanged
+
+    def sample_p_zs_given_zt(self, s, t, X_t, E_t, y_t, node_mask, last_step: bool, return_probs=False):
+        """Samples from zs ~ p(zs | zt), for any s < t. Only used during sampling.
+           if last_step, return the graph prediction as well
+           if return_probs, also return the predicted distributions of z_0 and the posterior distributions of z_s"""
         bs, n, dxs = X_t.shape
-        beta_t = self.noise_schedule(t_normalized=t)  # (bs, 1)
-        alpha_s_bar = self.noise_schedule.get_alpha_bar(t_normalized=t)
-        alpha_t_bar = self.noise_schedule.get_alpha_bar(t_normalized=t)
-
-        # Retrieve transitions matrix
-        Qtb = self.transition_model.get_Qt_bar(alpha_t_bar, self.device)
-        Qsb = self.transition_model.get_Qt_bar(alpha_s_bar, self.device)
-        Qt = self.transition_model.get_Qt(beta_t, self.device)
+        s_int = torch.round(s * self.T)
+        t_int = torch.round(t * self.T)
+
+        one_step = self.sampling_steps is None or self.sampling_steps == self.T
+        # The original all-step sampler takes Qsb at t, model.exact_sampling_posterior takes it at s
+        s_bar_int = t_int if one_step and not self.exact_sampling_posterior else s_int
+        if self.low_rank_posterior:
+            # Transitions are a * I + (1 - a) * 1 m^T, only their coefficients are needed
+            alpha_s_bar = self.noise_schedule.get_alpha_bar(t_int=s_bar_int)
+            alpha_t_bar = self.noise_schedule.get_alpha_bar(t_int=t_int)
+            alpha_t = 1 - self.noise_schedule(t_int=t_int) if one_step else alpha_t_bar / alpha_s_bar
+            transitions_X = transitions_E = (alpha_t, alpha_s_bar, alpha_t_bar)
+        else:
+            # Retrieve transitions matrix
+            Qtb = self.get_Qt_bar(t_int)
+            Qsb = self.get_Qt_bar(s_bar_int)
+            if one_step:
+                Qt = self.get_Qt(t_int)
+            else:
+                # Both transitions are closed under products: Q_t|s = Q_s+1 ... Q_t has noise
+                # 1 - alpha_t_bar / alpha_s_bar
+                alpha_s_bar = self.noise_schedule.get_alpha_bar(t_int=s_int)
+                alpha_t_bar = self.noise_schedule.get_alpha_bar(t_int=t_int)
+                Qt = self.transition_model.get_Qt(1 - alpha_t_bar / alpha_s_bar, self.device)
+            transitions_X = (Qt.X, Qsb.X, Qtb.X)
+            transitions_E = (Qt.E, Qsb.E, Qtb.E)
 
         # Neural net predictions
         noisy_data = {'X_t': X_t, 'E_t': E_t, 'y_t': y_t, 't': t, 'node_mask': node_mask}
         extra_data = self.compute_extra_data(noisy_data)
-        pred = self.forward(noisy_data, extra_data, node_mask)
+        candidates = self.candidate_pairs(E_t, node_mask) if self.sparse_edges else None
+        pred = self.forward(noisy_data, extra_data, node_mask, candidates=candidates)
 
         # Normalize predictions
         pred_X = F.softmax(pred.X, dim=-1)               # bs, n, d0
@@ -613,46 +954,84 @@ class DiscreteDenoisingDiffusion(pl.LightningModule):
 
         if last_step:
             predicted_graph = diffusion_utils.sample_discrete_features(pred_X, pred_E, node_mask=node_mask)
+        pred_probs = utils.PlaceHolder(X=pred_X, E=pred_E, y=pred.y)
 
-        p_s_and_t_given_0_X = diffusion_utils.compute_batched_over0_posterior_distribution(X_t=X_t,
-                                                                                           Qt=Qt.X,
-                                                                                           Qsb=Qsb.X,
-                                                                                           Qtb=Qtb.X)
-
-        p_s_and_t_given_0_E = diffusion_utils.compute_batched_over0_posterior_distribution(X_t=E_t,
-                                                                                           Qt=Qt.E,
-                                                                                           Qsb=Qsb.E,
-                                                                                           Qtb=Qtb.E)
-        # Dim of these two tensors: bs, N, d0, d_t-1
-        weighted_X = pred_X.unsqueeze(-1) * p_s_and_t_given_0_X         # bs, n, d0, d_t-1
-        unnormalized_prob_X = weighted_X.sum(dim=2)                     # bs, n, d_t-1
+        unnormalized_prob_X = self.mixed_posterior(X_t, pred_X, transitions_X, self.x_marginals)   # bs, n, d_t-1
         unnormalized_prob_X[torch.sum(unnormalized_prob_X, dim=-1) == 0] = 1e-5
         prob_X = unnormalized_prob_X / torch.sum(unnormalized_prob_X, dim=-1, keepdim=True)  # bs, n, d_t-1
 
-        pred_E = pred_E.reshape((bs, -1, pred_E.shape[-1]))
-        weighted_E = pred_E.unsqueeze(-1) * p_s_and_t_given_0_E        # bs, N, d0, d_t-1
-        unnormalized_prob_E = weighted_E.sum(dim=-2)
-        unnormalized_prob_E[torch.sum(unnormalized_prob_E, dim=-1) == 0] = 1e-5
-        prob_E = unnormalized_prob_E / torch.sum(unnormalized_prob_E, dim=-1, keepdim=True)
-        prob_E = prob_E.reshape(bs, n, n, pred_E.shape[-1])
+        if candidates is None:
+            pred_E = pred_E.reshape((bs, -1, pred_E.shape[-1]))
+            unnormalized_prob_E = self.mixed_posterior(E_t.flatten(start_dim=1, end_dim=2), pred_E, transitions_E,
+                                                       self.e_marginals)                 # bs, N, d_t-1
+            unnormalized_prob_E[torch.sum(unnormalized_prob_E, dim=-1) == 0] = 1e-5
+            prob_E = unnormalized_prob_E / torch.sum(unnormalized_prob_E, dim=-1, keepdim=True)
+            prob_E = prob_E.reshape(bs, n, n, pred_E.shape[-1])
+        else:
+            prob_E = self.candidate_posterior_E(E_t, pred_E, candidates, transitions_E)
 
-        assert ((prob_X.sum(dim=-1) - 1).abs() < 1e-4).all()
-        assert ((prob_E.sum(dim=-1) - 1).abs() < 1e-4).all()
+        if utils.should_check('posterior_normalized'):
+            assert ((prob_X.sum(dim=-1) - 1).abs() < 1e-4).all()
+            assert ((prob_E.sum(dim=-1) - 1).abs() < 1e-4).all()
+        posterior = utils.PlaceHolder(X=prob_X, E=prob_E, y=None)
 
         sampled_s = diffusion_utils.sample_discrete_features(prob_X, prob_E, node_mask=node_mask)
 
         X_s = F.one_hot(sampled_s.X, num_classes=self.Xdim_output).float()
         E_s = F.one_hot(sampled_s.E, num_classes=self.Edim_output).float()
 
-        assert (E_s == torch.transpose(E_s, 1, 2)).all()
+        if utils.should_check('E_s_symmetric'):
+            assert (E_s == torch.transpose(E_s, 1, 2)).all()
         assert (X_t.shape == X_s.shape) and (E_t.shape == E_s.shape)
 
         out_one_hot = utils.PlaceHolder(X=X_s, E=E_s, y=torch.zeros(y_t.shape[0], 0))
         out_discrete = utils.PlaceHolder(X=X_s, E=E_s, y=torch.zeros(y_t.shape[0], 0))
 
+        if return_probs:
+            return out_one_hot.mask(node_mask).type_as(y_t), out_discrete.mask(node_mask, collapse=True).type_as(y_t), \
+                   predicted_graph if last_step else None, pred_probs, posterior
         return out_one_hot.mask(node_mask).type_as(y_t), out_discrete.mask(node_mask, collapse=True).type_as(y_t), \
                predicted_graph if last_step else None
 
+    def mixed_posterior(self, M_t, pred, transitions, marginals):
+        """ Unnormalized distribution of M_s given M_t, mixed over the predicted distribution pred of M_0.
+            M_t, pred: bs, N, d. transitions: (alpha_t, alpha_s_bar, alpha_t_bar), each bs, 1, with the low rank
+            posterior, (Qt, Qsb, Qtb), each bs, d, d, otherwise. Returns bs, N, d_t-1. """
+        if self.low_rank_posterior:
+            return diffusion_utils.low_rank_posterior_distribution(M_t, pred, marginals, *transitions)
+        return diffusion_utils.mixed_posterior_distribution(M_t, pred, *transitions)
+
+    def get_Qt(self, t_int):
+        """ One-step transition matrices from t - 1 to t, for the integer timesteps t_int (bs, 1). """
+        if self.transition_tables is not None:
+            return self.transition_tables.get_Qt(t_int)
+        return self.transition_model.get_Qt(self.noise_schedule(t_int=t_int), self.device)
+
+    def get_Qt_bar(self, t_int):
+        """ Transition matrices from 0 to t, for the integer timesteps t_int (bs, 1). """
+        if self.transition_tables is not None:
+            return self.transition_tables.get_Qt_bar(t_int)
+        return self.transition_model.get_Qt_bar(self.noise_schedule.get_alpha_bar(t_int=t_int), self.device)
+
+    def candidate_pairs(self, E_t, node_mask):
+        """ Pairs that get an edge state in the sparse edge mode, drawn again at every step. """
+        return utils.candidate_pairs(E_t, node_mask, k_hop=self.cfg.model.get('sparse_k_hop', 2),
+                                     num_random=self.cfg.model.get('sparse_random_pairs', 8))
+
+    def candidate_posterior_E(self, E_t, pred_E, candidates, transitions):
+        """ Distribution of E_s in the sparse edge mode. The posterior is only computed for the candidate pairs,
+            as a batch of single pairs, and the other pairs stay without edge.
+            pred_E: bs, n, n, d0 predicted probabilities. transitions: see mixed_posterior. Returns bs, n, n, d_t-1. """
+        b, i, j = candidates[:, candidates[1] != candidates[2]]
+        unnormalized_prob = self.mixed_posterior(E_t[b, i, j].unsqueeze(1), pred_E[b, i, j].unsqueeze(1),
+                                                 tuple(q[b] for q in transitions), self.e_marginals)[:, 0]  # M, d_t-1
+        unnormalized_prob[torch.sum(unnormalized_prob, dim=-1) == 0] = 1e-5
+
+        prob_E = torch.zeros_like(pred_E)
+        prob_E[..., 0] = 1
+        prob_E[b, i, j] = unnormalized_prob / torch.sum(unnormalized_prob, dim=-1, keepdim=True)
+        return prob_E
+
     def compute_extra_data(self, noisy_data):
         """ At every training step (after adding noise) and step in sampling, compute extra information and append to
             the network input. """
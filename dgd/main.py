@@ -36,6 +36,7 @@ from dgd.metrics.molecular_metrics import TrainMolecularMetrics, SamplingMolecul
 from dgd.analysis.visualization import MolecularVisualization, FragmentVisualization, NonMolecularVisualization
 from dgd.diffusion.extra_features import DummyExtraFeatures, ExtraFeatures
 from dgd.diffusion.extra_features_molecular import ExtraMolecularFeatures
+from dgd.models.inference import make_backend
 
 warnings.filterwarnings("ignore", category=PossibleUserWarning)
 
@@ -126,6 +127,10 @@ def main(cfg: DictConfig):
     if 'seed' in cfg.general and cfg.general.seed is not None:
         seed_everything(cfg.general.seed)
 
+    # Debug and test runs check all tensors, other runs follow general.check_level
+    check_level = 'full' if cfg.general.name in ['debug', 'test'] else cfg.general.get('check_level', 'sampled')
+    utils.set_check_level(check_level, interval=cfg.general.get('check_interval', 100))
+
     if dataset_config["name"] in ['sbm', 'comm-20', 'planar']:
         if dataset_config['name'] == 'sbm':
             datamodule = SBMDataModule(cfg)
@@ -237,9 +242,16 @@ def main(cfg: DictConfig):
     else:
         raise NotImplementedError("Unknown dataset {}".format(cfg["dataset"]))
 
+    export_path = cfg.general.get('export_onnx', None)
+    compare_backends = cfg.general.get('compare_backends', None)
+    compare_steps = cfg.general.get('compare_sampling_steps', None)
     if cfg.general.test_only:
         # When testing, previous configuration is fully loaded
-        cfg, _ = get_resume(cfg, model_kwargs)
+        cfg, resumed_model = get_resume(cfg, model_kwargs)
+        if export_path is not None:
+            assert cfg.model.type == 'discrete', "ONNX export is only implemented for the discrete model"
+            resumed_model.to('cpu').export_onnx(os.path.abspath(export_path))
+            return
         os.chdir(cfg.general.test_only.split('checkpoints')[0])
     elif cfg.general.resume is not None:
         # When resuming, we can override some parts of previous configuration
@@ -249,6 +261,24 @@ def main(cfg: DictConfig):
     utils.create_folders(cfg)
     cfg = setup_wandb(cfg)
 
+    if cfg.general.test_only and compare_backends is not None:
+        # Sampling speed and quality of each backend against the eager float32 network, on the cpu
+        resumed_model.to('cpu')
+        backends = {'fp32': None}
+        backends.update({name: make_backend(name, resumed_model.model, cfg) for name in compare_backends})
+        resumed_model.compare_inference_backends(backends, datamodule.val_dataloader(),
+                                                 num_samples=cfg.general.samples_to_generate)
+        return
+
+    if cfg.general.test_only and compare_steps is not None:
+        # Sampling speed and quality of the sampler with fewer steps than the diffusion
+        assert cfg.model.type == 'discrete', "Sampling with fewer steps is only implemented for the discrete model"
+        if torch.cuda.is_available() and cfg.general.gpus > 0:
+            resumed_model.to('cuda')
+        resumed_model.compare_sampling_steps(list(compare_steps), datamodule.val_dataloader(),
+                                             num_samples=cfg.general.samples_to_generate)
+        return
+
     if cfg.model.type == 'discrete':
         model = DiscreteDenoisingDiffusion(cfg=cfg, **model_kwargs)
     else:
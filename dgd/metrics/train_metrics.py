@@ -73,10 +73,10 @@ class TrainLossDiscrete(nn.Module):
     def forward(self, masked_pred_X, masked_pred_E, pred_y, true_X, true_E, true_y, log: bool):
         """ Compute train metrics
         masked_pred_X : tensor -- (bs, n, dx)
-        masked_pred_E : tensor -- (bs, n, n, de)
+        masked_pred_E : tensor -- (bs, n, n, de), or (bs, n * (n - 1) / 2, de) upper triangular pairs
         pred_y : tensor -- (bs, )
         true_X : tensor -- (bs, n, dx)
-        true_E : tensor -- (bs, n, n, de)
+        true_E : tensor -- same shape as masked_pred_E
         true_y : tensor -- (bs, )
         log : boolean. """
         true_X = torch.reshape(true_X, (-1, true_X.size(-1)))  # (bs * n, dx)
@@ -99,11 +99,14 @@ class TrainLossDiscrete(nn.Module):
         loss_y = self.y_loss(pred_y, true_y) if true_y.numel() > 0 else 0.0
 
 
+        # Each term is averaged over the nodes (edges) of this batch only, so that the scale of the loss does not
+        # depend on the number of graphs when batch sizes vary. Epoch metrics are averaged over all nodes (edges).
         if log:
             to_log = {"train_loss/batch_CE": (loss_X + loss_E + loss_y).detach(),
-                      "train_loss/X_CE": self.edge_loss.compute() if true_X.numel() > 0 else -1,
+                      "train_loss/X_CE": loss_X if true_X.numel() > 0 else -1,
                       "train_loss/E_CE": loss_E if true_E.numel() > 0 else -1,
-                      "train_loss/y_CE": self.node_loss.compute() if true_y.numel() > 0 else -1}
+                      "train_loss/y_CE": loss_y if true_y.numel() > 0 else -1,
+                      "train_loss/batch_size": true_y.size(0)}
             wandb.log(to_log, commit=True)
         return loss_X + self.lambda_train[0] * loss_E + self.lambda_train[1] * loss_y
 
@@ -114,7 +117,7 @@ class TrainLossDiscrete(nn.Module):
     def log_epoch_metrics(self, current_epoch, start_epoch_time):
         epoch_node_loss = self.node_loss.compute() if self.node_loss.total_samples > 0 else -1
         epoch_edge_loss = self.edge_loss.compute() if self.edge_loss.total_samples > 0 else -1
-        epoch_y_loss = self.train_y_loss.compute() if self.y_loss.total_samples > 0 else -1
+        epoch_y_loss = self.y_loss.compute() if self.y_loss.total_samples > 0 else -1
 
         to_log = {"train_epoch/x_CE": epoch_node_loss,
                   "train_epoch/E_CE": epoch_edge_loss,
@@ -0,0 +1,225 @@
+import copy
+import json
+import warnings
+from collections import OrderedDict
+
+import torch
+import torch.nn as nn
+
+from dgd import utils
+
+
+class DenoiserModule(nn.Module):
+    """ GraphTransformer with tensor outputs, X, E and y, instead of a PlaceHolder, so that it can be traced. """
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, X, E, y, node_mask):
+        pred = self.model(X, E, y, node_mask)
+        return pred.X, pred.E, pred.y
+
+
+class CompiledDenoiser:
+    """ Inference backend that runs a TorchScript trace of the transformer, one per input signature.
+
+        A signature is the shape of X, E and y (batch size, n_max and feature dims), their dtype and device. The
+        first call with a signature traces the network and the trace is reused for all the following calls, e.g.
+        the T denoising steps of a sampling batch. At most cache_size traces are kept, the least recently used one
+        is dropped first. Calls that cannot be traced run the eager model: packed mode, whose shapes depend on the
+        node mask, and autocast, which is not captured by tracing.
+        With batch_buckets, the batch size is rounded up to the smallest bucket that holds it and the batch is padded
+        with empty graphs, so that a few traces serve all the batch sizes of frozen sampling. The graphs of a dense
+        batch are independent, so the predictions are those of the eager model. node_buckets do the same for n_max
+        with masked nodes, but those enter the pooled statistics (Xtoy, Etoy) and the attention of the dense network,
+        so the predictions differ from those at the exact n_max: they are off unless given. Shapes larger than the
+        largest bucket run the eager model. Without buckets, each exact shape gets its own trace.
+        Traces share the parameters of the model, so they follow in place updates of the weights. They are rebuilt
+        if the parameters are replaced, e.g. by moving the model to another device.
+    """
+    def __init__(self, model, cache_size=8, node_buckets=None, batch_buckets=None):
+        self.model = model
+        self.module = DenoiserModule(model)
+        self.cache_size = cache_size
+        self.node_buckets = sorted(node_buckets) if node_buckets else None
+        self.batch_buckets = sorted(batch_buckets) if batch_buckets else None
+        self.cache = OrderedDict()
+
+    def traceable(self):
+        if getattr(self.model, 'packed', False):
+            return False
+        return not autocast_enabled()
+
+    def signature(self, X, E, y):
+        weights = next(self.model.parameters()).data_ptr()
+        return tuple(X.shape), tuple(E.shape), tuple(y.shape), X.dtype, str(X.device), weights
+
+    @staticmethod
+    def bucket(size, buckets):
+        """ Smallest bucket that holds size, size itself without buckets, or None if no bucket is large enough. """
+        if buckets is None:
+            return size
+        return next((b for b in buckets if b >= size), None)
+
+    def __call__(self, X, E, y, node_mask):
+        if self.model.training or self.cache_size == 0 or not self.traceable():
+            return self.model(X, E, y, node_mask)
+        bs, n = X.shape[:2]
+        padded_bs, padded_n = self.bucket(bs, self.batch_buckets), self.bucket(n, self.node_buckets)
+        if padded_bs is None or padded_n is None:
+            return self.model(X, E, y, node_mask)
+        if (padded_bs, padded_n) != (bs, n):
+            X, E, y, node_mask = pad_inputs(X, E, y, node_mask, padded_bs, padded_n)
+        key = self.signature(X, E, y)
+        if key in self.cache:
+            self.cache.move_to_end(key)
+        else:
+            if len(self.cache) >= self.cache_size:
+                self.cache.popitem(last=False)
+            self.cache[key] = self.trace(X, E, y, node_mask)
+        X, E, y = self.cache[key](X, E, y, node_mask)
+        return utils.PlaceHolder(X=X[:bs, :n], E=E[:bs, :n, :n], y=y[:bs])
+
+    def trace(self, X, E, y, node_mask):
+        # Asserts on the values of the inputs are evaluated once while tracing, which is reported as a warning
+        with warnings.catch_warnings():
+            warnings.filterwarnings('ignore', category=torch.jit.TracerWarning)
+            return torch.jit.trace(self.module, (X, E, y, node_mask), check_trace=False)
+
+
+def pad_inputs(X, E, y, node_mask, batch_size, n_max):
+    """ Pads a dense batch to batch_size graphs of n_max nodes. Padding nodes are masked and padding graphs empty. """
+    bs, n = X.shape[:2]
+    padded_X = X.new_zeros((batch_size, n_max, X.size(2)))
+    padded_E = E.new_zeros((batch_size, n_max, n_max, E.size(3)))
+    padded_y = y.new_zeros((batch_size, y.size(1)))
+    padded_mask = node_mask.new_zeros((batch_size, n_max))
+    padded_X[:bs, :n], padded_E[:bs, :n, :n], padded_y[:bs], padded_mask[:bs, :n] = X, E, y, node_mask
+    return padded_X, padded_E, padded_y, padded_mask
+
+
+def autocast_enabled():
+    return torch.is_autocast_enabled() or torch.is_autocast_cpu_enabled()
+
+
+def quantize_dynamic(model):
+    """ Copy of a GraphTransformer whose transformer layers use dynamic int8 quantization for their Linear layers:
+        attention projections, FiLM and output layers of NodeEdgeBlock, and the feed forward networks.
+        LayerNorms, softmaxes and the input and output MLPs stay in float32. """
+    quantized = copy.deepcopy(model).eval()
+    quantized.tf_layers = torch.quantization.quantize_dynamic(quantized.tf_layers, {nn.Linear}, dtype=torch.qint8)
+    return quantized
+
+
+class QuantizedDenoiser:
+    """ Inference backend that runs a dynamically quantized copy of the transformer on the cpu, see quantize_dynamic.
+
+        The copy is made on the first call and made again when the weights of the model change, e.g. after a
+        training epoch or when a checkpoint is loaded. Inputs on another device and autocast use the eager model.
+    """
+    def __init__(self, model):
+        self.model = model
+        self.quantized = None
+        self.weights_version = None
+
+    def __call__(self, X, E, y, node_mask):
+        if self.model.training or X.device.type != 'cpu' or autocast_enabled():
+            return self.model(X, E, y, node_mask)
+        # The version of a tensor increases with each in place update
+        version = tuple(param._version for param in self.model.parameters())
+        if self.quantized is None or version != self.weights_version:
+            self.quantized = quantize_dynamic(self.model)
+            self.weights_version = version
+        return self.quantized(X, E, y, node_mask)
+
+
+class ExportedDenoiser(nn.Module):
+    """ Network of the diffusion model with the noisy graph and the extra features as separate inputs. """
+    input_names = ['X_t', 'E_t', 'y_t', 'extra_X', 'extra_E', 'extra_y', 'node_mask']
+    output_names = ['X', 'E', 'y']
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, X_t, E_t, y_t, extra_X, extra_E, extra_y, node_mask):
+        X = torch.cat((X_t, extra_X), dim=2)
+        E = torch.cat((E_t, extra_E), dim=3)
+        y = torch.hstack((y_t, extra_y))
+        pred = self.model(X, E, y, node_mask.float())
+        return pred.X, pred.E, pred.y
+
+
+def export_onnx(model, path, noisy_data, extra_data, node_mask, opset_version=13):
+    """ Writes the network to path in the ONNX format, with dynamic batch and node axes.
+
+        noisy_data (X_t, E_t and y_t), extra_data and node_mask are an example batch. The feature dims of each input
+        are written to path + '.json', which OnnxDenoiser uses to split the concatenated inputs of the network.
+        Only the default dense mode of GraphTransformer can be exported.
+    """
+    if getattr(model, 'packed', False) or getattr(model, 'symmetric_edges', False):
+        raise ValueError("Only the dense GraphTransformer can be exported to ONNX")
+    # The noisy y of sampling is an empty integer tensor, the network is run on float32 inputs
+    features = (noisy_data['X_t'], noisy_data['E_t'], noisy_data['y_t'], extra_data.X, extra_data.E, extra_data.y)
+    inputs = tuple(tensor.float() for tensor in features) + (node_mask.bool(),)
+    nodes = {0: 'batch', 1: 'nodes'}
+    pairs = {0: 'batch', 1: 'nodes', 2: 'nodes'}
+    dynamic_axes = {'X_t': nodes, 'E_t': pairs, 'y_t': {0: 'batch'}, 'extra_X': nodes, 'extra_E': pairs,
+                    'extra_y': {0: 'batch'}, 'node_mask': nodes, 'X': nodes, 'E': pairs, 'y': {0: 'batch'}}
+    module = ExportedDenoiser(model).eval()
+    with torch.no_grad(), warnings.catch_warnings():
+        warnings.filterwarnings('ignore', category=torch.jit.TracerWarning)
+        torch.onnx.export(module, inputs, path, input_names=ExportedDenoiser.input_names,
+                          output_names=ExportedDenoiser.output_names, dynamic_axes=dynamic_axes,
+                          opset_version=opset_version)
+    dims = {name: tensor.shape[-1] for name, tensor in zip(ExportedDenoiser.input_names[:-1], inputs)}
+    with open(path + '.json', 'w') as f:
+        json.dump(dims, f)
+
+
+class OnnxDenoiser:
+    """ Inference backend that runs an exported network with onnxruntime on the cpu.
+
+        Called like the network, with the concatenation of the noisy graph and the extra features, which are split
+        again with the dims saved by export_onnx. Outputs are moved back to the device of the inputs.
+    """
+    def __init__(self, path, num_threads=None):
+        import onnxruntime
+        options = onnxruntime.SessionOptions()
+        if num_threads is not None:
+            options.intra_op_num_threads = num_threads
+        self.session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        with open(path + '.json', 'r') as f:
+            self.dims = json.load(f)
+
+    def __call__(self, X, E, y, node_mask):
+        dx, de, dy = self.dims['X_t'], self.dims['E_t'], self.dims['y_t']
+        inputs = {'X_t': X[..., :dx], 'E_t': E[..., :de], 'y_t': y[..., :dy],
+                  'extra_X': X[..., dx:], 'extra_E': E[..., de:], 'extra_y': y[..., dy:]}
+        inputs = {name: tensor.detach().float().cpu().numpy() for name, tensor in inputs.items()}
+        inputs['node_mask'] = node_mask.bool().cpu().numpy()
+        X, E, y = [torch.from_numpy(out).to(X.device) for out in self.session.run(None, inputs)]
+        return utils.PlaceHolder(X=X, E=E, y=y)
+
+
+def make_backend(backend, model, cfg):
+    """ Inference backend called backend ('jit', 'onnx' or 'quantized') for the network model, or None for None. """
+    if backend is None:
+        return None
+    if cfg.model.get('sparse_edges', False):
+        # The backends run the dense network, without the candidate pairs that change at every step
+        raise ValueError(f"The inference backend {backend} cannot be used with model.sparse_edges")
+    if backend == 'jit':
+        return CompiledDenoiser(model, cache_size=cfg.model.get('inference_cache_size', 8),
+                                node_buckets=cfg.model.get('inference_node_buckets', None),
+                                batch_buckets=cfg.model.get('inference_batch_buckets', None))
+    if backend == 'onnx':
+        return OnnxDenoiser(cfg.model.onnx_path, num_threads=cfg.model.get('onnx_threads', None))
+    if backend == 'quantized':
+        return QuantizedDenoiser(model)
+    raise ValueError(f"Unknown inference backend {backend}")
+
+
+def inference_backend(cfg, model):
+    """ Backend that replaces the eager network outside of training, or None to always use the eager network. """
+    return make_backend(cfg.model.get('inference_backend', None), model, cfg)
@@ -1,5 +1,17 @@
 import torch
 import torch.nn as nn
+from torch_scatter import scatter_add, scatter_max, scatter_mean, scatter_min
+
+
+def segment_statistics(x, index, num_segments):
+    """ Mean, min, max and unbiased std of the rows of x grouped by index. x: N, d. Returns num_segments, 4 * d. """
+    m = scatter_mean(x, index, dim=0, dim_size=num_segments)
+    mi = scatter_min(x, index, dim=0, dim_size=num_segments)[0]
+    ma = scatter_max(x, index, dim=0, dim_size=num_segments)[0]
+    count = scatter_add(torch.ones_like(index, dtype=x.dtype), index, dim=0, dim_size=num_segments)
+    var = scatter_add((x - m[index]) ** 2, index, dim=0, dim_size=num_segments)
+    std = (var / (count - 1).clamp(min=1).unsqueeze(-1)).sqrt()
+    return torch.hstack((m, mi, ma, std))
 
 
 class Xtoy(nn.Module):
@@ -8,8 +20,10 @@ class Xtoy(nn.Module):
         super().__init__()
         self.lin = nn.Linear(4 * dx, dy)
 
-    def forward(self, X):
-        """ X: bs, n, dx. """
+    def forward(self, X, index=None, num_graphs=None):
+        """ X: bs, n, dx, or num_nodes, dx packed node features with index the graph of each node. """
+        if index is not None:
+            return self.lin(segment_statistics(X, index, num_graphs))
         m = X.mean(dim=1)
         mi = X.min(dim=1)[0]
         ma = X.max(dim=1)[0]
@@ -25,10 +39,15 @@ class Etoy(nn.Module):
         super().__init__()
         self.lin = nn.Linear(4 * d, dy)
 
-    def forward(self, E):
-        """ E: bs, n, n, de
+    def forward(self, E, index=None, num_graphs=None):
+        """ E: bs, n, n, de, or bs, n * (n - 1) / 2, de for upper triangular edge features, or num_pairs, de
+            packed pair features with index the graph of each pair.
             Features relative to the diagonal of E could potentially be added.
         """
+        if index is not None:
+            return self.lin(segment_statistics(E, index, num_graphs))
+        if E.dim() == 3:
+            E = E.unsqueeze(2)
         m = E.mean(dim=(1, 2))
         mi = E.min(dim=2)[0].min(dim=1)[0]
         ma = E.max(dim=2)[0].max(dim=1)[0]
@@ -7,12 +7,18 @@ from torch.nn.modules.linear import Linear
 from torch.nn.modules.normalization import LayerNorm
 from torch.nn import functional as F
 from torch import Tensor
+from torch.utils.checkpoint import checkpoint
+from torch_geometric.utils import softmax
 
 from dgd import utils
 from dgd.diffusion import diffusion_utils
 from dgd.models.layers import Xtoy, Etoy
 
 
+# Logit of the no edge type predicted for the pairs left out by the sparse edge mode, the other types get 0
+NO_EDGE_LOGIT = 20.
+
+
 class XEyTransformerLayer(nn.Module):
     """ Transformer that updates node, edge and global features
         d_x: node features
@@ -25,11 +31,11 @@ class XEyTransformerLayer(nn.Module):
     """
     def __init__(self, dx: int, de: int, dy: int, n_head: int, dim_ffX: int = 2048,
                  dim_ffE: int = 128, dim_ffy: int = 2048, dropout: float = 0.1,
-                 layer_norm_eps: float = 1e-5, device=None, dtype=None) -> None:
+                 layer_norm_eps: float = 1e-5, attention_chunk_size=None, device=None, dtype=None) -> None:
         kw = {'device': device, 'dtype': dtype}
         super().__init__()
 
-        self.self_attn = NodeEdgeBlock(dx, de, dy, n_head, **kw)
+        self.self_attn = NodeEdgeBlock(dx, de, dy, n_head, attention_chunk_size=attention_chunk_size, **kw)
 
         self.linX1 = Linear(dx, dim_ffX, **kw)
         self.linX2 = Linear(dim_ffX, dx, **kw)
@@ -57,16 +63,19 @@ class XEyTransformerLayer(nn.Module):
 
         self.activation = F.relu
 
-    def forward(self, X: Tensor, E: Tensor, y, node_mask: Tensor):
+    def forward(self, X: Tensor, E: Tensor, y, node_mask: Tensor, pair_index=None, packed=None):
         """ Pass the input through the encoder layer.
-            X: (bs, n, d)
-            E: (bs, n, n, d)
+            X: (bs, n, d), or (num_nodes, d) if packed is given
+            E: (bs, n, n, d), or (bs, n * (n - 1) / 2, d) upper triangular pairs if pair_index is given,
+               or (num_pairs, d) if packed is given
             y: (bs, dy)
             node_mask: (bs, n) Mask for the src keys per batch (optional)
+            pair_index: (n, n) see utils.triu_pair_index
+            packed: utils.PackedGraphs of the batch
             Output: newX, newE, new_y with the same shape.
         """
 
-        newX, newE, new_y = self.self_attn(X, E, y, node_mask=node_mask)
+        newX, newE, new_y = self.self_attn(X, E, y, node_mask=node_mask, pair_index=pair_index, packed=packed)
 
         newX_d = self.dropoutX1(newX)
         X = self.normX1(X + newX_d)
@@ -93,9 +102,13 @@ class XEyTransformerLayer(nn.Module):
 
 
 class NodeEdgeBlock(nn.Module):
-    """ Self attention layer that also updates the representations on the edges. """
-    def __init__(self, dx, de, dy, n_head, **kwargs):
+    """ Self attention layer that also updates the representations on the edges.
+        attention_chunk_size: if not None, the attention is computed for blocks of that many query rows at a time,
+        which lowers the peak memory from O(bs * n^2 * dx) to O(bs * chunk_size * n * dx).
+    """
+    def __init__(self, dx, de, dy, n_head, attention_chunk_size=None, **kwargs):
         super().__init__()
+        self.attention_chunk_size = attention_chunk_size
         assert dx % n_head == 0, f"dx: {dx} -- nhead: {n_head}"
         self.dx = dx
         self.de = de
@@ -130,17 +143,19 @@ class NodeEdgeBlock(nn.Module):
         self.e_out = Linear(dx, de)
         self.y_out = nn.Sequential(nn.Linear(dy, dy), nn.ReLU(), nn.Linear(dy, dy))
 
-    def forward(self, X, E, y, node_mask):
+    def forward(self, X, E, y, node_mask, pair_index=None, packed=None):
         """
         :param X: bs, n, d        node features
-        :param E: bs, n, n, d     edge features
+        :param E: bs, n, n, d     edge features, or bs, n * (n - 1) / 2, d upper triangular pairs with pair_index
         :param y: bs, dz           global features
         :param node_mask: bs, n
+        :param pair_index: n, n   position of each pair in the upper triangular layout, see utils.triu_pair_index
+        :param packed: utils.PackedGraphs. X and E are then packed, see forward_packed
         :return: newX, newE, new_y with the same shape.
         """
+        if packed is not None:
+            return self.forward_packed(X, E, y, packed)
         x_mask = node_mask.unsqueeze(-1)        # bs, n, 1
-        e_mask1 = x_mask.unsqueeze(2)           # bs, n, 1, 1
-        e_mask2 = x_mask.unsqueeze(1)           # bs, 1, n, 1
 
         # 1. Map X to keys and queries
         Q = self.q(X) * x_mask           # (bs, n, dx)
@@ -151,43 +166,46 @@ class NodeEdgeBlock(nn.Module):
         Q = Q.reshape((Q.size(0), Q.size(1), self.n_head, self.df))
         K = K.reshape((K.size(0), K.size(1), self.n_head, self.df))
 
-        Q = Q.unsqueeze(2)                              # (bs, 1, n, n_head, df)
-        K = K.unsqueeze(1)                              # (bs, n, 1, n head, df)
-
-        # Compute unnormalized attentions. Y is (bs, n, n, n_head, df)
-        Y = Q * K
-        Y = Y / math.sqrt(Y.size(-1))
-        diffusion_utils.assert_correctly_masked(Y, (e_mask1 * e_mask2).unsqueeze(-1))
-
-        E1 = self.e_mul(E) * e_mask1 * e_mask2                        # bs, n, n, dx
-        E1 = E1.reshape((E.size(0), E.size(1), E.size(2), self.n_head, self.df))
-
-        E2 = self.e_add(E) * e_mask1 * e_mask2                        # bs, n, n, dx
-        E2 = E2.reshape((E.size(0), E.size(1), E.size(2), self.n_head, self.df))
-
-        # Incorporate edge features to the self attention scores.
-        Y = Y * (E1 + 1) + E2                  # (bs, n, n, n_head, df)
+        V = self.v(X) * x_mask                        # bs, n, dx
+        V = V.reshape((V.size(0), V.size(1), self.n_head, self.df))
 
-        # Incorporate y to E
-        newE = Y.flatten(start_dim=3)                      # bs, n, n, dx
         ye1 = self.y_e_add(y).unsqueeze(1).unsqueeze(1)  # bs, 1, 1, de
         ye2 = self.y_e_mul(y).unsqueeze(1).unsqueeze(1)
-        newE = ye1 + (ye2 + 1) * newE
 
-        # Output E
-        newE = self.e_out(newE) * e_mask1 * e_mask2      # bs, n, n, de
-        diffusion_utils.assert_correctly_masked(newE, e_mask1 * e_mask2)
-
-        # Compute attentions. attn is still (bs, n, n, n_head, df)
-        attn = F.softmax(Y, dim=2)
-
-        V = self.v(X) * x_mask                        # bs, n, dx
-        V = V.reshape((V.size(0), V.size(1), self.n_head, self.df))
-        V = V.unsqueeze(1)                                     # (bs, 1, n, n_head, df)
-
-        # Compute weighted values
-        weighted_V = attn * V
-        weighted_V = weighted_V.sum(dim=2)
+        n = X.size(1)
+        if pair_index is not None:
+            # Rows of E are gathered from the upper triangular pairs. The diagonal reads an extra row of zeros
+            E_source = torch.cat((E, E.new_zeros(E.size(0), 1, E.size(-1))), dim=1)
+        chunk_size = n if self.attention_chunk_size is None else self.attention_chunk_size
+        if chunk_size >= n:
+            if pair_index is None:
+                newE, weighted_V = self.attend_rows(Q, K, V, E, ye1, ye2, x_mask, x_mask)
+            else:
+                newE, weighted_V = self.attend_rows(Q, K, V, E_source, ye1, ye2, x_mask, x_mask, pair_index)
+        else:
+            # Each block of query rows only needs its own rows of E, so the (bs, n, n, n_head, df) tensors are
+            # built chunk_size rows at a time. During training, blocks are recomputed in the backward pass
+            # instead of keeping their intermediate tensors.
+            recompute = self.training and torch.is_grad_enabled()
+            newE_blocks, weighted_V_blocks = [], []
+            for start in range(0, n, chunk_size):
+                rows = slice(start, start + chunk_size)
+                if pair_index is None:
+                    inputs = (Q[:, rows], K, V, E[:, rows], ye1, ye2, x_mask[:, rows], x_mask)
+                else:
+                    inputs = (Q[:, rows], K, V, E_source, ye1, ye2, x_mask[:, rows], x_mask, pair_index[rows])
+                if recompute:
+                    newE_block, weighted_V_block = checkpoint(self.attend_rows, *inputs)
+                else:
+                    newE_block, weighted_V_block = self.attend_rows(*inputs)
+                newE_blocks.append(newE_block)
+                weighted_V_blocks.append(weighted_V_block)
+            newE = torch.cat(newE_blocks, dim=1)
+            weighted_V = torch.cat(weighted_V_blocks, dim=1)
+
+        if pair_index is not None:
+            # Both directions of each pair are averaged, which keeps the edge features symmetric
+            newE = (utils.to_triu(newE) + utils.to_triu(newE.transpose(1, 2))) / 2
 
         # Send output to input dim
         weighted_V = weighted_V.flatten(start_dim=2)            # bs, n, dx
@@ -210,16 +228,113 @@ class NodeEdgeBlock(nn.Module):
 
         return newX, newE, new_y
 
+    def forward_packed(self, X, E, y, packed):
+        """ Same layer on the num_nodes, dx nodes and num_pairs, de pairs of a utils.PackedGraphs.
+            The softmax of each node only runs over the nodes of its own graph, so padding does not take part in
+            the attention nor in the pooling to y, unlike in forward.
+        """
+        src, dst = packed.pair_src, packed.pair_dst
+
+        Q = self.q(X).reshape((-1, self.n_head, self.df))           # num_nodes, n_head, df
+        K = self.k(X).reshape((-1, self.n_head, self.df))
+        V = self.v(X).reshape((-1, self.n_head, self.df))
+
+        # Unnormalized attentions of each pair. Y is (num_pairs, n_head, df)
+        Y = Q[src] * K[dst]
+        Y = Y / math.sqrt(Y.size(-1))
+
+        E1 = self.e_mul(E).reshape((-1, self.n_head, self.df))
+        E2 = self.e_add(E).reshape((-1, self.n_head, self.df))
+        Y = Y * (E1 + 1) + E2
+
+        # Incorporate y to E
+        newE = Y.flatten(start_dim=1)                                 # num_pairs, dx
+        newE = self.y_e_add(y)[packed.pair_graph] + (self.y_e_mul(y)[packed.pair_graph] + 1) * newE
+        newE = self.e_out(newE)                                       # num_pairs, de
+
+        # Softmax over the pairs that share the same query node, then sum of the values
+        attn = softmax(Y, src, num_nodes=packed.num_nodes)
+        weighted_V = Q.new_zeros(Q.shape).index_add_(0, src, attn * V[dst])
+        weighted_V = weighted_V.flatten(start_dim=1)                # num_nodes, dx
+
+        # Incorporate y to X
+        newX = self.y_x_add(y)[packed.node_graph] + (self.y_x_mul(y)[packed.node_graph] + 1) * weighted_V
+        newX = self.x_out(newX)
+
+        y = self.y_y(y)
+        e_y = self.e_y(E, packed.pair_graph, packed.num_graphs)
+        x_y = self.x_y(X, packed.node_graph, packed.num_graphs)
+        new_y = self.y_out(y + x_y + e_y)
+        return newX, newE, new_y
+
+    def attend_rows(self, Q, K, V, E, ye1, ye2, row_mask, x_mask, pair_index=None):
+        """ Attention of a block of query rows over all the nodes.
+            Q: bs, r, n_head, df      K, V: bs, n, n_head, df      E: bs, r, n, de
+            row_mask: bs, r, 1        x_mask: bs, n, 1
+            pair_index: r, n. If given, E is the padded upper triangular layout and its rows are gathered from it.
+            Returns newE (bs, r, n, de) and the weighted values (bs, r, n_head, df).
+        """
+        if pair_index is not None:
+            E = E[:, pair_index]
+        e_mask1 = row_mask.unsqueeze(2)         # bs, r, 1, 1
+        e_mask2 = x_mask.unsqueeze(1)           # bs, 1, n, 1
+
+        Q = Q.unsqueeze(2)                              # (bs, r, 1, n_head, df)
+        K = K.unsqueeze(1)                              # (bs, 1, n, n head, df)
+
+        # Compute unnormalized attentions. Y is (bs, r, n, n_head, df)
+        Y = Q * K
+        Y = Y / math.sqrt(Y.size(-1))
+        diffusion_utils.assert_correctly_masked(Y, (e_mask1 * e_mask2).unsqueeze(-1))
+
+        E1 = self.e_mul(E) * e_mask1 * e_mask2                        # bs, r, n, dx
+        E1 = E1.reshape((E.size(0), E.size(1), E.size(2), self.n_head, self.df))
+
+        E2 = self.e_add(E) * e_mask1 * e_mask2                        # bs, r, n, dx
+        E2 = E2.reshape((E.size(0), E.size(1), E.size(2), self.n_head, self.df))
+
+        # Incorporate edge features to the self attention scores.
+        Y = Y * (E1 + 1) + E2                  # (bs, r, n, n_head, df)
+
+        # Incorporate y to E
+        newE = Y.flatten(start_dim=3)                      # bs, r, n, dx
+        newE = ye1 + (ye2 + 1) * newE
+
+        # Output E
+        newE = self.e_out(newE) * e_mask1 * e_mask2      # bs, r, n, de
+        diffusion_utils.assert_correctly_masked(newE, e_mask1 * e_mask2)
+
+        # Compute attentions. attn is still (bs, r, n, n_head, df)
+        attn = F.softmax(Y, dim=2)
+
+        V = V.unsqueeze(1)                                     # (bs, 1, n, n_head, df)
+
+        # Compute weighted values
+        weighted_V = attn * V
+        weighted_V = weighted_V.sum(dim=2)                     # bs, r, n_head, df
+        return newE, weighted_V
+
 
 class GraphTransformer(nn.Module):
     """
     n_layers : int -- number of layers
     dims : dict -- contains dimensions for each feature type
+    attention_chunk_size : int -- number of query rows processed at once in the attention, None for all
+    symmetric_edges : bool -- keep only the pairs above the diagonal in the edge features, see forward_triu
+    packed : bool -- run on the real nodes of each graph only, see forward_packed
+    checkpoint_every : int -- during training, recompute the activations of each group of that many layers in the
+                              backward pass instead of storing them, None to store everything
     """
     def __init__(self, n_layers: int, input_dims: dict, hidden_mlp_dims: dict, hidden_dims: dict,
-                 output_dims: dict, act_fn_in: nn.ReLU(), act_fn_out: nn.ReLU()):
+                 output_dims: dict, act_fn_in: nn.ReLU(), act_fn_out: nn.ReLU(), attention_chunk_size=None,
+                 symmetric_edges: bool = False, packed: bool = False, checkpoint_every=None):
         super().__init__()
+        if packed and symmetric_edges:
+            raise ValueError("packed and symmetric_edges cannot be used together")
         self.n_layers = n_layers
+        self.symmetric_edges = symmetric_edges
+        self.packed = packed
+        self.checkpoint_every = checkpoint_every
         self.out_dim_X = output_dims['X']
         self.out_dim_E = output_dims['E']
         self.out_dim_y = output_dims['y']
@@ -238,7 +353,8 @@ class GraphTransformer(nn.Module):
                                                             dy=hidden_dims['dy'],
                                                             n_head=hidden_dims['n_head'],
                                                             dim_ffX=hidden_dims['dim_ffX'],
-                                                            dim_ffE=hidden_dims['dim_ffE'])
+                                                            dim_ffE=hidden_dims['dim_ffE'],
+                                                            attention_chunk_size=attention_chunk_size)
                                         for i in range(n_layers)])
 
         self.mlp_out_X = nn.Sequential(nn.Linear(hidden_dims['dx'], hidden_mlp_dims['X']), act_fn_out,
@@ -250,7 +366,16 @@ class GraphTransformer(nn.Module):
         self.mlp_out_y = nn.Sequential(nn.Linear(hidden_dims['dy'], hidden_mlp_dims['y']), act_fn_out,
                                        nn.Linear(hidden_mlp_dims['y'], output_dims['y']))
 
-    def forward(self, X, E, y, node_mask):
+    def forward(self, X, E, y, node_mask, candidates=None):
+        """ candidates: 3, P (graph, i, j) pairs for the sparse edge mode, see forward_packed. """
+        if candidates is not None:
+            if self.symmetric_edges:
+                raise ValueError("The sparse edge mode cannot be used with symmetric_edges")
+            return self.forward_packed(X, E, y, node_mask, candidates)
+        if self.symmetric_edges:
+            return self.forward_triu(X, E, y, node_mask)
+        if self.packed:
+            return self.forward_packed(X, E, y, node_mask)
         bs, n = X.shape[0], X.shape[1]
 
         diag_mask = torch.eye(n)
@@ -266,8 +391,7 @@ class GraphTransformer(nn.Module):
         after_in = utils.PlaceHolder(X=self.mlp_in_X(X), E=new_E, y=self.mlp_in_y(y)).mask(node_mask)
         X, E, y = after_in.X, after_in.E, after_in.y
 
-        for layer in self.tf_layers:
-            X, E, y = layer(X, E, y, node_mask)
+        X, E, y = self.run_layers(X, E, y, node_mask)
 
         X = self.mlp_out_X(X)
         E = self.mlp_out_E(E)
@@ -280,3 +404,88 @@ class GraphTransformer(nn.Module):
         E = 1/2 * (E + torch.transpose(E, 1, 2))
 
         return utils.PlaceHolder(X=X, E=E, y=y).mask(node_mask)
+
+    def run_layers(self, X, E, y, node_mask, **kwargs):
+        """ Applies the transformer layers. With checkpoint_every = k, only the inputs of each group of k layers
+            are kept for the backward pass during training, and the group is run again to get its gradients. """
+        k = self.checkpoint_every
+        if k is None or not (self.training and torch.is_grad_enabled()):
+            for layer in self.tf_layers:
+                X, E, y = layer(X, E, y, node_mask, **kwargs)
+            return X, E, y
+
+        for start in range(0, self.n_layers, k):
+            def run_group(X, E, y, layers=self.tf_layers[start: start + k]):
+                for layer in layers:
+                    X, E, y = layer(X, E, y, node_mask, **kwargs)
+                return X, E, y
+            X, E, y = checkpoint(run_group, X, E, y)
+        return X, E, y
+
+    def forward_triu(self, X, E, y, node_mask):
+        """ Same inputs and outputs as forward, but the edge features are stored as the bs, n * (n - 1) / 2, de
+            pairs above the diagonal from the input MLP to the output MLP. Only the attention looks at both
+            directions of each pair, and each layer averages them. """
+        n = X.shape[1]
+        pair_index = utils.triu_pair_index(n, device=E.device)
+        x_mask = node_mask.unsqueeze(-1)
+        pair_mask = utils.to_triu(x_mask.unsqueeze(2) * x_mask.unsqueeze(1))      # bs, n * (n - 1) / 2, 1
+
+        X_to_out = X[..., :self.out_dim_X]
+        E_to_out = utils.to_triu(E[..., :self.out_dim_E])
+        y_to_out = y[..., :self.out_dim_y]
+
+        X = self.mlp_in_X(X) * x_mask
+        E = self.mlp_in_E(utils.to_triu(E)) * pair_mask
+        y = self.mlp_in_y(y)
+
+        X, E, y = self.run_layers(X, E, y, node_mask, pair_index=pair_index)
+
+        X = self.mlp_out_X(X) + X_to_out
+        E = utils.from_triu(self.mlp_out_E(E) + E_to_out, n, pair_index)
+        y = self.mlp_out_y(y) + y_to_out
+
+        return utils.PlaceHolder(X=X, E=E, y=y).mask(node_mask)
+
+    def forward_packed(self, X, E, y, node_mask, candidates=None):
+        """ Same inputs and outputs as forward, but the layers run on the concatenated nodes of all graphs and on
+            the sum n_i^2 pairs of nodes of the same graph, instead of bs * n^2 padded pairs. The attention is
+            block diagonal and the pooling to y uses segment reductions over the real nodes and pairs.
+            Since padding is left out of the softmax and of the pooling, outputs differ from forward for graphs
+            smaller than n: a model should be trained and sampled with the same setting.
+            attention_chunk_size is not used here.
+
+            Sparse edge mode: with candidate pairs (see utils.candidate_pairs), only the candidate pairs have an
+            edge state and each node only attends to its candidates, so the memory follows the number of candidates
+            instead of n^2. The other pairs are predicted to have no edge, with logits NO_EDGE_LOGIT and 0.
+        """
+        packed = utils.PackedGraphs(node_mask, pairs=candidates)
+        X, E = packed.pack(X, E)
+        not_diag = (packed.pair_src != packed.pair_dst).unsqueeze(-1).type_as(E)
+
+        X_to_out = X[..., :self.out_dim_X]
+        E_to_out = E[..., :self.out_dim_E]
+        y_to_out = y[..., :self.out_dim_y]
+
+        X = self.mlp_in_X(X)
+        E = self.mlp_in_E(E)
+        E = (E + E[packed.pair_transpose]) / 2
+        y = self.mlp_in_y(y)
+
+        X, E, y = self.run_layers(X, E, y, node_mask, packed=packed)
+
+        X = self.mlp_out_X(X) + X_to_out
+        E = (self.mlp_out_E(E) + E_to_out) * not_diag
+        E = 1/2 * (E + E[packed.pair_transpose])
+        y = self.mlp_out_y(y) + y_to_out
+
+        X, E = packed.unpack(X, E)
+        if candidates is not None:
+            bs, n = node_mask.shape
+            left_out = ~torch.eye(n, dtype=torch.bool, device=E.device).repeat(bs, 1, 1)
+            b, i, j = candidates
+            left_out[b, i, j] = False
+            no_edge = E.new_zeros(E.shape[-1])
+            no_edge[0] = NO_EDGE_LOGIT
+            E[left_out] = no_edge
+        return utils.PlaceHolder(X=X, E=E, y=y).mask(node_mask)
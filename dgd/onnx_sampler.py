@@ -0,0 +1,180 @@
+""" Standalone sampler of a denoiser exported with DiscreteDenoisingDiffusion.export_onnx.
+
+    Only needs torch and onnxruntime, not Lightning, hydra, wandb or the rest of the code: the network runs
+    with onnxruntime and the reverse diffusion uses the coefficients that export_onnx writes to path + '.sampler.json'
+    (noise schedule, limit distributions, node count distribution and the timesteps of the sampler). The transitions
+    of the discrete model, uniform or marginal, are Q(a) = a * I + (1 - a) * 1 m^T with m the limit distribution,
+    so the posterior is computed in closed form as in diffusion_utils.low_rank_posterior_distribution.
+
+    The extra features of the network are computed by the training code. Models trained without extra and domain
+    features only get the time as extra input, which time_features computes. Other models need an extra_features
+    function that returns the same features as DiscreteDenoisingDiffusion.compute_extra_data.
+
+    python dgd/onnx_sampler.py model.onnx --num_samples 100 --output samples.pt
+"""
+import argparse
+import json
+
+import torch
+import torch.nn.functional as F
+
+
+def time_features(noisy_data):
+    """ Extra features of a model without extra and domain features: no node or edge feature, and the time t. """
+    X, E = noisy_data['X_t'], noisy_data['E_t']
+    return X.new_zeros(X.shape[:2] + (0,)), E.new_zeros(E.shape[:3] + (0,)), noisy_data['t']
+
+
+def write_sampler_coefficients(path, T, timesteps, betas, alphas_bar, x_limit, e_limit, node_prob, one_step,
+                               exact_posterior=False):
+    """ Writes what OnnxSampler needs besides the network to path + '.sampler.json'. one_step: the sampler visits
+        all T steps and uses the one step transitions, otherwise transitions from s to t are computed from alpha_bar.
+        exact_posterior: model.exact_sampling_posterior, alpha_s_bar of the one step sampler at s instead of t.
+    """
+    coefficients = {'T': T, 'timesteps': [int(t) for t in timesteps], 'betas': betas.tolist(),
+                    'alphas_bar': alphas_bar.tolist(), 'x_limit': x_limit.tolist(), 'e_limit': e_limit.tolist(),
+                    'node_prob': node_prob.tolist(), 'one_step': one_step, 'exact_posterior': exact_posterior}
+    with open(path + '.sampler.json', 'w') as f:
+        json.dump(coefficients, f)
+
+
+class OnnxSampler:
+    """ Samples graphs from the network exported to path, on the cpu. Follows the reverse diffusion of
+        DiscreteDenoisingDiffusion.sample_batch and draws from the global torch random state in the same order, so
+        that both samplers can be compared step by step, see DiscreteDenoisingDiffusion.export_onnx.
+    """
+    def __init__(self, path, num_threads=None, extra_features=None):
+        import onnxruntime
+        options = onnxruntime.SessionOptions()
+        if num_threads is not None:
+            options.intra_op_num_threads = num_threads
+        self.session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        with open(path + '.json', 'r') as f:
+            self.dims = json.load(f)
+        with open(path + '.sampler.json', 'r') as f:
+            coefficients = json.load(f)
+        self.T = coefficients['T']
+        self.timesteps = coefficients['timesteps']
+        self.one_step = coefficients['one_step']
+        self.exact_posterior = coefficients.get('exact_posterior', False)
+        self.betas = torch.tensor(coefficients['betas'])
+        self.alphas_bar = torch.tensor(coefficients['alphas_bar'])
+        self.x_limit = torch.tensor(coefficients['x_limit'])
+        self.e_limit = torch.tensor(coefficients['e_limit'])
+        self.node_dist = torch.distributions.Categorical(torch.tensor(coefficients['node_prob']))
+        if extra_features is None:
+            if (self.dims['extra_X'], self.dims['extra_E'], self.dims['extra_y']) != (0, 0, 1):
+                raise ValueError("The network has extra features besides the time, pass their extra_features function")
+            extra_features = time_features
+        self.extra_features = extra_features
+
+    def sample_noise(self, node_mask):
+        """ Graphs drawn from the limit distribution, one-hot encoded. Same as sample_discrete_feature_noise. """
+        bs, n = node_mask.shape
+        X = self.x_limit[None, None, :].expand(bs, n, -1).flatten(end_dim=-2).multinomial(1).reshape(bs, n)
+        E = self.e_limit[None, None, None, :].expand(bs, n, n, -1).flatten(end_dim=-2).multinomial(1)
+        X = F.one_hot(X, num_classes=len(self.x_limit)).float()
+        E = F.one_hot(E.reshape(bs, n, n), num_classes=len(self.e_limit)).float()
+        E = torch.triu(E.permute(0, 3, 1, 2), diagonal=1).permute(0, 2, 3, 1)
+        return self.mask(X, E + E.transpose(1, 2), node_mask)
+
+    @staticmethod
+    def mask(X, E, node_mask):
+        pair_mask = node_mask.unsqueeze(1) & node_mask.unsqueeze(2)
+        return X * node_mask.unsqueeze(-1), E * pair_mask.unsqueeze(-1)
+
+    def predict(self, X_t, E_t, y_t, t, node_mask):
+        """ Predicted distributions of X_0 and E_0 given the noisy graphs at normalized times t (bs, 1). """
+        noisy_data = {'X_t': X_t, 'E_t': E_t, 'y_t': y_t, 't': t, 'node_mask': node_mask}
+        extra_X, extra_E, extra_y = self.extra_features(noisy_data)
+        inputs = {'X_t': X_t, 'E_t': E_t, 'y_t': y_t, 'extra_X': extra_X, 'extra_E': extra_E, 'extra_y': extra_y}
+        inputs = {name: tensor.float().numpy() for name, tensor in inputs.items()}
+        inputs['node_mask'] = node_mask.numpy()
+        pred_X, pred_E, _ = self.session.run(None, inputs)
+        return F.softmax(torch.from_numpy(pred_X), dim=-1), F.softmax(torch.from_numpy(pred_E), dim=-1)
+
+    def posterior(self, X_t, E_t, y_t, node_mask, s_int, t_int):
+        """ Distributions of X_s and E_s given the noisy graphs at step t_int, for a step s_int < t_int. """
+        bs, n, _ = X_t.shape
+        t = t_int * torch.ones((bs, 1)) / self.T
+        pred_X, pred_E = self.predict(X_t, E_t, y_t, t, node_mask)
+        # As in DiscreteDenoisingDiffusion.sample_p_zs_given_zt, the one step sampler takes alpha_s_bar at t by default
+        s_bar_int = t_int if self.one_step and not self.exact_posterior else s_int
+        alpha_s_bar = self.alphas_bar[s_bar_int] * torch.ones((bs, 1))
+        alpha_t_bar = self.alphas_bar[t_int] * torch.ones((bs, 1))
+        alpha_t = 1 - self.betas[t_int] * torch.ones((bs, 1)) if self.one_step else alpha_t_bar / alpha_s_bar
+        coefficients = (alpha_t, alpha_s_bar, alpha_t_bar)
+        prob_X = self.mixed_posterior(X_t, pred_X, self.x_limit, *coefficients)
+        prob_E = self.mixed_posterior(E_t.flatten(start_dim=1, end_dim=2), pred_E.reshape(bs, n * n, -1),
+                                      self.e_limit, *coefficients)
+        return prob_X, prob_E.reshape(bs, n, n, -1)
+
+    @staticmethod
+    def mixed_posterior(M_t, pred, marginals, alpha_t, alpha_s_bar, alpha_t_bar):
+        """ Normalized posterior of M_s given M_t, mixed over the predicted distribution of M_0. M_t, pred: bs, N, d.
+            See diffusion_utils.low_rank_posterior_distribution. """
+        M_t = M_t.float()
+        alpha_t, alpha_s_bar, alpha_t_bar = alpha_t.unsqueeze(-1), alpha_s_bar.unsqueeze(-1), alpha_t_bar.unsqueeze(-1)
+        m_t = M_t @ marginals.unsqueeze(-1)
+        left_term = alpha_t * M_t + (1 - alpha_t) * m_t
+        denominator = alpha_t_bar * M_t + (1 - alpha_t_bar) * m_t
+        denominator[denominator == 0] = 1e-6
+        w = pred / denominator
+        prob = left_term * (alpha_s_bar * w + (1 - alpha_s_bar) * w.sum(dim=-1, keepdim=True) * marginals)
+        prob[torch.sum(prob, dim=-1) == 0] = 1e-5
+        return prob / torch.sum(prob, dim=-1, keepdim=True)
+
+    def sample_step(self, prob_X, prob_E, node_mask):
+        """ One-hot graphs drawn from the posterior. Same as diffusion_utils.sample_discrete_features: only the pairs
+            above the diagonal are drawn and masked entries draw from a uniform distribution. """
+        bs, n, dx = prob_X.shape
+        de = prob_E.shape[-1]
+        prob_X[~node_mask] = 1 / dx
+        X = prob_X.reshape(bs * n, dx).multinomial(1).reshape(bs, n)
+        rows, cols = torch.triu_indices(n, n, offset=1)
+        prob_E = prob_E[:, rows, cols]
+        prob_E[~(node_mask[:, rows] & node_mask[:, cols])] = 1 / de
+        pairs = prob_E.reshape(-1, de).multinomial(1).reshape(bs, -1)
+        E = torch.zeros((bs, n, n), dtype=torch.long)
+        E[:, rows, cols] = pairs
+        E[:, cols, rows] = pairs
+        return self.mask(F.one_hot(X, num_classes=dx).float(), F.one_hot(E, num_classes=de).float(), node_mask)
+
+    @torch.no_grad()
+    def sample_batch(self, batch_size):
+        """ Samples batch_size graphs. Returns a list of (atom_types, edge_types) like sample_batch. """
+        n_nodes = self.node_dist.sample((batch_size,))
+        node_mask = torch.arange(n_nodes.max().item()).unsqueeze(0) < n_nodes.unsqueeze(1)
+        X, E = self.sample_noise(node_mask)
+        y = torch.zeros((batch_size, 0))
+        for t_int, s_int in zip(self.timesteps[:-1], self.timesteps[1:]):
+            X, E = self.sample_step(*self.posterior(X, E, y, node_mask, s_int, t_int), node_mask)
+        X, E = torch.argmax(X, dim=-1), torch.argmax(E, dim=-1)
+        X[~node_mask] = -1
+        E[~(node_mask.unsqueeze(1) & node_mask.unsqueeze(2))] = -1
+        return [[X[i, :n], E[i, :n, :n]] for i, n in enumerate(n_nodes.tolist())]
+
+    def sample(self, num_samples, batch_size=64):
+        samples = []
+        for ident in range(0, num_samples, batch_size):
+            samples.extend(self.sample_batch(min(batch_size, num_samples - ident)))
+        return samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Samples graphs from an exported denoiser with onnxruntime")
+    parser.add_argument('path', help="ONNX file written by general.export_onnx")
+    parser.add_argument('--num_samples', type=int, default=100)
+    parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='samples.pt', help="Where the list of (atom_types, edge_types) is saved")
+    args = parser.parse_args()
+    torch.manual_seed(args.seed)
+    samples = OnnxSampler(args.path, num_threads=args.threads).sample(args.num_samples, args.batch_size)
+    torch.save(samples, args.output)
+    print(f"Saved {len(samples)} graphs to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -10,6 +10,40 @@ from torch_geometric.utils import to_dense_adj, to_dense_batch
 import torch
 
 
+# Precisions of the denoising network. Everything outside of the network stays in float32
+PRECISIONS = {'fp32': torch.float32, 'bf16': torch.bfloat16}
+
+
+def network_autocast(device, precision):
+    """ Context to run the denoising network in. 'bf16' autocasts the network to bfloat16, on cpu or cuda. """
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unknown precision {precision}, expected one of {list(PRECISIONS)}")
+    return torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=precision == 'bf16')
+
+
+# Level of the runtime checks on the values of tensors, which read whole tensors and synchronize with the device.
+# 'full': every check, 'sampled': one check out of check_interval, 'off': no check. Checks on shapes always run
+CHECK_LEVELS = ('off', 'sampled', 'full')
+_checks = {'level': 'full', 'interval': 100, 'calls': {}}
+
+
+def set_check_level(level, interval=100):
+    if level not in CHECK_LEVELS:
+        raise ValueError(f"Unknown check level {level}, expected one of {CHECK_LEVELS}")
+    _checks.update(level=level, interval=interval, calls={})
+
+
+def should_check(name):
+    """ Whether the next check on tensor values called name should run, see set_check_level. With 'sampled', each
+        check counts its own calls, so that frequent checks do not decide which calls of rare ones run: a check runs
+        on its first call and then once every check_interval calls. """
+    if _checks['level'] == 'sampled':
+        calls = _checks['calls'].get(name, 0)
+        _checks['calls'][name] = calls + 1
+        return calls % _checks['interval'] == 0
+    return _checks['level'] == 'full'
+
+
 def create_folders(args):
     try:
         # os.makedirs('checkpoints')
@@ -137,7 +171,7 @@ def normalize(X, E, y, norm_values, norm_biases, node_mask):
     E = (E - norm_biases[1]) / norm_values[1]
     y = (y - norm_biases[2]) / norm_values[2]
 
-    diag = torch.eye(E.shape[1], dtype=torch.bool).unsqueeze(0).expand(E.shape[0], -1, -1)
+    diag = torch.eye(E.shape[1], dtype=torch.bool, device=E.device).unsqueeze(0).expand(E.shape[0], -1, -1)
     E[diag] = 0
 
     return PlaceHolder(X=X, E=E, y=y).mask(node_mask)
@@ -175,6 +209,130 @@ def to_dense(x, edge_index, edge_attr, batch):
     return PlaceHolder(X=X, E=E, y=None), node_mask
 
 
+def dense_batch(data):
+    """ Masked dense X, E and node_mask of a batch. Uses the tensors built by DenseCollater in the DataLoader
+        workers when they are there, and computes them otherwise. """
+    if 'dense_X' in data:
+        return PlaceHolder(X=data.dense_X, E=data.dense_E, y=None), data.node_mask
+    dense_data, node_mask = to_dense(data.x, data.edge_index, data.edge_attr, data.batch)
+    return dense_data.mask(node_mask), node_mask
+
+
+def triu_pair_index(n, device=None):
+    """ (n, n) tensor giving, for each ordered pair of nodes, the position of the pair in the upper triangular
+        layout of to_triu. (i, j) and (j, i) share the same position and the diagonal points to an extra position
+        P = n * (n - 1) / 2, used as a padding row by from_triu. """
+    rows, cols = torch.triu_indices(n, n, offset=1, device=device)
+    pairs = torch.arange(rows.shape[0], device=device)
+    index = torch.full((n, n), rows.shape[0], dtype=torch.long, device=device)
+    index[rows, cols] = pairs
+    index[cols, rows] = pairs
+    return index
+
+
+def to_triu(E):
+    """ E: bs, n, n, ... symmetric tensor. Returns the bs, n * (n - 1) / 2, ... entries above the diagonal. """
+    rows, cols = torch.triu_indices(E.shape[1], E.shape[2], offset=1, device=E.device)
+    return E[:, rows, cols]
+
+
+def from_triu(E, n, pair_index=None):
+    """ Inverse of to_triu: builds the symmetric bs, n, n, ... tensor, with zeros on the diagonal. """
+    if pair_index is None:
+        pair_index = triu_pair_index(n, device=E.device)
+    padding = E.new_zeros((E.shape[0], 1) + tuple(E.shape[2:]))
+    return torch.cat((E, padding), dim=1)[:, pair_index]
+
+
+def all_pairs(node_mask):
+    """ 3, P long tensor of the (graph, i, j) ordered pairs of nodes of the same graph, diagonal included, sorted. """
+    node_mask = node_mask.bool()
+    return (node_mask.unsqueeze(2) & node_mask.unsqueeze(1)).nonzero().T
+
+
+class PackedGraphs:
+    """ Indices to run the transformer on the concatenated real nodes of a dense batch, without padding.
+
+        Nodes are numbered in the order of X[node_mask] and pairs in the order of pairs. By default, all the
+        ordered pairs (i, j) of nodes of the same graph are kept, diagonal included, so there are sum n_i^2 of them.
+        pairs: 3, P sorted and symmetric (graph, i, j) pairs to keep fewer pairs, see candidate_pairs.
+        node_graph, pair_graph: graph of each node and pair. pair_src, pair_dst: packed index of i and j.
+        pair_transpose: packed index of the pair (j, i).
+    """
+    def __init__(self, node_mask, pairs=None):
+        node_mask = node_mask.bool()
+        bs, n = node_mask.shape
+        self.node_mask = node_mask
+        self.pairs = all_pairs(node_mask) if pairs is None else pairs
+        self.num_graphs = bs
+        self.num_nodes = int(node_mask.sum())
+
+        node_index = torch.full((bs, n), -1, dtype=torch.long, device=node_mask.device)
+        node_index[node_mask] = torch.arange(self.num_nodes, device=node_mask.device)
+        self.node_graph = node_mask.nonzero(as_tuple=True)[0]
+
+        b, i, j = self.pairs
+        self.pair_graph = b
+        self.pair_src = node_index[b, i]
+        self.pair_dst = node_index[b, j]
+        # Pairs are sorted by (graph, i, j), so the pair (j, i) is found by binary search
+        self.pair_transpose = torch.searchsorted((b * n + i) * n + j, (b * n + j) * n + i)
+
+    def pack(self, X, E):
+        """ X: bs, n, dx  E: bs, n, n, de. Returns the num_nodes, dx node and num_pairs, de pair features. """
+        b, i, j = self.pairs
+        return X[self.node_mask], E[b, i, j]
+
+    def unpack(self, X, E):
+        """ Inverse of pack. Padding and left out pairs are filled with zeros. """
+        bs, n = self.node_mask.shape
+        b, i, j = self.pairs
+        dense_X = X.new_zeros((bs, n) + tuple(X.shape[1:]))
+        dense_E = E.new_zeros((bs, n, n) + tuple(E.shape[1:]))
+        dense_X[self.node_mask] = X
+        dense_E[b, i, j] = E
+        return dense_X, dense_E
+
+
+def candidate_pairs(E, node_mask, k_hop=2, num_random=8):
+    """ 3, P sorted and symmetric (graph, i, j) pairs that get an edge state in the sparse edge mode: the diagonal,
+        the edges of E, the pairs at most k_hop hops apart and num_random random partners per node.
+        The k-hop pairs come from products of the sparse adjacency matrix of the edge_index of the batch, so their cost
+        follows the number of edges and paths instead of bs * n^3.
+        E: bs, n, n, de one-hot edge types where type 0 is no edge. Nodes of each graph come first in the batch.
+    """
+    node_mask = node_mask.bool()
+    bs, n = node_mask.shape
+    device = E.device
+    # Nodes are numbered b * n + i, so the adjacency of the batch is block diagonal
+    b, i, j = ((E.argmax(dim=-1) > 0) & node_mask.unsqueeze(2) & node_mask.unsqueeze(1)).nonzero(as_tuple=True)
+    edge_index = torch.stack((b * n + i, b * n + j))
+    adj = torch.sparse_coo_tensor(edge_index, torch.ones(edge_index.shape[1], device=device), (bs * n, bs * n))
+    src, dst = [edge_index[0]], [edge_index[1]]
+
+    reach = adj
+    for _ in range(k_hop - 1):
+        reach = torch.sparse.mm(reach, adj).coalesce()
+        src.append(reach.indices()[0])
+        dst.append(reach.indices()[1])
+        reach = torch.sparse_coo_tensor(reach.indices(), torch.ones_like(reach.values()), reach.shape)
+
+    graphs, rows = node_mask.nonzero(as_tuple=True)
+    nodes = graphs * n + rows
+    src.append(nodes)
+    dst.append(nodes)
+    if num_random > 0:
+        n_nodes = node_mask.sum(dim=1)[graphs].unsqueeze(1)
+        partners = (torch.rand(nodes.shape[0], num_random, device=device) * n_nodes).long()
+        src.append(nodes.repeat_interleave(num_random))
+        dst.append((graphs.unsqueeze(1) * n + partners).flatten())
+
+    src, dst = torch.cat(src), torch.cat(dst)
+    # Both directions of every pair, sorted and without duplicates as keys (b * n + i) * n + j
+    keys = torch.unique(torch.cat((src * n + dst % n, dst * n + src % n)))
+    return torch.stack((keys // (n * n), keys // n % n, keys % n))
+
+
 def encode_no_edge(E):
     assert len(E.shape) == 4
     if E.shape[-1] == 0:
@@ -183,7 +341,7 @@ def encode_no_edge(E):
     first_elt = E[:, :, :, 0]
     first_elt[no_edge] = 1
     E[:, :, :, 0] = first_elt
-    diag = torch.eye(E.shape[1], dtype=torch.bool).unsqueeze(0).expand(E.shape[0], -1, -1)
+    diag = torch.eye(E.shape[1], dtype=torch.bool, device=E.device).unsqueeze(0).expand(E.shape[0], -1, -1)
     E[diag] = 0
     return E
 
@@ -240,7 +398,8 @@ class PlaceHolder:
         else:
             self.X = self.X * x_mask
             self.E = self.E * e_mask1 * e_mask2
-            assert torch.allclose(self.E, torch.transpose(self.E, 1, 2))
+            if should_check('masked_E_symmetric'):
+                assert torch.allclose(self.E, torch.transpose(self.E, 1, 2))
         return self
 
 